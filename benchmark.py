@@ -0,0 +1,678 @@
+"""
+Benchmarks for the database.
+
+    python benchmark.py micro
+        codec, validation, checksum and recovery micro benchmarks
+    python benchmark.py ycsb --target persistent --workload update-heavy
+        a YCSB style workload, see run_workload
+    python benchmark.py compare baseline.json current.json
+        compares two ycsb results and fails on regressions
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from database import *
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def make_document(rng: random.Random) -> Object:
+    """
+    Creates an account document like the ones stored in the database.
+    """
+    account = {"name": rng.choice(["Bill", "Roger", "Ann", "Maria"]),
+               "address": str(rng.randint(1, 999)) + " main street",
+               "phones": ["619-594-" + str(rng.randint(1000, 9999))
+                          for _ in range(rng.randint(1, 4))],
+               "balance": round(rng.uniform(0, 10000), 2),
+               "history": [{"amount": rng.randint(1, 500),
+                            "type": rng.choice(["deposit", "withdrawal"])}
+                           for _ in range(rng.randint(5, 50))]}
+    return Object.from_string(json.dumps(account))
+
+
+def benchmark_codecs(documents: int = 1000, seed: int = 1) -> list:
+    """
+    Compresses the same documents with each codec.
+    Returns a result per codec with the compression ratio and the
+    compress and decompress time per document in microseconds.
+    """
+    rng = random.Random(seed)
+    samples = [make_document(rng).to_string() for _ in range(documents)]
+    dictionary = ZlibCodec.train_dictionary(samples[:100])
+    codecs = [('zlib-1', ZlibCodec(level=1)),
+              ('zlib-6', ZlibCodec(level=6)),
+              ('zlib-6-dictionary', ZlibCodec(level=6, dictionary=dictionary)),
+              ('lzma-0', LzmaCodec(preset=0)),
+              ('lzma-6', LzmaCodec(preset=6))]
+
+    raw = [sample.encode() for sample in samples]
+    raw_bytes = sum(len(data) for data in raw)
+    results = []
+    for (name, codec) in codecs:
+        start = time.perf_counter()
+        compressed = [codec.compress(data) for data in raw]
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in compressed:
+            codec.decompress(data)
+        decompress_time = time.perf_counter() - start
+
+        compressed_bytes = sum(len(data) for data in compressed)
+        results.append({"codec": name,
+                        "raw_bytes": raw_bytes,
+                        "compressed_bytes": compressed_bytes,
+                        "ratio": round(raw_bytes / compressed_bytes, 2),
+                        "compress_us": round(compress_time / documents * 1e6, 1),
+                        "decompress_us": round(decompress_time / documents * 1e6, 1)})
+    return results
+
+
+def benchmark_validation(puts: int = 200000) -> list:
+    """
+    Compares the time per value of the uncached validator chain, the
+    cached Validator and compiled schemas, and the time per BaseDB.put
+    with and without a schema.
+    """
+    # the chain as Validator built it before results were cached per type
+    chain = NumberValidator()
+    string_validator = StringValidator()
+    array_validator = ArrayValidator()
+    object_validator = ObjectValidator()
+    chain.set_next_validator(string_validator)
+    string_validator.set_next_validator(array_validator)
+    array_validator.set_next_validator(object_validator)
+    object_validator.set_next_validator(InvalidDataTypeValidator())
+
+    account = Object.from_string(json.dumps(
+        {"name": "Bill", "balance": 1234.05, "phones": ["619-594-3535"]}))
+    account_schema = Schema({"name": "string", "balance": "number",
+                             "phones": ["string"]}, required=["name"])
+    values = ["text", 5, 3.5, account]
+
+    def schema_check(spec):
+        validate = Schema.compile(spec)
+        return lambda value: Schema.check(validate, value)
+
+    checks = [("chain", chain.is_valid),
+              ("cached_validator", Validator().is_valid),
+              ("schema_string", schema_check("string")),
+              ("schema_number", schema_check("number")),
+              ("schema_account", schema_check(account_schema))]
+
+    results = []
+    for (name, check) in checks:
+        if name == "schema_account":
+            checked = [account]
+        elif name.startswith("schema"):
+            checked = [values[0] if name == "schema_string" else values[1]]
+        else:
+            checked = values
+        start = time.perf_counter()
+        for _ in range(puts // len(checked)):
+            for value in checked:
+                check(value)
+        elapsed = time.perf_counter() - start
+        results.append({"validation": name,
+                        "ns_per_value": round(elapsed / puts * 1e9, 1)})
+
+    # new documents are checked in full, puts of a document which is
+    # already bound to the schema only check its type
+    documents = [Object.from_string(account.to_string())
+                 for _ in range(puts // 2)]
+    for with_schema in (False, True):
+        for new_documents in (False, True):
+            database = BaseDB()
+            if with_schema:
+                database.set_schema("account:", account_schema)
+                database.set_schema("count:", "int")
+            start = time.perf_counter()
+            for i in range(puts // 2):
+                document = documents[i] if new_documents else account
+                database.put("account:" + str(i % 1000), document)
+                database.put("count:" + str(i % 1000), i)
+            elapsed = time.perf_counter() - start
+            results.append({"put_with_schema": with_schema,
+                            "new_documents": new_documents,
+                            "ns_per_put": round(elapsed / puts * 1e9, 1)})
+    return results
+
+
+def benchmark_numeric(values: int = 1000000, seed: int = 1) -> list:
+    """
+    Compares an Array of floats with a NumericArray: memory, append, sum
+    and the size of the logged json.
+    """
+    rng = random.Random(seed)
+    floats = [rng.uniform(0, 1000) for _ in range(values)]
+    results = []
+
+    start = time.perf_counter()
+    series = Array()
+    for value in floats:
+        series.put(value)
+    append_time = time.perf_counter() - start
+    start = time.perf_counter()
+    sum(series.get(i) for i in range(series.length()))
+    sum_time = time.perf_counter() - start
+    results.append({"value": "Array",
+                    "values": values,
+                    "memory_bytes": memory_size(series),
+                    "append_s": round(append_time, 4),
+                    "sum_s": round(sum_time, 4),
+                    "json_bytes": len(series.to_string())})
+
+    start = time.perf_counter()
+    numeric = NumericArray('float64')
+    numeric.extend(floats)
+    append_time = time.perf_counter() - start
+    start = time.perf_counter()
+    numeric.sum()
+    sum_time = time.perf_counter() - start
+    results.append({"value": "NumericArray",
+                    "values": values,
+                    "numpy": numpy != None,
+                    "memory_bytes": memory_size(numeric),
+                    "append_s": round(append_time, 4),
+                    "sum_s": round(sum_time, 4),
+                    "json_bytes": len(json.dumps(numeric.encode()))})
+    return results
+
+
+def benchmark_array(elements: int = 300000, operations: int = 100000,
+                    seed: int = 1) -> list:
+    """
+    Times an Array used as a queue (put at the end, remove from the front),
+    as a timeline edited in the middle, and to_string after one change.
+    """
+    rng = random.Random(seed)
+    timeline = Array()
+    for i in range(elements):
+        timeline.put(i)
+
+    start = time.perf_counter()
+    for i in range(operations):
+        timeline.remove(0)
+        timeline.put(i)
+    queue_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(operations):
+        index = rng.randrange(timeline.length())
+        timeline.insert(index, i)
+        timeline.remove(index)
+    middle_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timeline.to_string()
+    first_time = time.perf_counter() - start
+    timeline.set(elements // 2, 'changed')
+    start = time.perf_counter()
+    timeline.to_string()
+    changed_time = time.perf_counter() - start
+    return [{"elements": elements,
+             "operations": operations,
+             "queue_us_per_op": round(queue_time / operations * 1e6, 2),
+             "middle_us_per_op": round(middle_time / operations * 1e6, 2),
+             "to_string_s": round(first_time, 4),
+             "to_string_after_set_s": round(changed_time, 4)}]
+
+
+def benchmark_text_index(documents: int = 200000, words: int = 5000,
+                         seed: int = 1) -> list:
+    """
+    Builds a TextIndex over generated accounts and times a few queries.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['word' + str(i) for i in range(words)]
+    cities = ['San Diego', 'Los Angeles', 'San Francisco', 'New York']
+    database = BaseDB()
+    index = database.add_view('search', TextIndex(['name', 'address.city']))
+
+    start = time.perf_counter()
+    for i in range(documents):
+        account = Object().put('name', ' '.join(
+            rng.choice(vocabulary) for _ in range(3)))
+        account.put('address', Object().put('city', rng.choice(cities)))
+        database.put('account:' + str(i), account)
+    results = [{"documents": documents,
+                "build_s": round(time.perf_counter() - start, 3),
+                "index_bytes": index.memory_size()}]
+
+    for query in ['word17', 'word17 san', 'word17 OR word18', 'word12*',
+                  'san diego']:
+        start = time.perf_counter()
+        for _ in range(10):
+            matches = index.search(query)
+        results.append({"query": query,
+                        "matches": len(matches),
+                        "ms_per_query": round(
+                            (time.perf_counter() - start) / 10 * 1000, 3)})
+    return results
+
+
+def benchmark_verify(records: int = 500000, file: str = 'bench_commands.txt',
+                     workers_counts=(1, 2, 4)) -> list:
+    """
+    Times the checksum scan of a command file with each number of workers.
+    """
+    command_log = CommandLog(file)
+    command_log.reset([['PutCommand', 'Key' + str(i), i]
+                       for i in range(records)])
+    results = []
+    try:
+        for workers in workers_counts:
+            start = time.perf_counter()
+            command_log.verify(workers)
+            results.append({"workers": workers,
+                            "records": records,
+                            "bytes": os.path.getsize(file),
+                            "verify_s": round(time.perf_counter() - start, 3)})
+    finally:
+        os.remove(file)
+    return results
+
+
+def benchmark_recover(records: int = 10000000, keys: int = 100000,
+                      workers_counts=(1, 4), seed: int = 1,
+                      commands: str = 'bench_commands.txt',
+                      snapshot: str = 'bench_snapshot.txt') -> list:
+    """
+    Times PersistentDB.recover on a command file of puts and removes over
+    'keys' keys, with each number of workers.
+    Half of the puts store a document with a nested object and array.
+    """
+    rng = random.Random(seed)
+    with open(commands, 'wb') as commands_file:
+        batch = []
+        for i in range(records):
+            key = 'Key' + str(rng.randrange(keys))
+            if i % 10 == 0:
+                batch.append(CommandLog.frame(
+                    json.dumps(['RemoveCommand', key])))
+            elif i % 2 == 0:
+                document = {'name': 'User' + str(i), 'balance': i,
+                            'address': {'city': 'San Diego', 'zip': 92182},
+                            'phones': ['619-594-' + str(i % 10000),
+                                       '858-534-' + str(i % 10000)]}
+                batch.append(CommandLog.frame(
+                    json.dumps(['PutCommand', key, document])))
+            else:
+                batch.append(CommandLog.frame(
+                    json.dumps(['PutCommand', key, i])))
+            if len(batch) == 10000:
+                commands_file.write(b''.join(batch))
+                batch = []
+        commands_file.write(b''.join(batch))
+    Memento('{}', snapshot).save_state()
+
+    results = []
+    try:
+        for workers in workers_counts:
+            start = time.perf_counter()
+            PersistentDB.recover(commands, snapshot, workers=workers)
+            results.append({"workers": workers,
+                            "records": records,
+                            "bytes": os.path.getsize(commands),
+                            "recover_s": round(time.perf_counter() - start, 3)})
+    finally:
+        os.remove(commands)
+        os.remove(snapshot)
+    return results
+
+
+# operation mixes, after the YCSB core workloads
+WORKLOADS = {
+    'update-heavy': {'read': 0.5, 'update': 0.5},
+    'read-heavy': {'read': 0.95, 'update': 0.05},
+    'read-only': {'read': 1.0},
+    'read-latest': {'read': 0.95, 'insert': 0.05},
+    'scan': {'scan': 0.95, 'insert': 0.05},
+    'read-modify-write': {'read': 0.5, 'read-modify-write': 0.5},
+    'transactional': {'read': 0.5, 'transaction': 0.5},
+}
+
+
+class UniformGenerator():
+    def __init__(self, items: int, rng: random.Random) -> None:
+        self.items = items
+        self.__rng = rng
+
+    def grow(self, items: int) -> None:
+        self.items = items
+
+    def next(self) -> int:
+        return self.__rng.randrange(self.items)
+
+
+class ZipfianGenerator():
+    """
+    Zipfian item numbers, item 0 being the most popular, using the method
+    from Gray et al., "Quickly Generating Billion-Record Synthetic
+    Databases", as YCSB does. The item count can grow.
+    """
+
+    def __init__(self, items: int, rng: random.Random,
+                 theta: float = 0.99) -> None:
+        self.__rng = rng
+        self.__theta = theta
+        self.__alpha = 1 / (1 - theta)
+        self.__zeta2 = 1 + 0.5 ** theta
+        self.items = 0
+        self.__zetan = 0.0
+        self.grow(items)
+
+    def grow(self, items: int) -> None:
+        for i in range(self.items + 1, items + 1):
+            self.__zetan += 1 / i ** self.__theta
+        self.items = items
+        self.__eta = (1 - (2 / items) ** (1 - self.__theta)) / \
+            (1 - self.__zeta2 / self.__zetan)
+
+    def next(self) -> int:
+        u = self.__rng.random()
+        uz = u * self.__zetan
+        if uz < 1:
+            return 0
+        if uz < self.__zeta2:
+            return 1
+        item = int(self.items *
+                   (self.__eta * u - self.__eta + 1) ** self.__alpha)
+        return min(item, self.items - 1)
+
+
+class LatestGenerator():
+    """
+    Zipfian over how recently items were inserted, newest first.
+    """
+
+    def __init__(self, items: int, rng: random.Random) -> None:
+        self.__zipfian = ZipfianGenerator(items, rng)
+        self.items = items
+
+    def grow(self, items: int) -> None:
+        self.__zipfian.grow(items)
+        self.items = items
+
+    def next(self) -> int:
+        return self.items - 1 - self.__zipfian.next()
+
+
+DISTRIBUTIONS = {'uniform': UniformGenerator,
+                 'zipfian': ZipfianGenerator,
+                 'latest': LatestGenerator}
+
+
+def make_value(shape: str, rng: random.Random):
+    if shape == 'scalar':
+        return rng.randint(0, 1000000)
+    if shape == 'string':
+        return ''.join(rng.choice('abcdefghij') for _ in range(100))
+    if shape == 'object':
+        return make_document(rng)
+    raise ValueError("Unknown value shape " + shape)
+
+
+def copy_value(value):
+    """
+    Returns a copy of an Object from the value pool, so that no two keys
+    share one Object. Scalars and strings are returned as they are.
+    """
+    if type(value) == Object:
+        return Object.from_string(value.to_string())
+    return value
+
+
+def modify(value, rng: random.Random):
+    """
+    Returns the value changed, for read-modify-write operations.
+    """
+    if type(value) == Object:
+        value.put('balance', round(rng.uniform(0, 10000), 2))
+        return value
+    if type(value) == str:
+        return value[1:] + value[0]
+    return value + 1
+
+
+def peak_rss_kb() -> int:
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_workload(target: str = 'base', workload: str = 'update-heavy',
+                 distribution: str = 'zipfian', value_shape: str = 'scalar',
+                 records: int = 10000, operations: int = 100000,
+                 cursors: int = 0, observers: int = 0,
+                 scan_length: int = 10, transaction_size: int = 4,
+                 seed: int = 1) -> dict:
+    """
+    Loads 'records' keys into a BaseDB or PersistentDB target, then runs
+    'operations' operations of the workload's mix on keys picked from the
+    distribution. 'cursors' cursors, each with 'observers' observers, are
+    spread over the first keys.
+    Returns the configuration, load and run throughput, latency
+    percentiles per operation in microseconds, recover time for the
+    persistent target and peak RSS. Run throughput counts only the time
+    spent inside the timed operations, not copying the values they put.
+    """
+    rng = random.Random(seed)
+    mix = WORKLOADS[workload]
+    config = {"target": target, "workload": workload,
+              "distribution": distribution, "value_shape": value_shape,
+              "records": records, "operations": operations,
+              "cursors": cursors, "observers": observers,
+              "scan_length": scan_length,
+              "transaction_size": transaction_size, "seed": seed}
+
+    with tempfile.TemporaryDirectory() as directory:
+        commands = os.path.join(directory, 'commands.txt')
+        snapshot = os.path.join(directory, 'dbSnapshot.txt')
+        base = BaseDB()
+        if target == 'base':
+            database = base
+        elif target == 'persistent':
+            database = PersistentDB(base, commands, snapshot)
+        else:
+            raise ValueError("Unknown target " + target)
+
+        # a pool of values, so making values is not measured. Each key gets
+        # its own copy, made before the operation is timed.
+        values = [make_value(value_shape, rng) for _ in range(1000)]
+
+        loaded = [copy_value(values[i % len(values)]) for i in range(records)]
+        start = time.perf_counter()
+        for i in range(records):
+            database.put('user' + str(i), loaded[i])
+        load_seconds = time.perf_counter() - start
+        del loaded
+        if target == 'persistent':
+            database.snapshot()
+
+        for i in range(cursors):
+            cursor = database.get_cursor('user' + str(i % records))
+            for _ in range(observers):
+                cursor.add_observer(Observer())
+
+        keys = DISTRIBUTIONS[distribution](records, rng)
+        operation_names = list(mix)
+        weights = [mix[name] for name in operation_names]
+        chosen = rng.choices(operation_names, weights, k=operations)
+        histograms = {name: LatencyHistogram() for name in operation_names}
+        inserted = records
+
+        run_seconds = 0.0
+        for name in chosen:
+            if name == 'update':
+                value = copy_value(values[rng.randrange(len(values))])
+            elif name == 'insert':
+                value = copy_value(values[inserted % len(values)])
+            start = time.perf_counter()
+            if name == 'read':
+                database.get('user' + str(keys.next()))
+            elif name == 'update':
+                database.put('user' + str(keys.next()), value)
+            elif name == 'insert':
+                database.put('user' + str(inserted), value)
+                inserted += 1
+                keys.grow(inserted)
+            elif name == 'scan':
+                first = keys.next()
+                for i in range(first, min(first + scan_length, inserted)):
+                    database.get('user' + str(i))
+            elif name == 'read-modify-write':
+                key = 'user' + str(keys.next())
+                database.put(key, modify(database.get(key), rng))
+            elif name == 'transaction':
+                if target == 'persistent':
+                    transaction = database.transaction()
+                else:
+                    transaction = Transaction(database, commands)
+                for _ in range(transaction_size):
+                    key = 'user' + str(keys.next())
+                    transaction.put(key, modify(transaction.get(key), rng))
+                transaction.commit()
+            duration = time.perf_counter() - start
+            histograms[name].add(duration)
+            run_seconds += duration
+
+        recover_seconds = None
+        if target == 'persistent':
+            start = time.perf_counter()
+            PersistentDB.recover(commands, snapshot)
+            recover_seconds = time.perf_counter() - start
+
+    latency = dict()
+    for (name, histogram) in histograms.items():
+        if histogram.count:
+            latency[name] = {statistic: round(value * 1e6, 2)
+                             if statistic != "count" else value
+                             for (statistic, value)
+                             in histogram.summary().items()}
+    return {"config": config,
+            "environment": {"python": platform.python_version(),
+                            "platform": platform.platform()},
+            "load": {"seconds": round(load_seconds, 4),
+                     "ops_per_s": round(records / load_seconds, 1)},
+            "run": {"seconds": round(run_seconds, 4),
+                    "ops_per_s": round(operations / run_seconds, 1),
+                    "latency_us": latency},
+            "recover_seconds": None if recover_seconds == None
+            else round(recover_seconds, 4),
+            "peak_rss_kb": peak_rss_kb()}
+
+
+# p99 latencies are bucket bounds of a LatencyHistogram, which are a
+# quarter power of two apart, so a p99 may move by one bucket without
+# any real change
+BUCKET_GROWTH = 2 ** 0.25
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> list:
+    """
+    Compares two run_workload results.
+    Returns a description of every throughput drop, or mean latency or
+    recover time increase, larger than the threshold fraction, and of
+    every p99 latency increase larger than the threshold on top of one
+    histogram bucket.
+    """
+    regressions = list()
+    p99_threshold = (1 + threshold) * BUCKET_GROWTH - 1
+
+    def check(name: str, old, new, higher_is_better: bool,
+              allowed: float = threshold) -> None:
+        if old == None or new == None or old == 0:
+            return
+        change = (new - old) / old
+        if (higher_is_better and change < -allowed) or \
+                (not higher_is_better and change > allowed):
+            regressions.append(name + ": " + str(old) + " -> " + str(new) +
+                               " (" + format(change, '+.1%') + ")")
+
+    check("load ops_per_s", baseline["load"]["ops_per_s"],
+          current["load"]["ops_per_s"], True)
+    check("run ops_per_s", baseline["run"]["ops_per_s"],
+          current["run"]["ops_per_s"], True)
+    for (name, latency) in baseline["run"]["latency_us"].items():
+        if name in current["run"]["latency_us"]:
+            check(name + " mean_us", latency["mean"],
+                  current["run"]["latency_us"][name]["mean"], False)
+            check(name + " p99_us", latency["p99"],
+                  current["run"]["latency_us"][name]["p99"], False,
+                  p99_threshold)
+    check("recover_seconds", baseline["recover_seconds"],
+          current["recover_seconds"], False)
+    return regressions
+
+
+def main(arguments: list) -> int:
+    parser = argparse.ArgumentParser(description="Database benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("micro", help="run the micro benchmarks")
+
+    ycsb = commands.add_parser("ycsb", help="run a YCSB style workload")
+    ycsb.add_argument("--target", choices=["base", "persistent"],
+                      default="base")
+    ycsb.add_argument("--workload", choices=sorted(WORKLOADS),
+                      default="update-heavy")
+    ycsb.add_argument("--distribution", choices=sorted(DISTRIBUTIONS),
+                      default="zipfian")
+    ycsb.add_argument("--value-shape", choices=["scalar", "string", "object"],
+                      default="scalar")
+    ycsb.add_argument("--records", type=int, default=10000)
+    ycsb.add_argument("--operations", type=int, default=100000)
+    ycsb.add_argument("--cursors", type=int, default=0)
+    ycsb.add_argument("--observers", type=int, default=0)
+    ycsb.add_argument("--seed", type=int, default=1)
+    ycsb.add_argument("--output", help="write the result as json to a file")
+
+    comparison = commands.add_parser("compare",
+                                     help="compare two ycsb result files")
+    comparison.add_argument("baseline")
+    comparison.add_argument("current")
+    comparison.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(arguments)
+    if args.command == "micro":
+        for result in benchmark_codecs() + benchmark_validation() + \
+                benchmark_numeric() + benchmark_array() + \
+                benchmark_text_index() + \
+                benchmark_verify() + \
+                benchmark_recover():
+            print(json.dumps(result))
+    elif args.command == "ycsb":
+        result = run_workload(args.target, args.workload, args.distribution,
+                              args.value_shape, args.records, args.operations,
+                              args.cursors, args.observers, seed=args.seed)
+        print(json.dumps(result, indent=2))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(result, output_file, indent=2)
+    else:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print(regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
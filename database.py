@@ -1,4 +1,24 @@
+import base64
+import collections.abc
+import concurrent.futures
+import heapq
+import itertools
 import json
+import lzma
+import array
+import bisect
+import math
+import os
+import re
+import sys
+import time
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Validator():
@@ -6,10 +26,13 @@ class Validator():
         """
         Base validator which creates the chain of responsibility.
         """
+        self.__valid_types = dict()
         self.__number_validator = NumberValidator()
         self.__string_validator = StringValidator()
         self.__array_validator = ArrayValidator()
         self.__object_validator = ObjectValidator()
+        self.__numeric_array_validator = NumericArrayValidator()
+        self.__immutable_validator = ImmutableValidator()
         self.__invalid_type_validator = InvalidDataTypeValidator()
 
         self.__set_next_validator(self.__number_validator)
@@ -17,14 +40,25 @@ class Validator():
         self.__string_validator.set_next_validator(self.__array_validator)
         self.__array_validator .set_next_validator(self.__object_validator)
         self.__object_validator.set_next_validator(
+            self.__numeric_array_validator)
+        self.__numeric_array_validator.set_next_validator(
+            self.__immutable_validator)
+        self.__immutable_validator.set_next_validator(
             self.__invalid_type_validator)
 
     def is_valid(self, data) -> bool:
         """
         Each validator sends the data down the chain if it is invalid.
         The final validator should return false.
+        Validators only look at the type of the data, so the chain's answer
+        is remembered for each type.
         """
-        return self.__next_validator.is_valid(data)
+        data_type = type(data)
+        if data_type in self.__valid_types:
+            return self.__valid_types[data_type]
+        valid = self.__next_validator.is_valid(data)
+        self.__valid_types[data_type] = valid
+        return valid
 
     def __set_next_validator(self, next_validator: 'Validator') -> None:
         self.__next_validator = next_validator
@@ -44,6 +78,34 @@ class ObjectValidator(Validator):
             return self.__next_validator.is_valid(data)
 
 
+class NumericArrayValidator(Validator):
+    def __init__(self) -> None:
+        self.__next_validator = None
+
+    def set_next_validator(self, next_validator) -> None:
+        self.__next_validator = next_validator
+
+    def is_valid(self, data) -> bool:
+        if type(data) == NumericArray:
+            return True
+        else:
+            return self.__next_validator.is_valid(data)
+
+
+class ImmutableValidator(Validator):
+    def __init__(self) -> None:
+        self.__next_validator = None
+
+    def set_next_validator(self, next_validator) -> None:
+        self.__next_validator = next_validator
+
+    def is_valid(self, data) -> bool:
+        if type(data) == ImmutableObject or type(data) == ImmutableArray:
+            return True
+        else:
+            return self.__next_validator.is_valid(data)
+
+
 class ArrayValidator(Validator):
     def __init__(self) -> None:
         self.__next_validator = None
@@ -101,12 +163,408 @@ class InvalidDataTypeValidator(Validator):
         return False
 
 
+class Schema():
+    """
+    Describes the values allowed at a key, for keys starting with a prefix.
+    A spec is one of:
+        a type name: 'number', 'int', 'float', 'string', 'array', 'object',
+            'numeric' (a NumericArray, only at a key) or 'any'
+        a list holding one spec, for an Array whose elements all match it
+        a dictionary of field specs, for an Object
+        a Schema, for an Object with required fields
+    Object and Array specs also match ImmutableObjects and ImmutableArrays.
+    Specs are compiled once into validator functions, which raise TypeError
+    for invalid values. Once the whole value passes, check binds the field
+    and element validators to its Objects and Arrays so that later puts
+    into them are checked too, and unbind removes them again.
+    ImmutableObjects and ImmutableArrays are not changed: validators return
+    a bound copy of them, which is the value to store.
+    """
+    types = {'number': (int, float), 'int': (int,), 'float': (float,),
+             'string': (str,)}
+
+    def __init__(self, fields: dict, required: list = None) -> None:
+        self.fields = fields
+        self.required = required if required != None else []
+
+    @classmethod
+    def compile(cls, spec):
+        """
+        Returns the validator function for the spec.
+        """
+        if type(spec) == Schema:
+            return Schema.__compile_object(spec.fields, spec.required)
+        elif type(spec) == dict:
+            return Schema.__compile_object(spec, [])
+        elif type(spec) == list:
+            if len(spec) != 1:
+                raise ValueError("Array spec needs one element spec.")
+            return Schema.__compile_array(spec[0])
+        elif spec == 'any':
+            return lambda value, bindings: value
+        elif spec == 'array':
+            return Schema.__compile_array('any')
+        elif spec == 'object':
+            return Schema.__compile_object({}, [])
+        elif spec == 'numeric':
+            return Schema.__compile_type(spec, (NumericArray,))
+        elif spec in Schema.types:
+            return Schema.__compile_type(spec, Schema.types[spec])
+        raise ValueError("Unknown spec " + repr(spec))
+
+    @classmethod
+    def __compile_type(cls, name: str, types: tuple):
+        message = ' must be ' + name + '.'
+
+        def validate(value, bindings: list):
+            if type(value) not in types:
+                raise TypeError(message)
+            return value
+        return validate
+
+    @classmethod
+    def __compile_array(cls, element_spec):
+        validate_element = Schema.compile(element_spec)
+
+        def validate(value, bindings: list):
+            if type(value) != Array and type(value) != ImmutableArray:
+                raise TypeError(' must be array.')
+            mutable = type(value) == Array
+            # puts into a bound Array are already checked, it is only bound
+            # again in case the value it replaces shares it
+            if value.get_schema() is validate_element:
+                if mutable:
+                    bindings.append((value, (validate_element,)))
+                return value
+            replaced = list()
+            for index in range(value.length()):
+                element = value.get(index)
+                try:
+                    checked = validate_element(element, bindings)
+                except TypeError as e:
+                    raise Schema.error(e, '[' + str(index) + ']') from None
+                if checked is not element:
+                    replaced.append((index, checked))
+            if not mutable:
+                return value.bind(validate_element, replaced)
+            bindings.append((value, (validate_element,)))
+            return value
+        return validate
+
+    @classmethod
+    def __compile_object(cls, field_specs: dict, required: list):
+        fields = dict()
+        for (field, field_spec) in field_specs.items():
+            fields[field] = Schema.compile(field_spec)
+        required = frozenset(required)
+
+        def validate(value, bindings: list):
+            if type(value) != Object and type(value) != ImmutableObject:
+                raise TypeError(' must be object.')
+            mutable = type(value) == Object
+            # puts into a bound Object are already checked
+            if value.get_schema() is fields:
+                if mutable:
+                    bindings.append((value, (fields, required)))
+                return value
+            keys = value.keys()
+            missing = required.difference(keys)
+            if missing:
+                raise TypeError('.' + min(missing) + ' is required.')
+            replaced = list()
+            for field in keys:
+                validate_field = fields.get(field)
+                if validate_field != None:
+                    field_value = value.get(field)
+                    try:
+                        checked = validate_field(field_value, bindings)
+                    except TypeError as e:
+                        raise Schema.error(e, '.' + field) from None
+                    if checked is not field_value:
+                        replaced.append((field, checked))
+            if not mutable:
+                return value.bind(fields, required, replaced)
+            bindings.append((value, (fields, required)))
+            return value
+        return validate
+
+    @classmethod
+    def check(cls, validate, value):
+        """
+        Checks the value with a compiled validator, then binds the field and
+        element validators to its Objects and Arrays.
+        Nothing is bound if the value does not pass.
+        Returns the value to store, a bound copy if it is immutable.
+        """
+        bindings = list()
+        value = validate(value, bindings)
+        Schema.bind(bindings)
+        return value
+
+    @classmethod
+    def bind(cls, bindings: list) -> None:
+        for (value, schema) in bindings:
+            value.set_schema(*schema)
+
+    @classmethod
+    def unbind(cls, value):
+        """
+        Removes the validators bound to the Object or Array and to the
+        values nested in it, once it is no longer under its schema.
+        Returns the value, an unbound copy if it is immutable.
+        """
+        if type(value) == Object or type(value) == Array or \
+                type(value) == ImmutableObject or \
+                type(value) == ImmutableArray:
+            return value.unbind()
+        return value
+
+    @classmethod
+    def error(cls, error: TypeError, path: str) -> TypeError:
+        """
+        Adds the path of a field or element to the start of the error.
+        """
+        return TypeError(path + str(error))
+
+
+class LatencyHistogram():
+    """
+    Counts latencies in buckets that grow by a quarter power of two, so
+    each bucket is within 19% of the latencies in it, from nanoseconds
+    to hours, in a few hundred buckets.
+    """
+
+    def __init__(self) -> None:
+        self.__buckets = dict()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        nanoseconds = seconds * 1e9
+        bucket = int(math.log2(nanoseconds) * 4) if nanoseconds > 1 else 0
+        self.__buckets[bucket] = self.__buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the percentile,
+        in seconds.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / 4) / 1e9, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+
+class Metrics():
+    """
+    Latency histograms and counters for database operations and their
+    phases. Disabled by default: every instrumented call site only checks
+    'enabled' until it is turned on.
+    Hooks are called with (name, seconds) for every timed phase, which
+    can be used to feed a profiler or tracing system.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.__histograms = dict()
+        self.__counters = dict()
+        self.__hooks = list()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.__histograms = dict()
+        self.__counters = dict()
+
+    def record(self, name: str, start: float) -> None:
+        """
+        Records the time since start, a time.perf_counter() value.
+        """
+        seconds = time.perf_counter() - start
+        if not name in self.__histograms:
+            self.__histograms[name] = LatencyHistogram()
+        self.__histograms[name].add(seconds)
+        for hook in self.__hooks:
+            hook(name, seconds)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def add_hook(self, hook) -> None:
+        self.__hooks.append(hook)
+
+    def remove_hook(self, hook) -> None:
+        self.__hooks.remove(hook)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the latency summary of every phase and the counters.
+        Latencies are in seconds.
+        """
+        return {"latency": {name: histogram.summary() for (name, histogram)
+                            in self.__histograms.items()},
+                "counters": dict(self.__counters)}
+
+
+METRICS = Metrics()
+
+
+def memory_size(value) -> int:
+    """
+    Returns the approximate number of bytes used by the value, including
+    everything nested in it.
+    """
+    if type(value) == Array or type(value) == Object or \
+            type(value) == CompressedValue or type(value) == NumericArray or \
+            type(value) == ImmutableArray or type(value) == ImmutableObject:
+        return value.memory_size()
+    return sys.getsizeof(value)
+
+
+def value_json(value, encoded: bool = False) -> str:
+    """
+    Returns the json of a database value. Arrays and Objects keep their
+    json until they change, so unchanged values are not encoded again.
+    NumericArrays use their compact encoding if encoded is true.
+    """
+    if type(value) == Array or type(value) == Object or \
+            type(value) == CompressedValue or type(value) == ImmutableArray or \
+            type(value) == ImmutableObject:
+        return value.to_string()
+    elif type(value) == NumericArray:
+        if encoded:
+            return json.dumps(value.encode())
+        return value.to_string()
+    return json.dumps(value)
+
+
+def attach(value, parent) -> bool:
+    """
+    Records that the parent holds the value, if it is an Array, Object or
+    NumericArray. These call parent.invalidate() when they change, so that
+    the parent drops its cached json.
+    Returns whether the value was attached.
+    """
+    if type(value) == Array or type(value) == Object or \
+            type(value) == NumericArray:
+        value.add_parent(parent)
+        return True
+    return False
+
+
+def detach(value, parent) -> bool:
+    """
+    Undoes attach, once the parent no longer holds the value.
+    """
+    if type(value) == Array or type(value) == Object or \
+            type(value) == NumericArray:
+        value.remove_parent(parent)
+        return True
+    return False
+
+
+def add_weak(parents: dict, parent) -> None:
+    """
+    Counts one more hold of the parent in a dict of id -> [weakref, count],
+    as Arrays, Objects and NumericArrays keep their parents. Parents are
+    held weakly so that children do not keep a discarded parent alive, and
+    the entries of collected parents are dropped as the dict grows.
+    """
+    entry = parents.get(id(parent))
+    if entry != None and entry[0]() is parent:
+        entry[1] += 1
+        return
+    parents[id(parent)] = [weakref.ref(parent), 1]
+    size = len(parents)
+    if size >= 8 and size & (size - 1) == 0:
+        for (key, entry) in list(parents.items()):
+            if entry[0]() == None:
+                del parents[key]
+
+
+def remove_weak(parents: dict, parent) -> None:
+    """
+    Undoes add_weak. Raises KeyError if the parent is not held.
+    """
+    entry = parents[id(parent)]
+    if entry[0]() is not parent:
+        raise KeyError(parent)
+    if entry[1] == 1:
+        del parents[id(parent)]
+    else:
+        entry[1] -= 1
+
+
+def live(parents: dict) -> list:
+    """
+    Returns the parents in a dict filled by add_weak which still exist.
+    """
+    result = list()
+    for (reference, count) in list(parents.values()):
+        parent = reference()
+        if parent != None:
+            result.append(parent)
+    return result
+
+
+def thaw(value):
+    """
+    Returns a new Array or Object if the value is a CompressedValue,
+    otherwise the value itself.
+    """
+    if type(value) == CompressedValue:
+        return value.thaw()
+    return value
+
+
+def notify_all(observers: list, updated_value) -> None:
+    """
+    Calls update on every observer or cursor. If some raise, the rest are
+    still updated, then the first error is raised.
+    """
+    error = None
+    for observer in observers:
+        try:
+            observer.update(updated_value)
+        except Exception as e:
+            if error == None:
+                error = e
+    if error != None:
+        raise error
+
+
 class Database:
     """
     Database interface.
     """
 
-    def put(self, key: str, value) -> 'Database':
+    def put(self, key: str, value, ttl=None) -> 'Database':
+        """
+        Stores the value at the key.
+        If a ttl (in seconds) is given, the key expires after that long.
+        """
         pass
 
     def get(self, key: str, value_type=None):
@@ -132,50 +590,217 @@ class Database:
 
 
 class BaseDB(Database):
-    def __init__(self) -> None:
-        self.__data = dict()
+    def __init__(self, clock=time.time, expiry_resolution: float = 1.0,
+                 cold_codec: 'Codec' = None, immutable: bool = False) -> None:
+        """
+        If a cold codec is given, access times are tracked so that large
+        values which are not being used can be compressed in memory.
+        If immutable is true, the data is held in a persistent
+        OrderedHashMap and Objects and Arrays are stored as ImmutableObjects
+        and ImmutableArrays, so that version() is O(1). Keys and fields keep
+        their insertion order as they do in a dict.
+        """
+        self.__immutable = immutable
+        self.__data = VersionedDict() if immutable else dict()
         self.__validator = Validator()
         self.__cursors = dict()
+        self.__expiry = ExpirationWheel(clock, expiry_resolution)
+        self.__expiry_listeners = dict()
+        self.__cold_codec = cold_codec
+        self.__last_access = dict()
+        self.__schemas = dict()
+        self.__schema_prefixes = tuple()
+        self.__key_schemas = dict()
+        self.__views = dict()
+        # the json of the whole database, kept until something changes
+        self.__json = None
+        self.__encoded_json = None
+
+    def check(self, key: str, value):
+        """
+        Raises TypeError if put would reject the value, without storing or
+        binding anything. Returns the value put would store, a bound copy
+        if the database is immutable.
+        """
+        return self.__check(key, value, list())
 
-    def put(self, key: str, value) -> Database:
+    def __check(self, key: str, value, bindings: list):
+        """
+        Validates the value against the value types and the schema of the
+        key, collecting the schema bindings to make once it is stored.
+        """
         if type(key) != str:
             raise TypeError("Invalid Key.")
-        if self.__validator.is_valid(value):
-            self.__data[key] = value
+        if not self.__validator.is_valid(value):
+            raise TypeError("Invalid value type.")
+        if self.__immutable:
+            value = to_immutable(value)
+        if self.__schemas:
+            validate = self.__key_schemas.get(key, False)
+            if validate == False:
+                validate = self.__find_schema(key)
+            if validate != None:
+                try:
+                    value = validate(value, bindings)
+                except TypeError as e:
+                    raise Schema.error(e, key) from None
+        return value
+
+    def put(self, key: str, value, ttl=None) -> Database:
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
+        bindings = list()
+        value = self.__check(key, value, bindings)
+        if timed:
+            METRICS.record('put.validate', start)
+        self.expire()
+        if key in self.__data:
+            self.__release(self.__data[key], value)
+        self.__data[key] = value
+        if bindings:
+            Schema.bind(bindings)
+        attach(value, self)
+        if self.__cold_codec != None:
+            self.__last_access[key] = self.now()
+        if ttl == None:
+            self.__expiry.remove(key)
+        else:
+            self.__expiry.add(key, self.__expiry.now() + ttl)
+        if timed:
+            notify_start = time.perf_counter()
             self.__update(key, value)
+            METRICS.record('put.notify', notify_start)
+            METRICS.record('put', start)
+            METRICS.count('ops.put')
         else:
-            raise TypeError("Invalid value type.")
+            self.__update(key, value)
         return self
 
     def get(self, key: str, value_type=None):
+        if METRICS.enabled:
+            METRICS.count('ops.get')
+
+        # lazy expiry, the key may have expired since the last sweep
+        if self.__expiry.is_expired(key):
+            self.__expire_key(key)
+
         try:
             value = self.__data[key]
         except KeyError as e:
             raise e
 
+        if self.__cold_codec != None:
+            self.__last_access[key] = self.now()
+            if type(value) == CompressedValue:
+                value = self.__thaw(key, value)
+
         if value_type:
             if type(value) != value_type:
                 raise TypeError("Does not contain given type.")
 
         return value
 
+    def peek(self, key: str):
+        """
+        Returns the value stored at the key without reading it: a frozen
+        value is returned as its CompressedValue and is not thawed.
+        Commands use it to keep the old value for undo.
+        """
+        if self.__expiry.is_expired(key):
+            self.__expire_key(key)
+        return self.__data[key]
+
     def remove(self, key: str):
+        if METRICS.enabled:
+            METRICS.count('ops.remove')
+        self.expire()
         try:
             removed_value = self.__data.pop(key)
         except KeyError as e:
             raise e
 
+        self.__last_access.pop(key, None)
+        self.__release(removed_value)
+        removed_value = thaw(removed_value)
+        self.__expiry.remove(key)
         self.__update(key, None)
         return removed_value
 
     def get_json(self) -> str:
-        # if the value is an Array or Object, turn into dictionary or list.
-        for (key, value) in self.__data.items():
-            if type(value) == Array or type(value) == Object:
-                self.__data[key] = json.loads(value.to_string())
-        return json.dumps(self.__data)
+        return self.__to_json(False)
+
+    def encode_json(self) -> str:
+        """
+        Like get_json, but NumericArrays use their compact encoding so that
+        they are restored as NumericArrays. Used for snapshots.
+        """
+        return self.__to_json(True)
+
+    def __to_json(self, encoded: bool) -> str:
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
+        self.expire()
+        database_json = self.__encoded_json if encoded else self.__json
+        if database_json == None:
+            # the stored values are left as they are, and keep their json
+            database_json = '{' + ', '.join(
+                [json.dumps(key) + ': ' + value_json(value, encoded)
+                 for (key, value) in self.__data.items()]) + '}'
+            if encoded:
+                self.__encoded_json = database_json
+            else:
+                self.__json = database_json
+        if timed:
+            METRICS.record('get_json', start)
+        return database_json
+
+    def invalidate(self) -> None:
+        """
+        Drops the cached json, called when a stored value changes.
+        """
+        self.__json = None
+        self.__encoded_json = None
+
+    def version(self) -> 'DatabaseVersion':
+        """
+        Returns a read only view of the data as it is now, which later
+        changes do not affect. Needs an immutable database.
+        """
+        if not self.__immutable:
+            raise Exception("Versions need an immutable database.")
+        self.expire()
+        return DatabaseVersion(self.__data.version())
+
+    def export_iter(self):
+        """
+        Generates one json line per key, [key, value] or, for expiring keys,
+        [key, value, expiry time]. NumericArrays use their compact encoding.
+        Keys put or removed while the lines are generated may or may not be
+        included.
+        """
+        self.expire()
+        if self.__immutable:
+            data = self.__data.version()
+            keys = data
+        else:
+            data = self.__data
+            keys = list(data)
+        for key in keys:
+            value = data.get(key, BaseDB)
+            if value is BaseDB:
+                continue
+            encoded_value = value_json(value, True)
+            expire_at = self.__expiry.get(key)
+            if expire_at == None:
+                yield '[' + json.dumps(key) + ', ' + encoded_value + ']\n'
+            else:
+                yield '[' + json.dumps(key) + ', ' + encoded_value + ', ' + \
+                    json.dumps(expire_at) + ']\n'
 
     def get_cursor(self, key: str) -> 'Cursor':
+        self.expire()
         if key in self.__data:
             if not key in self.__cursors:
                 self.__cursors[key] = list()
@@ -185,14 +810,374 @@ class BaseDB(Database):
         else:
             raise KeyError("Key does not exist in database.")
 
+    def add_view(self, name: str, view: 'View') -> 'View':
+        """
+        Adds a materialized view, built from the current data once and then
+        kept up to date on every put, remove and expiry.
+        Returns the view.
+        """
+        if name in self.__views:
+            raise KeyError("View already exists.")
+        self.expire()
+        for (key, value) in self.__data.items():
+            # frozen values are read without thawing them for good
+            view.change(key, thaw(value))
+        self.__views[name] = view
+        return view
+
+    def get_view(self, name: str) -> 'View':
+        return self.__views[name]
+
+    def remove_view(self, name: str) -> 'View':
+        return self.__views.pop(name)
+
+    def memory_usage(self) -> dict:
+        """
+        Returns a dictionary of (key, approximate bytes used by the key and
+        its value).
+        """
+        return {key: sys.getsizeof(key) + memory_size(value)
+                for (key, value) in self.__data.items()}
+
+    def set_schema(self, prefix: str, spec) -> None:
+        """
+        Values put at keys starting with the prefix must match the spec,
+        see Schema. The longest matching prefix is used.
+        Values already stored under the prefix are checked now.
+        """
+        validate = Schema.compile(spec)
+        bindings = list()
+        replaced = list()
+        self.expire()
+        for (key, value) in self.__data.items():
+            if key.startswith(prefix):
+                # a frozen value is bound when it is thawed, see __thaw
+                value = thaw(value)
+                try:
+                    checked = validate(value, bindings)
+                except TypeError as e:
+                    raise Schema.error(e, key) from None
+                if checked is not value:
+                    replaced.append((key, checked))
+
+        # only bound once every value passed
+        Schema.bind(bindings)
+        for (key, checked) in replaced:
+            self.__data[key] = checked
+        self.__schemas[prefix] = validate
+        self.__schema_prefixes = tuple(sorted(self.__schemas, key=len,
+                                              reverse=True))
+        self.__key_schemas = dict()
+
+    def remove_schema(self, prefix: str) -> None:
+        """
+        Values under the prefix are no longer checked by its schema. They
+        are bound to the schema of a shorter prefix instead, if they match.
+        """
+        validate = self.__schemas[prefix]
+        keys = [key for key in self.__data if key.startswith(prefix) and
+                self.__find_schema(key) is validate]
+
+        del self.__schemas[prefix]
+        self.__schema_prefixes = tuple(sorted(self.__schemas, key=len,
+                                              reverse=True))
+        self.__key_schemas = dict()
+        for key in keys:
+            value = Schema.unbind(self.__data[key])
+            remaining = self.__find_schema(key)
+            if remaining != None:
+                try:
+                    value = Schema.check(remaining, value)
+                except TypeError:
+                    pass
+            self.__data[key] = value
+
+    def __thaw(self, key: str, value: 'CompressedValue'):
+        """
+        Stores and returns the thawed value of a frozen key, bound to the
+        schema of the key again.
+        """
+        value = value.thaw()
+        if self.__immutable:
+            value = to_immutable(value)
+        validate = self.__find_schema(key) if self.__schemas else None
+        if validate != None:
+            try:
+                value = Schema.check(validate, value)
+            except TypeError:
+                # stored before the schema, see remove_schema
+                pass
+        self.__data[key] = value
+        attach(value, self)
+        return value
+
+    def __release(self, value, replacement=None) -> None:
+        """
+        Called when a value leaves the database, or is replaced.
+        """
+        detach(value, self)
+        if value is not replacement:
+            Schema.unbind(value)
+
+    def __find_schema(self, key: str):
+        """
+        Returns the validator for the longest prefix of the key, or None.
+        The result is remembered per key.
+        """
+        validate = None
+        for prefix in self.__schema_prefixes:
+            if key.startswith(prefix):
+                validate = self.__schemas[prefix]
+                break
+
+        # removed keys are left behind, so start over once it grows too big
+        if len(self.__key_schemas) > 2 * len(self.__data) + 1024:
+            self.__key_schemas = dict()
+        self.__key_schemas[key] = validate
+        return validate
+
+    def freeze(self, key: str) -> None:
+        """
+        Compresses the Array or Object at the key with the cold codec.
+        It is decompressed again the next time it is read.
+
+        Thawing builds a new Array or Object. References to the value, or
+        to values nested in it, taken before it was frozen no longer belong
+        to the database: changing them does not change the database until
+        they are put again. Read the key again after a freeze.
+        """
+        if self.__cold_codec == None:
+            raise Exception("No cold codec.")
+
+        value = self.__data[key]
+        if type(value) == Array or type(value) == Object:
+            self.__release(value)
+            self.__data[key] = CompressedValue.of(value, self.__cold_codec)
+
+    def freeze_cold(self, idle: float) -> list:
+        """
+        Compresses every Array or Object which has not been read or written
+        in the last 'idle' seconds and is at least cold_codec.min_size long.
+        Returns the compressed keys.
+        As with freeze, references taken before are detached from the
+        database once their key is frozen.
+        """
+        if self.__cold_codec == None:
+            raise Exception("No cold codec.")
+
+        frozen_keys = list()
+        cutoff = self.now() - idle
+        for (key, value) in self.__data.items():
+            if type(value) != Array and type(value) != Object:
+                continue
+            if self.__last_access.get(key, cutoff) > cutoff:
+                continue
+            frozen_json = value.to_string()
+            if len(frozen_json) >= self.__cold_codec.min_size:
+                self.__release(value)
+                self.__data[key] = CompressedValue(self.__cold_codec,
+                                                   frozen_json)
+                frozen_keys.append(key)
+        return frozen_keys
+
+    def now(self) -> float:
+        """
+        Returns the current time of the clock used for expiry.
+        """
+        return self.__expiry.now()
+
+    def expire_at(self, key: str, timestamp) -> None:
+        """
+        Sets the absolute time at which the key expires.
+        A timestamp of None makes the key persistent again.
+        """
+        if not key in self.__data:
+            raise KeyError(key)
+        if timestamp == None:
+            self.__expiry.remove(key)
+        else:
+            self.__expiry.add(key, timestamp)
+            if self.__expiry.is_expired(key):
+                self.__expire_key(key)
+
+    def get_expiry(self, key: str):
+        """
+        Returns the absolute expiry time of the key, or None if it never expires.
+        """
+        return self.__expiry.get(key)
+
+    def get_expiries(self) -> dict:
+        """
+        Returns a dictionary of (key, expiry time) for every expiring key.
+        """
+        self.expire()
+        return self.__expiry.get_all()
+
+    def add_expiry_listener(self, listener, name=None) -> None:
+        """
+        The listener is called with (key, expiry time) when a key expires.
+        A listener added under the name of an earlier one replaces it.
+        """
+        self.__expiry_listeners[listener if name == None else name] = listener
+
+    def remove_expiry_listener(self, name) -> None:
+        """
+        Removes the listener added under the name, or the listener itself.
+        """
+        self.__expiry_listeners.pop(name, None)
+
+    def expire(self) -> list:
+        """
+        Removes every key whose expiry time has passed.
+        Returns the expired keys.
+        """
+        expired_keys = self.__expiry.pop_expired()
+        error = None
+        for key in expired_keys:
+            # a raising view or observer does not stop the other keys
+            try:
+                self.__expire_key(key)
+            except Exception as e:
+                if error == None:
+                    error = e
+        if error != None:
+            raise error
+        return expired_keys
+
+    def __expire_key(self, key) -> None:
+        timestamp = self.__expiry.get(key)
+        self.__expiry.remove(key)
+        if not key in self.__data:
+            return
+        self.__release(self.__data.pop(key))
+        self.__last_access.pop(key, None)
+        try:
+            self.__update(key, None)
+        finally:
+            for listener in list(self.__expiry_listeners.values()):
+                listener(key, timestamp)
+
     def __update(self, key, updated_value) -> None:
         """
-        Passes the new value to the cursor.
+        Passes the new value to the cursor and the views.
         New value is null if the item was removed.
+        If a view or observer raises, the others are still told, then the
+        first error is raised. The key is left out of a view that raised.
         """
+        self.invalidate()
+        error = None
+        for view in self.__views.values():
+            try:
+                view.change(key, updated_value)
+            except Exception as e:
+                if error == None:
+                    error = e
+                if updated_value != None:
+                    view.change(key, None)
         if key in self.__cursors:
-            for cursor in self.__cursors[key]:
-                cursor.update(updated_value)
+            if METRICS.enabled:
+                METRICS.count('notifications', len(self.__cursors[key]))
+            try:
+                notify_all(self.__cursors[key], updated_value)
+            except Exception as e:
+                if error == None:
+                    error = e
+        if error != None:
+            raise error
+
+
+class ExpirationWheel():
+    """
+    Tracks key expiry times in buckets of 'resolution' seconds.
+    Each bucket holds the keys that expire within it, and a heap holds one
+    entry per non-empty bucket, so adding or removing a key is O(1)
+    amortized and a sweep only visits buckets that are due.
+    The bucket now falls in is also kept as a heap of (timestamp, key),
+    built once when it becomes current, so its due keys are popped from
+    the front instead of checking the whole bucket on every sweep.
+    """
+
+    def __init__(self, clock=time.time, resolution: float = 1.0) -> None:
+        self.__clock = clock
+        self.__resolution = resolution
+        self.__expiry_times = dict()
+        self.__buckets = dict()
+        self.__ticks = list()
+        self.__current_tick = None
+        # entries of removed keys are skipped when they are popped
+        self.__current = list()
+
+    def now(self) -> float:
+        return self.__clock()
+
+    def add(self, key: str, timestamp) -> None:
+        self.remove(key)
+        tick = math.ceil(timestamp / self.__resolution)
+        if not tick in self.__buckets:
+            self.__buckets[tick] = set()
+            heapq.heappush(self.__ticks, tick)
+        self.__buckets[tick].add(key)
+        self.__expiry_times[key] = timestamp
+        if tick == self.__current_tick:
+            heapq.heappush(self.__current, (timestamp, key))
+            if len(self.__current) > 2 * len(self.__buckets[tick]) + 32:
+                self.__order_current(tick)
+
+    def remove(self, key: str) -> None:
+        timestamp = self.__expiry_times.pop(key, None)
+        if timestamp == None:
+            return
+        tick = math.ceil(timestamp / self.__resolution)
+        # the empty bucket stays in the heap until it is swept
+        if tick in self.__buckets:
+            self.__buckets[tick].discard(key)
+
+    def get(self, key: str):
+        return self.__expiry_times.get(key)
+
+    def get_all(self) -> dict:
+        return dict(self.__expiry_times)
+
+    def is_expired(self, key: str) -> bool:
+        timestamp = self.__expiry_times.get(key)
+        return timestamp != None and timestamp <= self.__clock()
+
+    def __order_current(self, tick: int) -> None:
+        """
+        Makes the bucket of the tick the current one, ordered by time.
+        """
+        self.__current_tick = tick
+        bucket = self.__buckets.get(tick, ())
+        self.__current = [(self.__expiry_times[key], key) for key in bucket]
+        heapq.heapify(self.__current)
+
+    def pop_expired(self) -> list:
+        """
+        Returns the keys whose expiry time is not after now, the same keys
+        is_expired reports. Buckets that ended are taken whole, and the
+        due keys of the bucket now falls in are popped in time order.
+        The keys stay tracked until they are removed.
+        """
+        if not self.__ticks:
+            return []
+        now = self.__clock()
+        ended_tick = math.floor(now / self.__resolution)
+        expired_keys = list()
+        while self.__ticks and self.__ticks[0] <= ended_tick:
+            tick = heapq.heappop(self.__ticks)
+            expired_keys.extend(self.__buckets.pop(tick))
+        tick = math.ceil(now / self.__resolution)
+        if tick != self.__current_tick:
+            self.__order_current(tick)
+        current = self.__current
+        bucket = self.__buckets.get(tick)
+        while current and current[0][0] <= now:
+            (timestamp, key) = heapq.heappop(current)
+            if bucket != None and key in bucket and \
+                    self.__expiry_times.get(key) == timestamp:
+                bucket.discard(key)
+                expired_keys.append(key)
+        return expired_keys
 
 
 class PersistentDB(Database):
@@ -201,15 +1186,35 @@ class PersistentDB(Database):
     Also handles snapshotting and restoring the database.
     """
 
-    def __init__(self, database=BaseDB(), command_file='commands.txt',
-                 snapshot_file='dbSnapshot.txt') -> None:
-        self.__command_file = command_file
+    def __init__(self, database=None, command_file='commands.txt',
+                 snapshot_file='dbSnapshot.txt', codec=None,
+                 sync: bool = False) -> None:
+        """
+        Wraps the given BaseDB, or a new one.
+        If a codec is given, large command records and the snapshot are
+        compressed with it.
+        If sync is true, every command record is flushed to disk with fsync.
+        """
+        self.__command_file = CommandLog(command_file, codec, sync)
         self.__snapshot_file = snapshot_file
-        self.__decorated_database = database
-
-    def put(self, key: str, value) -> Database:
+        self.__codec = codec
+        self.__decorated_database = database if database != None else BaseDB()
+
+        # one listener per command file, so wrapping the same database
+        # again does not log every expiry twice. It only holds the wrapper
+        # weakly, so a discarded wrapper stops logging.
+        log_expiry = weakref.WeakMethod(self.__log_expiry)
+
+        def listener(key: str, timestamp) -> None:
+            method = log_expiry()
+            if method != None:
+                method(key, timestamp)
+        self.__decorated_database.add_expiry_listener(
+            listener, ('command file', os.path.abspath(command_file)))
+
+    def put(self, key: str, value, ttl=None) -> Database:
         command = PutCommand(self.__command_file, self.__decorated_database,
-                             key, value)
+                             key, value, ttl)
         command.execute()
         return self
 
@@ -232,61 +1237,172 @@ class PersistentDB(Database):
         Stores a snapshot of the current database in the snapshot file.
         Uses the default files if none are provided.
         """
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
         if commands == None:
             commands = self.__command_file
         if snapshot == None:
             snapshot = self.__snapshot_file
+        command_log = CommandLog.of(commands, self.__codec)
 
-        database_json = self.__decorated_database.get_json()
-        memento = Memento(database_json, snapshot)
+        # the snapshot is written a line at a time, see export_iter
+        memento = Memento(self.__decorated_database.export_iter(), snapshot,
+                          self.__codec)
         memento.save_state()
 
-        # clear command file after snapshotting
-        open(commands, 'w').close()
+        # clear command file after snapshotting.
+        # if we crash before this, replaying the old log onto the new
+        # snapshot gives the same data.
+        command_log.clear()
+        if timed:
+            METRICS.record('snapshot', start)
+
+    def version(self) -> 'DatabaseVersion':
+        return self.__decorated_database.version()
 
     @classmethod
-    def recover(cls, commands=None, snapshot=None) -> 'PersistentDB':
+    def recover(cls, commands=None, snapshot=None, codec=None,
+                strict: bool = False, workers=None,
+                database: BaseDB = None) -> 'PersistentDB':
         """
         Restore the database through the command and snapshot files.
         Gets the most recent snapshot of the database from the snapshot file.
         Then, run all the commands in order from the command file.
+        The codec must be the one the files were written with, if any.
+        The data is loaded into the given empty BaseDB, or a new one.
+        Views added to it beforehand, such as a TextIndex, are built as the
+        data is loaded.
+
+        Large command files are checksummed and parsed by 'workers'
+        processes. Recovery stops at the first torn or corrupt record and
+        the log is cut there, or raises ValueError if strict is true.
         Returns a persistent database.
         """
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
         if commands == None:
             commands = 'commands.txt'
         if snapshot == None:
             snapshot = 'dbSnapshot.txt'
 
-        recovered_database = BaseDB()
-        with open(snapshot) as snapshot_file:
-            dictionary = json.load(snapshot_file)
-        for data in dictionary.items():
-            # data is (key, value) pair.
-            if type(data[1]) == dict:
-                new_obj = Object.from_string(json.dumps(data[1]))
-                recovered_database.put(data[0], new_obj)
-            elif type(data[1]) == list:
-                new_array = Array.from_string(json.dumps(data[1]))
-                recovered_database.put(data[0], new_array)
-            else:
-                recovered_database.put(data[0], data[1])
+        recovered_database = database if database != None else BaseDB()
+        lines = Memento.load_lines(snapshot, codec)
+        first = next(lines, b'')
+        if first.startswith(b'{'):
+            # older snapshots are one json dictionary
+            dictionary = json.loads(b''.join([first] + list(lines)))
+            for data in dictionary.items():
+                # data is (key, value) pair.
+                recovered_database.put(data[0], from_json_value(data[1]))
+        else:
+            PersistentDB.__put_lines(recovered_database, [first], lines)
+
+        command_log = CommandLog(commands, codec)
+        (key_states, valid_length) = command_log.replay(
+            workers, recovered_database.now())
+        if valid_length < os.path.getsize(commands):
+            if strict:
+                raise ValueError("Corrupt record at byte " +
+                                 str(valid_length) + " of " + commands)
+            command_log.truncate(valid_length)
+
+        # only the final state of each key is applied.
+        # keys whose expiry time has passed are removed as they are applied.
+        for (key, state) in key_states.items():
+            state.apply(recovered_database, key)
+        if timed:
+            METRICS.record('recover', start)
+
+        return PersistentDB(recovered_database, commands, snapshot, codec)
+
+    def export_iter(self):
+        """
+        Generates the database as json lines, see BaseDB.export_iter.
+        """
+        return self.__decorated_database.export_iter()
 
-        # each line is a list containing command type, key, value, old value.
-        with open(commands) as command_file:
-            for line in command_file:
-                command_vars = json.loads(line)
-                command_name = command_vars.pop(0)
-                command_type = globals()[command_name]
+    def import_stream(self, stream, batch_size: int = 10000) -> int:
+        """
+        Puts the keys from a stream of json lines in the format of
+        export_iter, such as an open file, into the database.
+        The keys are not logged one by one, instead a snapshot is taken
+        once they are all in, so a crash during the import loses it.
+        If a line is invalid, the keys put before it are kept and the
+        snapshot is still taken, so that recover returns the same data.
+        Returns the number of keys imported.
+        """
+        try:
+            return PersistentDB.__put_lines(self.__decorated_database, [],
+                                            stream, batch_size)
+        finally:
+            self.snapshot()
 
-                recovered_command = command_type(commands, recovered_database,
-                                                 *command_vars)
-                recovered_command.execute(logging=False)
+    @classmethod
+    def __put_lines(cls, database: BaseDB, first_lines: list, lines,
+                    batch_size: int = 10000) -> int:
+        """
+        Puts each json line into the database, parsing them in batches.
+        Returns the number of lines put.
+        """
+        count = 0
+        batch = list()
+        for line_list in (first_lines, lines):
+            for line in line_list:
+                if type(line) == str:
+                    line = line.encode()
+                line = line.strip()
+                if line:
+                    batch.append(line)
+                if len(batch) >= batch_size:
+                    PersistentDB.__put_records(database, batch, count)
+                    count += len(batch)
+                    batch = list()
+        PersistentDB.__put_records(database, batch, count)
+        return count + len(batch)
 
-        return PersistentDB(recovered_database)
+    @classmethod
+    def __put_records(cls, database: BaseDB, batch: list,
+                      count: int) -> None:
+        try:
+            records = json.loads(b'[' + b','.join(batch) + b']')
+        except ValueError:
+            # find the bad line to report it
+            for (i, line) in enumerate(batch):
+                try:
+                    json.loads(line)
+                except ValueError:
+                    raise ValueError("Invalid json on line " +
+                                     str(count + i + 1)) from None
+        for (i, record) in enumerate(records):
+            if type(record) != list or len(record) < 2 or len(record) > 3:
+                raise ValueError("Invalid record on line " +
+                                 str(count + i + 1))
+            database.put(record[0], from_json_value(record[1]))
+            if len(record) == 3:
+                database.expire_at(record[0], record[2])
 
     def get_cursor(self, key: str) -> 'Cursor':
         return self.__decorated_database.get_cursor(key)
 
+    def add_view(self, name: str, view: 'View') -> 'View':
+        return self.__decorated_database.add_view(name, view)
+
+    def get_view(self, name: str) -> 'View':
+        return self.__decorated_database.get_view(name)
+
+    def set_schema(self, prefix: str, spec) -> None:
+        self.__decorated_database.set_schema(prefix, spec)
+
+    def __log_expiry(self, key: str, timestamp) -> None:
+        """
+        Records that the key expired so it is not restored by recover.
+        """
+        command = ExpireCommand(self.__command_file,
+                                self.__decorated_database, key, timestamp)
+        command.log()
+
 
 class Command():
     def __init__(self, command_file: str, database: BaseDB,
@@ -305,22 +1421,38 @@ class Command():
 
 class PutCommand(Command):
     def __init__(self, command_file: str, database: BaseDB,
-                 key: str, value) -> None:
+                 key: str, value, ttl=None) -> None:
         self.__command_file = command_file
         self.__database = database
         self.__key = key
         self.__value = value
+        self.__ttl = ttl
+        self.__expire_at = None
 
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
         # for 'undo' purposes, stores the old value at the given key if one existed.
+        # a frozen value is kept frozen, so writing the key does not thaw it.
         try:
-            self.__old_value = self.__database.get(key)
+            self.__old_value = self.__database.peek(key)
         except KeyError:
             self.__old_value = None
+        self.__old_expire_at = self.__database.get_expiry(key)
+        if timed:
+            METRICS.record('command.old_value', start)
 
     def execute(self, logging: bool = True):
+        if self.__ttl != None:
+            self.__expire_at = self.__database.now() + self.__ttl
         if logging:
+            # a value the database rejects must not reach the log
+            self.__value = self.__database.check(self.__key, self.__value)
             self.__log()
-        return self.__database.put(self.__key, self.__value)
+        self.__database.put(self.__key, self.__value)
+        if self.__expire_at != None:
+            self.__database.expire_at(self.__key, self.__expire_at)
+        return self.__database
 
     def undo(self) -> None:
         """
@@ -329,28 +1461,25 @@ class PutCommand(Command):
         """
         if self.__old_value:
             undo_command = PutCommand(self.__command_file,
-                                      self.__database, self.__key, self.__old_value)
+                                      self.__database, self.__key,
+                                      thaw(self.__old_value))
+            undo_command.__expire_at = self.__old_expire_at
         else:
             undo_command = RemoveCommand(self.__command_file,
                                          self.__database, self.__key)
         undo_command.execute()
 
     def __log(self) -> None:
-        value = self.__value
-        old_value = self.__old_value
-        if type(self.__value) == Array or type(self.__value) == Object:
-            value = self.__value.to_string()
-        if type(self.__old_value) == Array or type(self.__old_value) == Object:
-            old_value = self.__old_value.to_string()
-
-        command_list = ['PutCommand', self.__key, value]
+        # the record is built from the value's json, which may be cached
+        record = '["PutCommand", ' + json.dumps(self.__key) + ', ' + \
+            value_json(self.__value, True)
 
-        # if the key had a previous value, record the old value
-        if self.__old_value:
-            command_list.append(old_value)
+        # the old value is not needed for replay, so its slot is left null.
+        # older logs may hold an old value there.
+        if self.__expire_at != None:
+            record += ', null, ' + json.dumps(self.__expire_at)
 
-        with open(self.__command_file, 'a') as commands_file:
-            commands_file.write(json.dumps(command_list) + '\n')
+        CommandLog.of(self.__command_file).append_record(record + ']')
 
 
 class RemoveCommand(Command):
@@ -362,7 +1491,7 @@ class RemoveCommand(Command):
 
         # in order to 'undo', stores the old value at the given key if one existed.
         try:
-            self.__old_value = self.__database.get(key)
+            self.__old_value = self.__database.peek(key)
         except Exception:
             self.__old_value = None
 
@@ -376,21 +1505,47 @@ class RemoveCommand(Command):
         Undo a remove by putting the old value back.
         """
         undo_command = PutCommand(
-            self.__command_file, self.__database, self.__key, self.__old_value)
+            self.__command_file, self.__database, self.__key,
+            thaw(self.__old_value))
         undo_command.execute()
 
     def __log(self) -> None:
-        old_value = self.__old_value
-        if type(self.__old_value) == Array or type(self.__old_value) == Object:
-            old_value = self.__old_value.to_string()
         command_list = ['RemoveCommand',  str(self.__key)]
+        CommandLog.of(self.__command_file).append(command_list)
 
-        # if the key had a previous value, record the old value
-        if self.__old_value:
-            command_list.append(old_value)
 
-        with open(self.__command_file, 'a') as commands_file:
-            commands_file.write(json.dumps(command_list) + '\n')
+class ExpireCommand(Command):
+    """
+    Sets the time at which a key expires.
+    Logged when a key expires, so recover does not bring the key back.
+    """
+
+    def __init__(self, command_file: str, database: BaseDB,
+                 key: str, timestamp) -> None:
+        self.__command_file = command_file
+        self.__database = database
+        self.__key = key
+        self.__timestamp = timestamp
+        self.__old_timestamp = self.__database.get_expiry(key)
+
+    def execute(self, logging: bool = True):
+        if logging:
+            self.log()
+        # the key may have already been removed or expired
+        try:
+            self.__database.expire_at(self.__key, self.__timestamp)
+        except KeyError:
+            pass
+
+    def undo(self) -> None:
+        try:
+            self.__database.expire_at(self.__key, self.__old_timestamp)
+        except KeyError:
+            pass
+
+    def log(self) -> None:
+        command_list = ['ExpireCommand', self.__key, self.__timestamp]
+        CommandLog.of(self.__command_file).append(command_list)
 
 
 class Transaction():
@@ -404,11 +1559,12 @@ class Transaction():
         self.__commands = []
         self.__is_active = True
 
-    def put(self, key: str, value) -> Database:
+    def put(self, key: str, value, ttl=None) -> Database:
         if not self.__is_active:
             raise Exception("Inactive Transaction")
 
-        command = PutCommand(self.__command_file, self.__database, key, value)
+        command = PutCommand(self.__command_file, self.__database, key, value,
+                             ttl)
         self.__commands.append(command)
         return command.execute()
 
@@ -442,24 +1598,964 @@ class Transaction():
         self.__is_active = False
 
 
+def from_json_value(data):
+    """
+    Turns a decoded json value into a database value, without encoding it
+    again. Dictionaries become Objects and lists become Arrays, encoded
+    NumericArrays become NumericArrays.
+    """
+    if NumericArray.is_encoded(data):
+        return NumericArray.decode(data)
+    if type(data) == dict:
+        return Object.from_dict(data)
+    elif type(data) == list:
+        return Array.from_list(data)
+    return data
+
+
 class Memento():
-    def __init__(self, state, file) -> None:
+    chunk_size = 1 << 20
+
+    def __init__(self, state, file, codec=None) -> None:
+        """
+        The state is a string, or an iterable of strings which are written
+        one after another without being joined in memory.
+        """
         self.__state = state
         self.__file = file
+        self.__codec = codec
 
     def save_state(self) -> None:
-        with open(self.__file, 'w') as f:
-            f.write(self.__state)
+        """
+        The old state is only replaced once the new state is on disk.
+        """
+        chunks = self.__chunks()
+        if self.__codec != None:
+            # the whole snapshot is compressed, behind the codec's tag
+            tag = self.__codec.tag.encode() + b':'
+            chunks = Memento.__prefixed(tag,
+                                        self.__codec.compress_chunks(chunks))
+        atomic_write(self.__file, chunks)
+
+    def __chunks(self):
+        if type(self.__state) == str:
+            yield self.__state.encode()
+            return
+        # join the strings into chunks of about chunk_size bytes
+        batch = list()
+        batch_size = 0
+        for part in self.__state:
+            batch.append(part)
+            batch_size += len(part)
+            if batch_size >= Memento.chunk_size:
+                yield ''.join(batch).encode()
+                batch = list()
+                batch_size = 0
+        yield ''.join(batch).encode()
+
+    @classmethod
+    def __prefixed(cls, prefix: bytes, chunks):
+        yield prefix
+        yield from chunks
+
+    @classmethod
+    def load_state(cls, file, codec=None) -> str:
+        """
+        Returns the state stored in the file, decompressing it if needed.
+        """
+        return b''.join(Memento.load_chunks(file, codec)).decode()
+
+    @classmethod
+    def load_chunks(cls, file, codec=None):
+        """
+        Generates the state stored in the file as byte chunks,
+        decompressing it if needed.
+        """
+        with open(file, 'rb') as f:
+            chunks = iter(lambda: f.read(Memento.chunk_size), b'')
+            first = next(chunks, b'')
+            tag = codec.tag.encode() + b':' if codec != None else None
+            if tag != None and first.startswith(tag):
+                chunks = codec.decompress_chunks(
+                    Memento.__prefixed(first[len(tag):], chunks))
+            else:
+                chunks = Memento.__prefixed(first, chunks)
+            yield from chunks
+
+    @classmethod
+    def load_lines(cls, file, codec=None):
+        """
+        Generates the lines of the state stored in the file, as bytes.
+        """
+        # parts of a line which spans several chunks
+        parts = list()
+        for chunk in Memento.load_chunks(file, codec):
+            lines = chunk.split(b'\n')
+            if len(lines) == 1:
+                parts.append(chunk)
+                continue
+            parts.append(lines[0])
+            yield b''.join(parts)
+            yield from lines[1:-1]
+            parts = [lines[-1]]
+        last = b''.join(parts)
+        if last:
+            yield last
+
+
+class CompressedValue():
+    """
+    An Array or Object held in memory as compressed json.
+    Thawing it gives a new Array or Object, not the one that was frozen.
+    """
+
+    def __init__(self, codec: 'Codec', value_json: str) -> None:
+        self.__codec = codec
+        self.__data = codec.compress(value_json.encode())
+
+    @classmethod
+    def of(cls, value, codec: 'Codec') -> 'CompressedValue':
+        return CompressedValue(codec, value.to_string())
+
+    def to_string(self) -> str:
+        return self.__codec.decompress(self.__data).decode()
+
+    def thaw(self):
+        """
+        Returns the value as a new Array or Object.
+        """
+        return from_json_value(json.loads(self.to_string()))
+
+    def size(self) -> int:
+        return len(self.__data)
+
+    def memory_size(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.__data)
+
+
+class Codec():
+    """
+    Compresses records for the command file, snapshots and cold values.
+    Records smaller than min_size are not worth compressing.
+    """
+    tag = ''
+
+    def __init__(self, min_size: int = 256) -> None:
+        self.min_size = min_size
+
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+    def compress_chunks(self, chunks):
+        """
+        Generates the compressed form of the data given as an iterable of
+        byte chunks. Codecs which cannot stream compress it all at once.
+        """
+        yield self.compress(b''.join(chunks))
+
+    def decompress_chunks(self, chunks):
+        yield self.decompress(b''.join(chunks))
+
+
+class ZlibCodec(Codec):
+    """
+    Deflate compression, optionally primed with a trained dictionary.
+    The same dictionary must be used to read the data back.
+    """
+    tag = 'z'
+
+    def __init__(self, level: int = 6, dictionary: bytes = None,
+                 min_size: int = 256) -> None:
+        super().__init__(min_size)
+        self.__level = level
+        self.__dictionary = dictionary
+
+    def compress(self, data: bytes) -> bytes:
+        if self.__dictionary == None:
+            return zlib.compress(data, self.__level)
+        compressor = zlib.compressobj(self.__level, zdict=self.__dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.__dictionary == None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=self.__dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def compress_chunks(self, chunks):
+        if self.__dictionary == None:
+            compressor = zlib.compressobj(self.__level)
+        else:
+            compressor = zlib.compressobj(self.__level,
+                                          zdict=self.__dictionary)
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+
+    def decompress_chunks(self, chunks):
+        if self.__dictionary == None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=self.__dictionary)
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+    @classmethod
+    def train_dictionary(cls, samples: list, size: int = 32768) -> bytes:
+        """
+        Builds a dictionary from sample documents (strings, Arrays or
+        Objects) out of the json fragments that occur most often.
+        The most common fragments go last, where deflate reaches them with
+        the shortest distances.
+        """
+        counts = dict()
+        for sample in samples:
+            if type(sample) == Array or type(sample) == Object:
+                sample = sample.to_string()
+            # split after each separator so keys keep their quotes and colon
+            for fragment in re.findall(r'[^,:{}\[\]]*[,:{}\[\]]', sample):
+                counts[fragment] = counts.get(fragment, 0) + 1
+
+        # fragments seen once are document specific
+        common = [fragment for fragment in counts if counts[fragment] > 1]
+        common.sort(key=lambda fragment: counts[fragment] * len(fragment))
+        dictionary = b''
+        for fragment in reversed(common):
+            encoded = fragment.encode()
+            if len(dictionary) + len(encoded) > size:
+                break
+            dictionary = encoded + dictionary
+        return dictionary
+
+
+class LzmaCodec(Codec):
+    """
+    LZMA compression, slower than zlib but gives smaller records.
+    """
+    tag = 'x'
+
+    def __init__(self, preset: int = 6, min_size: int = 256) -> None:
+        super().__init__(min_size)
+        # raw streams skip the xz container headers, which dominate small records
+        self.__filters = [{"id": lzma.FILTER_LZMA2, "preset": preset}]
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_RAW,
+                             filters=self.__filters)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW,
+                               filters=self.__filters)
+
+    def compress_chunks(self, chunks):
+        compressor = lzma.LZMACompressor(format=lzma.FORMAT_RAW,
+                                         filters=self.__filters)
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+
+    def decompress_chunks(self, chunks):
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW,
+                                             filters=self.__filters)
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+
+
+def atomic_write(file: str, data) -> None:
+    """
+    Writes the data (bytes, or an iterable of byte chunks) to a temporary
+    file, syncs it and renames it over the file, so a crash leaves either
+    the old or the new contents.
+    """
+    temp_file = file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        if type(data) == bytes:
+            f.write(data)
+        else:
+            for chunk in data:
+                f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, file)
+
+    # sync the directory so the rename itself survives a crash
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(os.path.abspath(file)),
+                            os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        if METRICS.enabled:
+            METRICS.count('fsyncs')
+    if METRICS.enabled:
+        METRICS.count('fsyncs')
+
+
+class KeyState():
+    """
+    The combined effect of the logged commands on one key during replay.
+    kind is 'put', 'remove' or 'expire' (an expiry time for a value set
+    before these commands). removed is true if the key was removed before
+    the final put, so that it moves to the end like it did originally.
+    """
+
+    def __init__(self, kind: str, value=None, expire_at=None,
+                 removed: bool = False) -> None:
+        self.kind = kind
+        self.value = value
+        self.expire_at = expire_at
+        self.removed = removed
+
+    @classmethod
+    def of_record(cls, command_vars: list, now=None) -> tuple:
+        """
+        Returns the key and state of a logged command.
+        An expiry whose time is not after now is a remove, so that a key
+        which expired and was put again moves to the end as it did.
+        """
+        command_name = command_vars[0]
+        if command_name == 'PutCommand':
+            # older logs hold the old value in the fourth slot
+            expire_at = command_vars[4] if len(command_vars) > 4 else None
+            return (command_vars[1],
+                    KeyState('put', command_vars[2], expire_at))
+        elif command_name == 'RemoveCommand':
+            return (command_vars[1], KeyState('remove'))
+        elif command_name == 'ExpireCommand':
+            if now != None and command_vars[2] <= now:
+                return (command_vars[1], KeyState('remove'))
+            return (command_vars[1], KeyState('expire', None, command_vars[2]))
+        raise ValueError("Unknown command " + str(command_name))
+
+    def then(self, later: 'KeyState') -> 'KeyState':
+        """
+        Returns the state after this state followed by the later state.
+        """
+        if later.kind == 'put':
+            removed = later.removed or self.kind == 'remove' or self.removed
+            return KeyState('put', later.value, later.expire_at, removed)
+        if later.kind == 'expire':
+            if self.kind == 'put':
+                return KeyState('put', self.value, later.expire_at,
+                                self.removed)
+            if self.kind == 'remove':
+                return self
+        return later
+
+    def apply(self, database: BaseDB, key: str) -> None:
+        if self.kind == 'put':
+            if self.removed:
+                try:
+                    database.remove(key)
+                except KeyError:
+                    pass
+            database.put(key, from_json_value(self.value))
+            if self.expire_at != None:
+                database.expire_at(key, self.expire_at)
+        elif self.kind == 'remove':
+            try:
+                database.remove(key)
+            except KeyError:
+                pass
+        else:
+            try:
+                database.expire_at(key, self.expire_at)
+            except KeyError:
+                pass
+
+
+def merge_key_state(key_states: dict, key: str, later: KeyState) -> None:
+    """
+    Adds the later state of the key to key_states.
+    A key that was removed and put again moves to the end.
+    """
+    state = key_states.get(key)
+    if state == None:
+        key_states[key] = later
+        return
+    # the key is only put back at the end if it was removed in between
+    if later.kind == 'put' and (later.removed or state.kind == 'remove'):
+        del key_states[key]
+    key_states[key] = state.then(later)
+
+
+def merge_key_states(key_states: dict, later_states: dict) -> dict:
+    """
+    Adds the later states to key_states, in order.
+    """
+    for (key, later) in later_states.items():
+        merge_key_state(key_states, key, later)
+    return key_states
+
+
+def replay_log_range(file: str, start: int, end: int, codec=None,
+                     now=None) -> tuple:
+    """
+    Checks and parses the records between the byte offsets start and end.
+    Returns the final state of each key and the offset of the first
+    invalid record, or None. Expiries up to now count as removes.
+    """
+    with open(file, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+
+    # collect the json of each valid record
+    records = list()
+    invalid_offset = None
+    offset = start
+    last = len(lines) - 1
+    for (i, line) in enumerate(lines):
+        if i == last and len(line) == 0:
+            break
+        if not CommandLog.is_valid_record(line, i < last):
+            invalid_offset = offset
+            break
+        size = len(line) + 1
+
+        if CommandLog.frame_header.match(line) != None:
+            line = line[CommandLog.header_size:]
+        if not line.startswith(b'['):
+            # a record that does not decode is treated as corrupt
+            try:
+                line = json.dumps(CommandLog(file, codec).decode(
+                    line.decode())).encode()
+            except (ValueError, zlib.error, lzma.LZMAError):
+                invalid_offset = offset
+                break
+        offset += size
+        records.append(line)
+
+    # parse the records in batches, one json array per batch
+    key_states = dict()
+    for batch_start in range(0, len(records), 10000):
+        batch = records[batch_start:batch_start + 10000]
+        for command_vars in json.loads(b'[' + b','.join(batch) + b']'):
+            (key, state) = KeyState.of_record(command_vars, now)
+            merge_key_state(key_states, key, state)
+    return (key_states, invalid_offset)
+
+
+def verify_log_range(file: str, start: int, end: int):
+    """
+    Checks the records between the byte offsets start and end.
+    Returns the offset of the first invalid record, or None.
+    """
+    with open(file, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+
+    # the last piece follows the final newline, empty if the range ends on one
+    offset = start
+    last = len(lines) - 1
+    for (i, line) in enumerate(lines):
+        if i == last and len(line) == 0:
+            break
+        if not CommandLog.is_valid_record(line, i < last):
+            return offset
+        offset += len(line) + 1
+    return None
+
+
+class CommandLog():
+    """
+    Appends command records to the command file, one record per line.
+    Records at least codec.min_size long are compressed and written as the
+    codec's tag followed by base64 text, other records are plain json.
+
+    Each line is framed as '<length> <crc32> <record>', both in hex, so a
+    torn or corrupt record can be found. Unframed json lines from older
+    logs are still read.
+    """
+    header_size = 18
+    frame_header = re.compile(rb'[0-9a-f]{8} [0-9a-f]{8} ')
+    compressed_record = re.compile(rb'[A-Za-z0-9_]+:[A-Za-z0-9+/=]*$')
+
+    # below this size, starting processes costs more than the scan saves
+    parallel_size = 4 * 1024 * 1024
+
+    def __init__(self, file: str, codec: Codec = None,
+                 sync: bool = False) -> None:
+        self.file = file
+        self.__codec = codec
+        self.__sync = sync
+
+    @classmethod
+    def of(cls, command_file, codec: Codec = None) -> 'CommandLog':
+        """
+        Commands accept either a file name or a CommandLog.
+        """
+        if type(command_file) == CommandLog:
+            return command_file
+        return CommandLog(command_file, codec)
+
+    def append(self, command_list: list) -> None:
+        self.append_record(json.dumps(command_list))
+
+    def append_record(self, record_json: str) -> None:
+        """
+        Appends a record which is already a json list.
+        """
+        timed = METRICS.enabled
+        if timed:
+            start = time.perf_counter()
+        record = self.frame(self.encode_record(record_json))
+        with open(self.file, 'ab') as commands_file:
+            commands_file.write(record)
+            if self.__sync:
+                commands_file.flush()
+                os.fsync(commands_file.fileno())
+        if timed:
+            METRICS.record('log.append', start)
+            METRICS.count('log.records')
+            METRICS.count('log.bytes', len(record))
+            if self.__sync:
+                METRICS.count('fsyncs')
+
+    def clear(self) -> None:
+        self.reset([])
+
+    def reset(self, command_lists: list) -> None:
+        """
+        Atomically replaces the command file with the given records.
+        """
+        atomic_write(self.file, b''.join(
+            self.frame(self.encode(command_list))
+            for command_list in command_lists))
+
+    def truncate(self, length: int) -> None:
+        with open(self.file, 'r+b') as commands_file:
+            commands_file.truncate(length)
+
+    def read(self):
+        """
+        Generates each record in the command file as a list.
+        Checksums are not checked, call verify first.
+        """
+        with open(self.file, 'rb') as commands_file:
+            for line in commands_file:
+                line = line.rstrip(b'\n')
+                if CommandLog.is_framed(line):
+                    line = line[CommandLog.header_size:]
+                yield self.decode(line.decode())
+
+    def verify(self, workers=None) -> int:
+        """
+        Returns the length of the valid part of the command file, which ends
+        before the first torn or corrupt record.
+        Large files are split on line boundaries and checked in parallel.
+        """
+        offsets = self.__split(workers)
+        if len(offsets) == 2:
+            results = [verify_log_range(self.file, offsets[0], offsets[1])]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    len(offsets) - 1) as executor:
+                results = list(executor.map(verify_log_range,
+                                            [self.file] * (len(offsets) - 1),
+                                            offsets[:-1], offsets[1:]))
+
+        invalid_offsets = [offset for offset in results if offset != None]
+        return min(invalid_offsets) if invalid_offsets else offsets[-1]
+
+    def replay(self, workers=None, now=None) -> tuple:
+        """
+        Checks and parses the command file, stopping at the first torn or
+        corrupt record. Returns the final state of each key, and the length
+        of the valid part of the file. Expiries up to now count as removes,
+        see KeyState.of_record.
+        Large files are split on line boundaries, each part is parsed by its
+        own process, and the parts are merged in order.
+        """
+        offsets = self.__split(workers)
+        if len(offsets) == 2:
+            results = [replay_log_range(self.file, offsets[0], offsets[1],
+                                        self.__codec, now)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    len(offsets) - 1) as executor:
+                results = executor.map(replay_log_range,
+                                       [self.file] * (len(offsets) - 1),
+                                       offsets[:-1], offsets[1:],
+                                       [self.__codec] * (len(offsets) - 1),
+                                       [now] * (len(offsets) - 1))
+
+        key_states = dict()
+        for (part_states, invalid_offset) in results:
+            merge_key_states(key_states, part_states)
+            if invalid_offset != None:
+                return (key_states, invalid_offset)
+        return (key_states, offsets[-1])
+
+    def __split(self, workers) -> list:
+        """
+        Returns the offsets that split the command file into a part per
+        worker, each ending on a line boundary.
+        Small files are one part.
+        """
+        try:
+            size = os.path.getsize(self.file)
+        except FileNotFoundError:
+            return [0, 0]
+
+        if workers == None:
+            if hasattr(os, 'sched_getaffinity'):
+                workers = len(os.sched_getaffinity(0))
+            else:
+                workers = os.cpu_count() or 1
+        if workers == 1 or size < CommandLog.parallel_size:
+            return [0, size]
+
+        # move each split point past the next newline
+        offsets = [0]
+        with open(self.file, 'rb') as commands_file:
+            for i in range(1, workers):
+                commands_file.seek(max(size * i // workers, offsets[-1]))
+                commands_file.readline()
+                offsets.append(commands_file.tell())
+        offsets.append(size)
+        return offsets
+
+    @classmethod
+    def frame(cls, record: str) -> bytes:
+        data = record.encode()
+        return b'%08x %08x ' % (len(data), zlib.crc32(data)) + data + b'\n'
+
+    @classmethod
+    def is_framed(cls, line: bytes) -> bool:
+        return CommandLog.frame_header.match(line) != None
+
+    @classmethod
+    def is_valid_record(cls, line: bytes, has_newline: bool) -> bool:
+        """
+        A framed record is valid if its length and checksum match.
+        An unframed record, from an older log, is valid if it is a json
+        list, whose newline may be missing on the last line, or a compressed
+        record finished with a newline, which must still decode, see
+        replay_log_range. A frame torn or corrupt in its header is neither.
+        """
+        if CommandLog.frame_header.match(line) != None:
+            data = line[CommandLog.header_size:]
+            return int(line[0:8], 16) == len(data) and \
+                int(line[9:17], 16) == zlib.crc32(data)
+        if not line.startswith(b'['):
+            return has_newline and \
+                CommandLog.compressed_record.match(line) != None
+        try:
+            return type(json.loads(line)) == list
+        except ValueError:
+            return False
+
+    def encode(self, command_list: list) -> str:
+        return self.encode_record(json.dumps(command_list))
+
+    def encode_record(self, record: str) -> str:
+        if self.__codec == None or len(record) < self.__codec.min_size:
+            return record
+        compressed = self.__codec.compress(record.encode())
+        return self.__codec.tag + ':' + base64.b64encode(compressed).decode()
+
+    def decode(self, line: str) -> list:
+        # plain records are json lists, compressed records start with a tag
+        if line.startswith('['):
+            return json.loads(line)
+        if self.__codec == None or not line.startswith(self.__codec.tag + ':'):
+            raise ValueError("Record was compressed with an unknown codec.")
+        compressed = base64.b64decode(line[len(self.__codec.tag) + 1:])
+        return json.loads(self.__codec.decompress(compressed))
+
+
+class ChunkedList():
+    """
+    A list held as chunks of at most 2 * chunk_size elements, with a
+    Fenwick tree of the chunk lengths to find the chunk of an index in
+    O(log n). Inserting or removing anywhere only moves the elements of
+    one chunk, and the ends are reached without searching.
+    Each chunk keeps its json fragment until it is changed, see fragments.
+    """
+    chunk_size = 512
+
+    def __init__(self) -> None:
+        self.__chunks = list()
+        self.__fragments = list()
+        self.__tree = [0]
+        self.__length = 0
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __iter__(self):
+        for chunk in self.__chunks:
+            yield from chunk
+
+    def __getitem__(self, index: int):
+        return self.get(index)
+
+    def __setitem__(self, index: int, value) -> None:
+        self.set(index, value)
+
+    @classmethod
+    def of(cls, values: list) -> 'ChunkedList':
+        """
+        Returns a ChunkedList of the values, in chunks of chunk_size.
+        """
+        chunked = ChunkedList()
+        chunked.__chunks = [values[start:start + ChunkedList.chunk_size]
+                            for start in range(0, len(values),
+                                               ChunkedList.chunk_size)]
+        chunked.__fragments = [None] * len(chunked.__chunks)
+        chunked.__length = len(values)
+        chunked.__rebuild()
+        return chunked
+
+    def __rebuild(self) -> None:
+        tree = [0] + [len(chunk) for chunk in self.__chunks]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.__tree = tree
+
+    def __add_length(self, chunk_index: int, amount: int) -> None:
+        tree = self.__tree
+        i = chunk_index + 1
+        while i < len(tree):
+            tree[i] += amount
+            i += i & -i
+
+    def __locate(self, index: int) -> tuple:
+        """
+        Returns (chunk index, index in the chunk) for a valid index.
+        """
+        if index < len(self.__chunks[0]):
+            return (0, index)
+        last = len(self.__chunks) - 1
+        last_start = self.__length - len(self.__chunks[last])
+        if index >= last_start:
+            return (last, index - last_start)
+
+        tree = self.__tree
+        position = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            if position + step < len(tree) and tree[position + step] <= index:
+                position += step
+                index -= tree[position]
+            step >>= 1
+        return (position, index)
+
+    def __start(self, chunk_index: int) -> int:
+        """
+        Returns the index of the first element of the chunk.
+        """
+        tree = self.__tree
+        start = 0
+        while chunk_index > 0:
+            start += tree[chunk_index]
+            chunk_index -= chunk_index & -chunk_index
+        return start
+
+    def bisect_left(self, value) -> int:
+        """
+        Returns where to insert the value to keep a sorted list sorted,
+        before any equal elements, in O(log n).
+        """
+        chunks = self.__chunks
+        low = 0
+        high = len(chunks)
+        # the first chunk whose last element is not below the value
+        while low < high:
+            middle = (low + high) // 2
+            if chunks[middle][-1] < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(chunks):
+            return self.__length
+        return self.__start(low) + bisect.bisect_left(chunks[low], value)
+
+    def __check_index(self, index: int) -> int:
+        if index < 0:
+            index += self.__length
+        if index < 0 or index >= self.__length:
+            raise IndexError("list index out of range")
+        return index
+
+    def get(self, index: int):
+        (chunk_index, offset) = self.__locate(self.__check_index(index))
+        return self.__chunks[chunk_index][offset]
+
+    def set(self, index: int, value) -> None:
+        (chunk_index, offset) = self.__locate(self.__check_index(index))
+        self.__chunks[chunk_index][offset] = value
+        self.__fragments[chunk_index] = None
+
+    def append(self, value) -> None:
+        chunks = self.__chunks
+        if chunks and len(chunks[-1]) < 2 * ChunkedList.chunk_size:
+            chunks[-1].append(value)
+            self.__fragments[-1] = None
+            # the last chunk is only counted by the last node of the tree
+            self.__tree[-1] += 1
+            self.__length += 1
+            return
+        chunks.append([value])
+        self.__fragments.append(None)
+        self.__length += 1
+        self.__rebuild()
+
+    def insert(self, index: int, value) -> None:
+        """
+        Inserts before the index, an index equal to the length appends.
+        """
+        if index < 0:
+            index = max(index + self.__length, 0)
+        if index >= self.__length:
+            self.append(value)
+            return
+        (chunk_index, offset) = self.__locate(index)
+        chunk = self.__chunks[chunk_index]
+        chunk.insert(offset, value)
+        self.__fragments[chunk_index] = None
+        self.__length += 1
+        if len(chunk) > 2 * ChunkedList.chunk_size:
+            # split the chunk in two
+            self.__chunks[chunk_index:chunk_index + 1] = \
+                [chunk[:ChunkedList.chunk_size], chunk[ChunkedList.chunk_size:]]
+            self.__fragments[chunk_index:chunk_index + 1] = [None, None]
+            self.__rebuild()
+        else:
+            self.__add_length(chunk_index, 1)
+
+    def pop(self, index: int = -1):
+        (chunk_index, offset) = self.__locate(self.__check_index(index))
+        chunk = self.__chunks[chunk_index]
+        value = chunk.pop(offset)
+        self.__fragments[chunk_index] = None
+        self.__length -= 1
+        if not chunk:
+            del self.__chunks[chunk_index]
+            del self.__fragments[chunk_index]
+            self.__rebuild()
+        elif len(chunk) < ChunkedList.chunk_size // 4 and \
+                chunk_index + 1 < len(self.__chunks) and \
+                len(chunk) + len(self.__chunks[chunk_index + 1]) <= \
+                2 * ChunkedList.chunk_size:
+            # merge small chunks into the next one
+            chunk.extend(self.__chunks.pop(chunk_index + 1))
+            del self.__fragments[chunk_index + 1]
+            self.__rebuild()
+        else:
+            self.__add_length(chunk_index, -1)
+        return value
+
+    def fragments(self, encode_chunk):
+        """
+        Generates a json fragment for each non-empty chunk.
+        encode_chunk(chunk) returns the fragment and whether it can be
+        kept, fragments of chunks holding mutable values can change
+        without the chunk knowing.
+        """
+        for (chunk_index, chunk) in enumerate(self.__chunks):
+            fragment = self.__fragments[chunk_index]
+            if fragment == None:
+                (fragment, keep) = encode_chunk(chunk)
+                if keep:
+                    self.__fragments[chunk_index] = fragment
+            yield fragment
+
+    def memory_size(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.__chunks) + \
+            sum(sys.getsizeof(chunk) for chunk in self.__chunks) + \
+            sys.getsizeof(self.__tree)
 
 
 class Array:
+    """
+    The elements are held in a plain list until they outgrow one chunk of
+    a ChunkedList, then in a ChunkedList, so inserting or removing at any
+    index of a large Array is O(log n) and the ends are O(1). Most Arrays
+    are small and never pay for the chunks.
+    The json from to_string is kept until the Array or a nested value
+    changes, see invalidate.
+    """
+    # the most elements held in a plain list
+    list_limit = 2 * ChunkedList.chunk_size
+
     def __init__(self) -> None:
         self.__list = list()
-        self.__validator = Validator()
+        self.__validator = DEFAULT_VALIDATOR
+        self.__validate_element = None
+        self.__json = None
+        self.__parents = dict()
+
+    def __check_element(self, value):
+        """
+        Returns the schema bindings to make once the value is stored, or
+        None if the Array has no schema.
+        """
+        if type(value) == NumericArray:
+            raise TypeError("NumericArrays can only be database values.")
+        if self.__validate_element == None:
+            return None
+        bindings = list()
+        try:
+            self.__validate_element(value, bindings)
+        except TypeError as e:
+            raise Schema.error(e, 'Element') from None
+        return bindings
+
+    def __grow(self) -> None:
+        if type(self.__list) == list and \
+                len(self.__list) > Array.list_limit:
+            self.__list = ChunkedList.of(self.__list)
+
+    def __release(self, value, replacement=None) -> None:
+        detach(value, self)
+        if self.__validate_element != None and value is not replacement:
+            Schema.unbind(value)
 
     def put(self, value) -> 'Array':
         if self.__validator.is_valid(value):
+            bindings = self.__check_element(value)
             self.__list.append(value)
+            if len(self.__list) > Array.list_limit:
+                self.__grow()
+            attach(value, self)
+            if bindings:
+                Schema.bind(bindings)
+            self.invalidate()
+        return self
+
+    def insert(self, index: int, value) -> 'Array':
+        """
+        Puts the value before the index, 0 puts it first.
+        """
+        if self.__validator.is_valid(value):
+            bindings = self.__check_element(value)
+            self.__list.insert(index, value)
+            if len(self.__list) > Array.list_limit:
+                self.__grow()
+            attach(value, self)
+            if bindings:
+                Schema.bind(bindings)
+            self.invalidate()
+        return self
+
+    def set(self, index: int, value) -> 'Array':
+        if self.__validator.is_valid(value):
+            bindings = self.__check_element(value)
+            old_value = self.__list[index]
+            self.__list[index] = value
+            self.__release(old_value, value)
+            attach(value, self)
+            if bindings:
+                Schema.bind(bindings)
+            self.invalidate()
         return self
 
     def get(self, index: int, value_type=None):
@@ -474,20 +2570,88 @@ class Array:
 
     def to_string(self) -> str:
         """
-        Recursively calls to_string when we run into an Array or Object
+        Calls to_string on nested Arrays and Objects, the nested values are
+        left as they are. The json of chunks holding only strings, numbers,
+        booleans and None is kept until the chunk changes, other chunks
+        join the kept json of their nested values.
         """
-        for element in self.__list:
-            if type(element) == Array or type(element) == Object:
-                self.__list[self.__list.index(element)] = \
-                    json.loads(element.to_string())
+        if self.__json == None:
+            if type(self.__list) == list:
+                self.__json = '[' + \
+                    Array.__encode_chunk(self.__list)[0] + ']'
+            else:
+                fragments = [fragment for fragment in
+                             self.__list.fragments(Array.__encode_chunk)
+                             if fragment]
+                self.__json = '[' + ', '.join(fragments) + ']'
+        return self.__json
 
-        return json.dumps(self.__list)
+    @classmethod
+    def __encode_chunk(cls, chunk: list) -> tuple:
+        try:
+            # drop the brackets of the chunk's list
+            return (json.dumps(chunk)[1:-1], True)
+        except TypeError:
+            # the chunk holds Arrays or Objects
+            return (', '.join([value_json(element) for element in chunk]),
+                    False)
 
     def remove(self, index: int):
         try:
-            return self.__list.pop(index)
+            value = self.__list.pop(index)
         except IndexError:
             return None
+        self.__release(value)
+        self.invalidate()
+        return value
+
+    def add_parent(self, parent) -> None:
+        add_weak(self.__parents, parent)
+
+    def remove_parent(self, parent) -> None:
+        remove_weak(self.__parents, parent)
+
+    def invalidate(self) -> None:
+        """
+        Drops the kept json of this Array and of everything holding it.
+        If it was already dropped, the holders have dropped theirs too.
+        """
+        if self.__json == None:
+            return
+        self.__json = None
+        for parent in live(self.__parents):
+            parent.invalidate()
+
+    def set_schema(self, validate_element) -> None:
+        """
+        Sets the function which checks each element put into the Array.
+        """
+        self.__validate_element = validate_element
+
+    def get_schema(self):
+        return self.__validate_element
+
+    def unbind(self) -> 'Array':
+        """
+        Removes the schema of this Array and of the values nested in it.
+        Values nested in an Array without a schema were not bound by it.
+        """
+        if self.__validate_element == None:
+            return self
+        self.__validate_element = None
+        for value in self.__list:
+            if type(value) == Object or type(value) == Array:
+                value.unbind()
+        return self
+
+    def memory_size(self) -> int:
+        kept_json = sys.getsizeof(self.__json) if self.__json != None else 0
+        if type(self.__list) == list:
+            list_size = sys.getsizeof(self.__list)
+        else:
+            list_size = self.__list.memory_size()
+        return sys.getsizeof(self) + list_size + kept_json + \
+            sum(memory_size(element) for element in self.__list)
 
     @classmethod
     def from_string(cls, array_json: str) -> 'Array':
@@ -500,29 +2664,74 @@ class Array:
         except Exception as e:
             raise e
 
+        return Array.from_list(array_data)
+
+    @classmethod
+    def from_list(cls, array_data: list) -> 'Array':
+        """
+        Create a new Array from a decoded json list.
+        """
         new_array = Array()
 
-        # dictionaries and lists become arrays and objects
+        # dictionaries and lists become arrays and objects, the other json
+        # values are valid elements as they are
+        elements = list()
         for element in array_data:
             if type(element) == dict:
-                new_array.put(Object.from_string(json.dumps(element)))
+                element = Object.from_dict(element)
+                attach(element, new_array)
             elif type(element) == list:
-                new_array.put(Array.from_string(json.dumps(element)))
-            else:
-                new_array.put(element)
+                element = Array.from_list(element)
+                attach(element, new_array)
+            elements.append(element)
+        new_array.__list = elements
+        new_array.__grow()
         return new_array
 
 
 class Object:
+    """
+    The json from to_string is kept until the Object or a nested value
+    changes, see invalidate.
+    """
+
     def __init__(self) -> None:
         self.__data = dict()
-        self.__validator = Validator()
+        self.__validator = DEFAULT_VALIDATOR
+        self.__fields = None
+        self.__required = frozenset()
+        self.__json = None
+        self.__parents = dict()
+        # the number of Arrays and Objects held
+        self.__nested = 0
 
     def put(self, key: str, value) -> 'Object':
+        if type(value) == NumericArray:
+            raise TypeError("NumericArrays can only be database values.")
         if self.__validator.is_valid(value) and type(key) == str:
+            bindings = None
+            if self.__fields != None and key in self.__fields:
+                bindings = list()
+                try:
+                    self.__fields[key](value, bindings)
+                except TypeError as e:
+                    raise Schema.error(e, key) from None
+            if key in self.__data:
+                self.__release(self.__data[key], value)
             self.__data[key] = value
+            if attach(value, self):
+                self.__nested += 1
+            if bindings:
+                Schema.bind(bindings)
+            self.invalidate()
         return self
 
+    def __release(self, value, replacement=None) -> None:
+        if detach(value, self):
+            self.__nested -= 1
+        if self.__fields != None and value is not replacement:
+            Schema.unbind(value)
+
     def get(self, key: str, value_type=None):
         value = self.__data[key]
         if value_type:
@@ -533,18 +2742,86 @@ class Object:
     def length(self) -> int:
         return len(self.__data)
 
+    def keys(self) -> list:
+        return list(self.__data)
+
     def to_string(self) -> str:
         """
         Recursively calls to_string when we run into an Array or Object
+        The nested values are left as they are, and keep their json.
         """
-        for (key, value) in self.__data.items():
-            if type(value) == Array or type(value) == Object:
-                self.__data[key] = json.loads(value.to_string())
-
-        return json.dumps(self.__data)
+        if self.__json == None:
+            self.__json = self.__encode()
+        return self.__json
+
+    def __encode(self) -> str:
+        if self.__nested == 0:
+            try:
+                return json.dumps(self.__data)
+            except TypeError:
+                # immutable values are not counted as nested
+                pass
+        return '{' + ', '.join([json.dumps(key) + ': ' + value_json(value)
+                                for (key, value) in self.__data.items()]) + '}'
 
     def remove(self, key: str):
-        return self.__data.pop(key)
+        if key in self.__required:
+            raise TypeError(key + " is required.")
+        value = self.__data.pop(key)
+        self.__release(value)
+        self.invalidate()
+        return value
+
+    def add_parent(self, parent) -> None:
+        add_weak(self.__parents, parent)
+
+    def remove_parent(self, parent) -> None:
+        remove_weak(self.__parents, parent)
+
+    def invalidate(self) -> None:
+        """
+        Drops the kept json of this Object and of everything holding it.
+        If it was already dropped, the holders have dropped theirs too.
+        """
+        if self.__json == None:
+            return
+        self.__json = None
+        for parent in live(self.__parents):
+            parent.invalidate()
+
+    def set_schema(self, fields: dict, required: frozenset) -> None:
+        """
+        Sets the functions which check the value put at each field, and the
+        fields which may not be removed.
+        """
+        self.__fields = fields
+        self.__required = required
+
+    def get_schema(self) -> dict:
+        """
+        Returns the field validators set by set_schema, or None.
+        """
+        return self.__fields
+
+    def unbind(self) -> 'Object':
+        """
+        Removes the schema of this Object and of the values nested in it.
+        """
+        if self.__fields == None:
+            return self
+        self.__fields = None
+        self.__required = frozenset()
+        if self.__nested:
+            for value in self.__data.values():
+                if type(value) == Object or type(value) == Array:
+                    value.unbind()
+        return self
+
+    def memory_size(self) -> int:
+        kept_json = sys.getsizeof(self.__json) if self.__json != None else 0
+        return sys.getsizeof(self) + sys.getsizeof(self.__data) + kept_json + \
+            sum(sys.getsizeof(key) + memory_size(value)
+                for (key, value) in self.__data.items())
 
     @classmethod
     def from_string(cls, object_json: str) -> 'Object':
@@ -557,23 +2834,1206 @@ class Object:
         except Exception as e:
             raise e
 
-        new_object = Object()
+        return Object.from_dict(object_data)
 
-        # dictionaries and lists become arrays and objects
+    @classmethod
+    def from_dict(cls, object_data: dict) -> 'Object':
+        """
+        Create a new Object from a decoded json dictionary.
+        """
+        new_object = Object()
+
+        # dictionaries and lists become arrays and objects
         for (key, value) in object_data.items():
             if type(key) != str:
                 raise TypeError
 
             if type(value) == dict:
-                new_object.put(key, Object.from_string(json.dumps(value)))
+                new_object.put(key, Object.from_dict(value))
             elif type(value) == list:
-                new_object.put(key, Array.from_string(json.dumps(value)))
+                new_object.put(key, Array.from_list(value))
             else:
                 new_object.put(key, value)
 
         return new_object
 
 
+class NumericArray:
+    """
+    An array of int64 or float64 numbers held in one contiguous buffer
+    instead of a list of Python objects.
+    Aggregates use numpy when it is installed.
+    It is only stored as a database value, not nested in an Object or
+    Array. get_json writes it as a plain list, snapshots and the command
+    log in a compact binary encoding, see encode.
+    An immutable database stores read only copies, see read_only.
+    """
+    typecodes = {'int64': 'q', 'float64': 'd'}
+
+    def __init__(self, dtype: str = 'float64', values=None) -> None:
+        if not dtype in NumericArray.typecodes:
+            raise TypeError("dtype must be int64 or float64.")
+        self.__dtype = dtype
+        self.__data = array.array(NumericArray.typecodes[dtype])
+        self.__parents = dict()
+        self.__read_only = False
+        if values != None:
+            self.extend(values)
+
+    def dtype(self) -> str:
+        return self.__dtype
+
+    def read_only(self) -> 'NumericArray':
+        """
+        Returns a copy which cannot be changed, for immutable versions.
+        slice returns a changeable copy of it.
+        """
+        if self.__read_only:
+            return self
+        copy = self.slice()
+        copy.__read_only = True
+        return copy
+
+    def is_read_only(self) -> bool:
+        return self.__read_only
+
+    def __check_writable(self) -> None:
+        if self.__read_only:
+            raise TypeError("NumericArray is read only.")
+
+    def put(self, value) -> 'NumericArray':
+        self.__check_writable()
+        if type(value) == int or (type(value) == float and
+                                  self.__dtype == 'float64'):
+            self.__data.append(value)
+        else:
+            raise TypeError("Invalid value for " + self.__dtype + ".")
+        self.invalidate()
+        return self
+
+    def extend(self, values) -> 'NumericArray':
+        """
+        Appends many values at once, from a list, an Array, another
+        NumericArray or a numpy array.
+        """
+        self.__check_writable()
+        if type(values) == NumericArray:
+            values = values.to_buffer(self.__dtype)
+        elif type(values) == Array:
+            values = [values.get(i) for i in range(values.length())]
+        elif numpy != None and type(values) == numpy.ndarray:
+            values = values.astype(self.__dtype).tobytes()
+
+        if type(values) == bytes:
+            self.__data.frombytes(values)
+        else:
+            # array rejects floats in int64 arrays and non-numbers itself
+            self.__data.extend(values)
+        self.invalidate()
+        return self
+
+    def get(self, index: int, value_type=None):
+        value = self.__data[index]
+        if value_type:
+            if type(value) != value_type:
+                raise TypeError("Does not contain given type")
+        return value
+
+    def length(self) -> int:
+        return len(self.__data)
+
+    def remove(self, index: int):
+        self.__check_writable()
+        try:
+            value = self.__data.pop(index)
+        except IndexError:
+            return None
+        self.invalidate()
+        return value
+
+    def add_parent(self, parent) -> None:
+        add_weak(self.__parents, parent)
+
+    def remove_parent(self, parent) -> None:
+        remove_weak(self.__parents, parent)
+
+    def invalidate(self) -> None:
+        """
+        Tells everything holding the NumericArray that it changed.
+        Its own json is not kept.
+        """
+        for parent in live(self.__parents):
+            parent.invalidate()
+
+    def slice(self, start: int = None, stop: int = None) -> 'NumericArray':
+        new_array = NumericArray(self.__dtype)
+        new_array.extend(self.__data[start:stop])
+        return new_array
+
+    def sum(self):
+        if numpy != None and len(self.__data):
+            return self.__numpy().sum().item()
+        return sum(self.__data)
+
+    def min(self):
+        if numpy != None and len(self.__data):
+            return self.__numpy().min().item()
+        return min(self.__data)
+
+    def max(self):
+        if numpy != None and len(self.__data):
+            return self.__numpy().max().item()
+        return max(self.__data)
+
+    def mean(self) -> float:
+        if len(self.__data) == 0:
+            raise ValueError("Mean of an empty NumericArray.")
+        if numpy != None:
+            return self.__numpy().mean().item()
+        return sum(self.__data) / len(self.__data)
+
+    def __numpy(self):
+        # a view of the buffer, nothing is copied
+        return numpy.frombuffer(self.__data, dtype=self.__dtype)
+
+    def to_buffer(self, dtype: str = None) -> array.array:
+        """
+        Returns a copy of the buffer, converted to dtype if given.
+        """
+        if dtype == None or dtype == self.__dtype:
+            return array.array(self.__data.typecode, self.__data)
+        return array.array(NumericArray.typecodes[dtype],
+                           [NumericArray.convert(value, dtype)
+                            for value in self.__data])
+
+    @classmethod
+    def convert(cls, value, dtype: str):
+        if dtype == 'int64':
+            if value != int(value):
+                raise TypeError("Cannot store " + str(value) + " as int64.")
+            return int(value)
+        return float(value)
+
+    def to_list(self) -> list:
+        return self.__data.tolist()
+
+    def to_array(self) -> Array:
+        new_array = Array()
+        for value in self.__data:
+            new_array.put(value)
+        return new_array
+
+    @classmethod
+    def from_array(cls, source: Array, dtype: str = 'float64') -> 'NumericArray':
+        return NumericArray(dtype, source)
+
+    def to_string(self) -> str:
+        return json.dumps(self.__data.tolist())
+
+    def encode(self) -> list:
+        """
+        Returns the json form used in snapshots and the command log: null,
+        the dtype and the little endian buffer in base64.
+        No other value is encoded like this, as Arrays cannot hold null.
+        """
+        data = self.__data
+        if sys.byteorder != 'little':
+            data = array.array(data.typecode, data)
+            data.byteswap()
+        return [None, self.__dtype,
+                base64.b64encode(data.tobytes()).decode()]
+
+    @classmethod
+    def is_encoded(cls, data) -> bool:
+        return type(data) == list and len(data) == 3 and data[0] == None
+
+    @classmethod
+    def decode(cls, data: list) -> 'NumericArray':
+        new_array = NumericArray(data[1])
+        values = array.array(NumericArray.typecodes[data[1]])
+        values.frombytes(base64.b64decode(data[2]))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        new_array.extend(values)
+        return new_array
+
+    def memory_size(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.__data)
+
+
+class HashMapEntry():
+    __slots__ = ('hash', 'key', 'value')
+
+    def __init__(self, key_hash: int, key, value) -> None:
+        self.hash = key_hash
+        self.key = key
+        self.value = value
+
+
+class HashMapNode():
+    """
+    A node of a hash array mapped trie. Bit i of the bitmap is set if the
+    node has an entry for the five hash bits i at its level, and entries
+    holds those entries in bit order, each a HashMapEntry or a child node.
+    """
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap: int, entries: tuple) -> None:
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class HashMapCollision():
+    """
+    Entries whose keys have the same full hash.
+    """
+    __slots__ = ('hash', 'entries')
+
+    def __init__(self, key_hash: int, entries: tuple) -> None:
+        self.hash = key_hash
+        self.entries = entries
+
+
+class HashMap():
+    """
+    A persistent (immutable) dictionary, a hash array mapped trie with 32
+    way branching. set and delete return a new HashMap that shares all
+    but O(log n) nodes with the old one, which is left unchanged.
+    """
+    __slots__ = ('__root', '__length')
+    hash_bits = 64
+
+    def __init__(self, root: HashMapNode = None, length: int = 0) -> None:
+        self.__root = root if root != None else HashMapNode(0, ())
+        self.__length = length
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, HashMap) is not HashMap
+
+    def __getitem__(self, key):
+        value = self.get(key, HashMap)
+        if value is HashMap:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for (key, value) in self.items():
+            yield key
+
+    def get(self, key, default=None):
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        node = self.__root
+        shift = 0
+        while True:
+            if type(node) == HashMapCollision:
+                for entry in node.entries:
+                    if entry.key == key:
+                        return entry.value
+                return default
+            bit = 1 << ((key_hash >> shift) & 31)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[bin(node.bitmap & (bit - 1)).count('1')]
+            if type(entry) == HashMapEntry:
+                return entry.value if entry.key == key else default
+            node = entry
+            shift += 5
+
+    def items(self):
+        """
+        Generates the (key, value) pairs.
+        """
+        stack = [self.__root]
+        while stack:
+            node = stack.pop()
+            for entry in node.entries:
+                if type(entry) == HashMapEntry:
+                    yield (entry.key, entry.value)
+                else:
+                    stack.append(entry)
+
+    def set(self, key, value) -> 'HashMap':
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        (root, added) = HashMap.__set(self.__root, 0,
+                                      HashMapEntry(key_hash, key, value))
+        if root is self.__root:
+            return self
+        return HashMap(root, self.__length + 1 if added else self.__length)
+
+    def delete(self, key) -> 'HashMap':
+        """
+        Raises KeyError if the key is missing.
+        """
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        root = HashMap.__delete(self.__root, 0, key_hash, key)
+        if root == None:
+            root = HashMapNode(0, ())
+        elif type(root) != HashMapNode:
+            root = HashMap.__node_of(root, 0)
+        return HashMap(root, self.__length - 1)
+
+    @classmethod
+    def __set(cls, node, shift: int, new_entry: HashMapEntry) -> tuple:
+        """
+        Returns the node with the entry set, and whether a key was added.
+        """
+        if type(node) == HashMapCollision:
+            for (index, entry) in enumerate(node.entries):
+                if entry.key == new_entry.key:
+                    if entry.value is new_entry.value:
+                        return (node, False)
+                    entries = node.entries[:index] + (new_entry,) + \
+                        node.entries[index + 1:]
+                    return (HashMapCollision(node.hash, entries), False)
+            return (HashMapCollision(node.hash, node.entries + (new_entry,)),
+                    True)
+
+        bit = 1 << ((new_entry.hash >> shift) & 31)
+        index = bin(node.bitmap & (bit - 1)).count('1')
+        if not node.bitmap & bit:
+            entries = node.entries[:index] + (new_entry,) + \
+                node.entries[index:]
+            return (HashMapNode(node.bitmap | bit, entries), True)
+
+        entry = node.entries[index]
+        if type(entry) == HashMapEntry:
+            if entry.key == new_entry.key:
+                if entry.value is new_entry.value:
+                    return (node, False)
+                child = new_entry
+                added = False
+            elif entry.hash == new_entry.hash:
+                child = HashMapCollision(entry.hash, (entry, new_entry))
+                added = True
+            else:
+                (child, added) = HashMap.__set(
+                    HashMap.__node_of(entry, shift + 5), shift + 5, new_entry)
+        else:
+            (child, added) = HashMap.__set(entry, shift + 5, new_entry)
+            if child is entry:
+                return (node, False)
+        entries = node.entries[:index] + (child,) + node.entries[index + 1:]
+        return (HashMapNode(node.bitmap, entries), added)
+
+    @classmethod
+    def __node_of(cls, entry, shift: int) -> HashMapNode:
+        """
+        Returns a node holding just the entry (or collision) at this level.
+        """
+        if shift >= HashMap.hash_bits:
+            # all hash bits are used, only a collision can go deeper
+            return entry
+        return HashMapNode(1 << ((entry.hash >> shift) & 31), (entry,))
+
+    @classmethod
+    def __delete(cls, node, shift: int, key_hash: int, key):
+        """
+        Returns the node without the key. A node left with a single entry
+        returns that entry so its parent can hold it directly, and an empty
+        node returns None.
+        """
+        if type(node) == HashMapCollision:
+            entries = tuple(entry for entry in node.entries
+                            if entry.key != key)
+            if len(entries) == len(node.entries):
+                raise KeyError(key)
+            if len(entries) == 1:
+                return entries[0]
+            return HashMapCollision(node.hash, entries)
+
+        bit = 1 << ((key_hash >> shift) & 31)
+        if not node.bitmap & bit:
+            raise KeyError(key)
+        index = bin(node.bitmap & (bit - 1)).count('1')
+        entry = node.entries[index]
+        if type(entry) == HashMapEntry:
+            if entry.key != key:
+                raise KeyError(key)
+            child = None
+        else:
+            child = HashMap.__delete(entry, shift + 5, key_hash, key)
+
+        if child == None:
+            entries = node.entries[:index] + node.entries[index + 1:]
+            if len(entries) == 0:
+                return None
+            if len(entries) == 1 and type(entries[0]) != HashMapNode:
+                return entries[0]
+            return HashMapNode(node.bitmap & ~bit, entries)
+        if len(node.entries) == 1 and type(child) != HashMapNode:
+            return child
+        entries = node.entries[:index] + (child,) + node.entries[index + 1:]
+        return HashMapNode(node.bitmap, entries)
+
+
+class OrderedHashMap():
+    """
+    A persistent dictionary like HashMap which keeps insertion order, as
+    dict does. A Vector holds the (key, value) pairs in order and a HashMap
+    the position of each key. Removed keys leave holes, which are dropped
+    once they outnumber the keys, so set and delete stay O(log n) amortized.
+    """
+    __slots__ = ('__positions', '__order', '__holes')
+
+    def __init__(self, positions: HashMap = None, order: 'Vector' = None,
+                 holes: int = 0) -> None:
+        self.__positions = positions if positions != None else HashMap()
+        self.__order = order if order != None else Vector()
+        self.__holes = holes
+
+    def __len__(self) -> int:
+        return len(self.__positions)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__positions
+
+    def __getitem__(self, key):
+        return self.__order.get(self.__positions[key])[1]
+
+    def __iter__(self):
+        for (key, value) in self.items():
+            yield key
+
+    def get(self, key, default=None):
+        position = self.__positions.get(key)
+        if position == None:
+            return default
+        return self.__order.get(position)[1]
+
+    def items(self):
+        """
+        Generates the (key, value) pairs in insertion order.
+        """
+        for entry in self.__order:
+            if entry != None:
+                yield entry
+
+    def set(self, key, value) -> 'OrderedHashMap':
+        position = self.__positions.get(key)
+        if position == None:
+            return OrderedHashMap(
+                self.__positions.set(key, len(self.__order)),
+                self.__order.append((key, value)), self.__holes)
+        return OrderedHashMap(self.__positions,
+                              self.__order.set(position, (key, value)),
+                              self.__holes)
+
+    def delete(self, key) -> 'OrderedHashMap':
+        """
+        Raises KeyError if the key is missing.
+        """
+        position = self.__positions[key]
+        positions = self.__positions.delete(key)
+        if position == len(self.__order) - 1:
+            return OrderedHashMap(positions, self.__order.pop(),
+                                  self.__holes)
+        if self.__holes + 1 > max(len(positions), 32):
+            return OrderedHashMap.of(entry for entry in self.__order
+                                     if entry != None and entry[0] != key)
+        return OrderedHashMap(positions, self.__order.set(position, None),
+                              self.__holes + 1)
+
+    @classmethod
+    def of(cls, items) -> 'OrderedHashMap':
+        """
+        Returns an OrderedHashMap of the (key, value) pairs, in their order.
+        """
+        positions = HashMap()
+        order = Vector()
+        for (key, value) in items:
+            position = positions.get(key)
+            if position == None:
+                positions = positions.set(key, len(order))
+                order = order.append((key, value))
+            else:
+                order = order.set(position, (key, value))
+        return OrderedHashMap(positions, order)
+
+
+class KeySet(collections.abc.Set):
+    """
+    A read only set held in a persistent HashMap. add and discard return a
+    new KeySet in O(log n) and leave this one unchanged, so views can hand
+    their current keys to cursors without copying them.
+    It compares equal to a set or frozenset with the same items.
+    """
+    __slots__ = ('__map',)
+
+    def __init__(self, items=(), key_map: HashMap = None) -> None:
+        if key_map == None:
+            key_map = HashMap()
+            for item in items:
+                key_map = key_map.set(item, True)
+        self.__map = key_map
+
+    def __len__(self) -> int:
+        return len(self.__map)
+
+    def __contains__(self, item) -> bool:
+        return item in self.__map
+
+    def __iter__(self):
+        return iter(self.__map)
+
+    def __repr__(self) -> str:
+        return 'KeySet(' + repr(set(self)) + ')'
+
+    @classmethod
+    def _from_iterable(cls, items) -> frozenset:
+        # set operations such as & and | return plain frozensets
+        return frozenset(items)
+
+    def add(self, item) -> 'KeySet':
+        if item in self.__map:
+            return self
+        return KeySet(key_map=self.__map.set(item, True))
+
+    def discard(self, item) -> 'KeySet':
+        if not item in self.__map:
+            return self
+        return KeySet(key_map=self.__map.delete(item))
+
+
+class VersionedDict():
+    """
+    A dictionary whose contents are an OrderedHashMap, so that version()
+    returns the current contents in O(1) while later changes go to new
+    versions. Iteration goes over the version current when it started,
+    in insertion order.
+    """
+
+    def __init__(self) -> None:
+        self.__map = OrderedHashMap()
+
+    def version(self) -> OrderedHashMap:
+        return self.__map
+
+    def __len__(self) -> int:
+        return len(self.__map)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__map
+
+    def __getitem__(self, key):
+        return self.__map[key]
+
+    def __setitem__(self, key, value) -> None:
+        self.__map = self.__map.set(key, value)
+
+    def __delitem__(self, key) -> None:
+        self.__map = self.__map.delete(key)
+
+    def __iter__(self):
+        return iter(self.__map)
+
+    def get(self, key, default=None):
+        return self.__map.get(key, default)
+
+    def items(self):
+        return self.__map.items()
+
+    def pop(self, key, *default):
+        value = self.__map.get(key, VersionedDict)
+        if value is VersionedDict:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.__map = self.__map.delete(key)
+        return value
+
+
+class Vector():
+    """
+    A persistent (immutable) list, a trie of 32 element tuples with the
+    last elements kept in a tail, as in Clojure's PersistentVector.
+    append, set and pop return a new Vector sharing all but O(log n)
+    nodes with the old one.
+    """
+    __slots__ = ('__length', '__shift', '__root', '__tail')
+
+    def __init__(self, length: int = 0, shift: int = 5, root: tuple = (),
+                 tail: tuple = ()) -> None:
+        self.__length = length
+        self.__shift = shift
+        self.__root = root
+        self.__tail = tail
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __iter__(self):
+        for index in range(0, self.__tail_offset(), 32):
+            yield from self.__leaf(index)
+        yield from self.__tail
+
+    def __tail_offset(self) -> int:
+        return self.__length - len(self.__tail)
+
+    def __leaf(self, index: int) -> tuple:
+        node = self.__root
+        for level in range(self.__shift, 0, -5):
+            node = node[(index >> level) & 31]
+        return node
+
+    def get(self, index: int):
+        if index < 0:
+            index += self.__length
+        if index < 0 or index >= self.__length:
+            raise IndexError("Vector index out of range")
+        if index >= self.__tail_offset():
+            return self.__tail[index & 31]
+        return self.__leaf(index)[index & 31]
+
+    def append(self, value) -> 'Vector':
+        if len(self.__tail) < 32:
+            return Vector(self.__length + 1, self.__shift, self.__root,
+                          self.__tail + (value,))
+
+        # the tail is full, it moves into the trie
+        shift = self.__shift
+        if (self.__length >> 5) > (1 << shift):
+            root = (self.__root, Vector.__new_path(shift, self.__tail))
+            shift += 5
+        else:
+            root = self.__push_tail(shift, self.__root, self.__tail)
+        return Vector(self.__length + 1, shift, root, (value,))
+
+    def __push_tail(self, level: int, parent: tuple, tail: tuple) -> tuple:
+        index = ((self.__length - 1) >> level) & 31
+        if level == 5:
+            child = tail
+        elif index < len(parent):
+            child = self.__push_tail(level - 5, parent[index], tail)
+        else:
+            child = Vector.__new_path(level - 5, tail)
+        return parent[:index] + (child,) + parent[index + 1:]
+
+    @classmethod
+    def __new_path(cls, level: int, node: tuple) -> tuple:
+        while level > 0:
+            node = (node,)
+            level -= 5
+        return node
+
+    def set(self, index: int, value) -> 'Vector':
+        if index < 0:
+            index += self.__length
+        if index < 0 or index >= self.__length:
+            raise IndexError("Vector index out of range")
+        if index >= self.__tail_offset():
+            position = index & 31
+            tail = self.__tail[:position] + (value,) + \
+                self.__tail[position + 1:]
+            return Vector(self.__length, self.__shift, self.__root, tail)
+        return Vector(self.__length, self.__shift,
+                      Vector.__set(self.__shift, self.__root, index, value),
+                      self.__tail)
+
+    @classmethod
+    def __set(cls, level: int, node: tuple, index: int, value) -> tuple:
+        position = (index >> level) & 31
+        if level == 0:
+            child = value
+        else:
+            child = Vector.__set(level - 5, node[position], index, value)
+        return node[:position] + (child,) + node[position + 1:]
+
+    def pop(self) -> 'Vector':
+        """
+        Returns the Vector without its last element.
+        """
+        if self.__length == 0:
+            raise IndexError("pop from empty Vector")
+        if self.__length == 1:
+            return Vector()
+        if len(self.__tail) > 1:
+            return Vector(self.__length - 1, self.__shift, self.__root,
+                          self.__tail[:-1])
+
+        # the last leaf of the trie becomes the tail
+        tail = self.__leaf(self.__length - 2)
+        root = self.__pop_tail(self.__shift, self.__root)
+        shift = self.__shift
+        if root == None:
+            root = ()
+        if shift > 5 and len(root) == 1:
+            root = root[0]
+            shift -= 5
+        return Vector(self.__length - 1, shift, root, tail)
+
+    def __pop_tail(self, level: int, node: tuple):
+        index = ((self.__length - 2) >> level) & 31
+        if level > 5:
+            child = self.__pop_tail(level - 5, node[index])
+            if child == None:
+                return node[:index] if index else None
+            return node[:index] + (child,)
+        return node[:index] if index else None
+
+
+class RopeNode():
+    """
+    An inner node of a Rope. ends holds the total length of the children
+    up to and including each one, to find the child of an index.
+    """
+    __slots__ = ('ends', 'children')
+
+    def __init__(self, ends: tuple, children: tuple) -> None:
+        self.ends = ends
+        self.children = children
+
+    @classmethod
+    def of(cls, children: tuple) -> 'RopeNode':
+        return RopeNode(tuple(itertools.accumulate(
+            Rope.size(child) for child in children)), children)
+
+
+class Rope():
+    """
+    A persistent (immutable) list which can also remove from the middle,
+    a tree of RopeNodes over leaf tuples of at most 32 elements, with the
+    last elements kept in a tail as in a Vector. get, set, append and
+    remove return a new Rope sharing all but O(log n) nodes with the old
+    one.
+    Unlike a Vector, nodes may be partly full: removing an element only
+    shrinks its leaf, which is merged into its neighbour once it is less
+    than half full, and empty nodes are dropped.
+    """
+    __slots__ = ('__root', '__tail')
+    width = 32
+
+    def __init__(self, root=(), tail: tuple = ()) -> None:
+        self.__root = root
+        self.__tail = tail
+
+    @classmethod
+    def size(cls, node) -> int:
+        if type(node) == RopeNode:
+            return node.ends[-1]
+        return len(node)
+
+    def __len__(self) -> int:
+        return Rope.size(self.__root) + len(self.__tail)
+
+    def __iter__(self):
+        stack = [self.__root]
+        while stack:
+            node = stack.pop()
+            if type(node) == RopeNode:
+                stack.extend(reversed(node.children))
+            else:
+                yield from node
+        yield from self.__tail
+
+    def __find(self, index: int) -> int:
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("Rope index out of range")
+        return index
+
+    def get(self, index: int):
+        index = self.__find(index)
+        node = self.__root
+        tail_offset = Rope.size(node)
+        if index >= tail_offset:
+            return self.__tail[index - tail_offset]
+        while type(node) == RopeNode:
+            position = bisect.bisect_right(node.ends, index)
+            if position:
+                index -= node.ends[position - 1]
+            node = node.children[position]
+        return node[index]
+
+    def set(self, index: int, value) -> 'Rope':
+        index = self.__find(index)
+        tail_offset = Rope.size(self.__root)
+        if index >= tail_offset:
+            position = index - tail_offset
+            return Rope(self.__root, self.__tail[:position] + (value,) +
+                        self.__tail[position + 1:])
+        return Rope(Rope.__set(self.__root, index, value), self.__tail)
+
+    @classmethod
+    def __set(cls, node, index: int, value):
+        if type(node) != RopeNode:
+            return node[:index] + (value,) + node[index + 1:]
+        position = bisect.bisect_right(node.ends, index)
+        if position:
+            index -= node.ends[position - 1]
+        children = node.children
+        child = Rope.__set(children[position], index, value)
+        return RopeNode(node.ends, children[:position] + (child,) +
+                        children[position + 1:])
+
+    def append(self, value) -> 'Rope':
+        if len(self.__tail) < Rope.width:
+            return Rope(self.__root, self.__tail + (value,))
+
+        # the tail is full, it moves into the tree
+        if Rope.size(self.__root) == 0:
+            return Rope(self.__tail, (value,))
+        nodes = Rope.__push(self.__root, self.__tail)
+        if len(nodes) == 1:
+            return Rope(nodes[0], (value,))
+        return Rope(RopeNode.of(nodes), (value,))
+
+    @classmethod
+    def __push(cls, node, leaf: tuple) -> tuple:
+        """
+        Returns the node with the leaf added after its last leaf, or the
+        node and a new sibling holding the leaf once the node is full.
+        """
+        if type(node) != RopeNode:
+            return (node, leaf)
+        nodes = Rope.__push(node.children[-1], leaf)
+        ends = node.ends
+        if len(nodes) == 1:
+            return (RopeNode(ends[:-1] + (ends[-1] + len(leaf),),
+                             node.children[:-1] + nodes),)
+        # the last child was full and is unchanged, the leaf is in nodes[1]
+        if len(node.children) < Rope.width:
+            return (RopeNode(ends + (ends[-1] + len(leaf),),
+                             node.children + nodes[1:]),)
+        return (node, RopeNode((len(leaf),), nodes[1:]))
+
+    def remove(self, index: int) -> 'Rope':
+        index = self.__find(index)
+        tail_offset = Rope.size(self.__root)
+        if index >= tail_offset:
+            position = index - tail_offset
+            return Rope(self.__root, self.__tail[:position] +
+                        self.__tail[position + 1:])
+        root = Rope.__remove(self.__root, index)
+        while type(root) == RopeNode and len(root.children) == 1:
+            root = root.children[0]
+        return Rope(root, self.__tail)
+
+    @classmethod
+    def __remove(cls, node, index: int):
+        if type(node) != RopeNode:
+            return node[:index] + node[index + 1:]
+        position = bisect.bisect_right(node.ends, index)
+        if position:
+            index -= node.ends[position - 1]
+        children = node.children
+        child = Rope.__remove(children[position], index)
+        if Rope.size(child) == 0:
+            children = children[:position] + children[position + 1:]
+            if not children:
+                return ()
+            return RopeNode.of(children)
+        if type(child) != RopeNode and len(child) < Rope.width // 2:
+            # merge a small leaf into a neighbouring leaf
+            for neighbour in (position - 1, position + 1):
+                if 0 <= neighbour < len(children) and \
+                        type(children[neighbour]) != RopeNode and \
+                        len(children[neighbour]) + len(child) <= Rope.width:
+                    first = min(position, neighbour)
+                    if neighbour < position:
+                        merged = children[neighbour] + child
+                    else:
+                        merged = child + children[neighbour]
+                    return RopeNode.of(children[:first] + (merged,) +
+                                       children[first + 2:])
+        ends = node.ends
+        return RopeNode(ends[:position] +
+                        tuple(end - 1 for end in ends[position:]),
+                        children[:position] + (child,) +
+                        children[position + 1:])
+
+    @classmethod
+    def of(cls, values) -> 'Rope':
+        """
+        Returns a Rope of the values, built in O(n).
+        """
+        values = tuple(values)
+        nodes = [values[start:start + Rope.width]
+                 for start in range(0, len(values), Rope.width)]
+        if not nodes:
+            return Rope()
+        tail = nodes.pop()
+        while len(nodes) > 1:
+            nodes = [RopeNode.of(tuple(nodes[start:start + Rope.width]))
+                     for start in range(0, len(nodes), Rope.width)]
+        return Rope(nodes[0] if nodes else (), tail)
+
+def to_immutable(value):
+    """
+    Returns the value with every nested Object and Array turned into an
+    ImmutableObject or ImmutableArray, and a NumericArray into a read only
+    copy.
+    """
+    if type(value) == Object:
+        return ImmutableObject.of(value)
+    elif type(value) == Array:
+        return ImmutableArray.of(value)
+    elif type(value) == NumericArray:
+        return value.read_only()
+    return value
+
+
+class ImmutableArray:
+    """
+    An Array which is never changed in place. put, set and remove return a
+    new ImmutableArray sharing structure with the old one, in O(log n).
+    Nested Objects and Arrays are made immutable as they are put.
+    """
+
+    def __init__(self, vector: Rope = None, validate_element=None) -> None:
+        self.__vector = vector if vector != None else Rope()
+        self.__validate_element = validate_element
+
+    def __check(self, value):
+        if not DEFAULT_VALIDATOR.is_valid(value) or \
+                type(value) == NumericArray:
+            raise TypeError("Invalid value type.")
+        value = to_immutable(value)
+        if self.__validate_element != None:
+            try:
+                value = Schema.check(self.__validate_element, value)
+            except TypeError as e:
+                raise Schema.error(e, 'Element') from None
+        return value
+
+    def put(self, value) -> 'ImmutableArray':
+        return ImmutableArray(self.__vector.append(self.__check(value)),
+                              self.__validate_element)
+
+    def set(self, index: int, value) -> 'ImmutableArray':
+        return ImmutableArray(self.__vector.set(index, self.__check(value)),
+                              self.__validate_element)
+
+    def get(self, index: int, value_type=None):
+        value = self.__vector.get(index)
+        if value_type:
+            if type(value) != value_type:
+                raise TypeError("Does not contain given type")
+        return value
+
+    def length(self) -> int:
+        return len(self.__vector)
+
+    def remove(self, index: int) -> 'ImmutableArray':
+        try:
+            vector = self.__vector.remove(index)
+        except IndexError:
+            raise IndexError("ImmutableArray index out of range") from None
+        return ImmutableArray(vector, self.__validate_element)
+
+    def to_string(self) -> str:
+        elements = list()
+        for element in self.__vector:
+            if type(element) == ImmutableArray or \
+                    type(element) == ImmutableObject:
+                element = json.loads(element.to_string())
+            elements.append(element)
+        return json.dumps(elements)
+
+    def bind(self, validate_element,
+             replaced: list = ()) -> 'ImmutableArray':
+        """
+        Returns a copy whose element validator checks each element put into
+        it and the versions made from it, with the (index, element) pairs
+        in replaced set. This version is left as it is.
+        """
+        vector = self.__vector
+        for (index, element) in replaced:
+            vector = vector.set(index, element)
+        return ImmutableArray(vector, validate_element)
+
+    def unbind(self) -> 'ImmutableArray':
+        """
+        Returns a copy without the schema, nor the schemas of the values
+        nested in it.
+        """
+        if self.__validate_element == None:
+            return self
+        vector = self.__vector
+        for (index, element) in enumerate(self.__vector):
+            unbound = Schema.unbind(element)
+            if unbound is not element:
+                vector = vector.set(index, unbound)
+        return ImmutableArray(vector)
+
+    def get_schema(self):
+        return self.__validate_element
+
+    def memory_size(self) -> int:
+        """
+        Counts shared structure in full.
+        """
+        return sys.getsizeof(self) + \
+            sum(memory_size(element) for element in self.__vector)
+
+    def thaw(self) -> Array:
+        """
+        Returns a mutable copy.
+        """
+        return Array.from_string(self.to_string())
+
+    @classmethod
+    def of(cls, source: Array) -> 'ImmutableArray':
+        return ImmutableArray(Rope.of(
+            to_immutable(source.get(index))
+            for index in range(source.length())))
+
+    @classmethod
+    def from_string(cls, array_json: str) -> 'ImmutableArray':
+        return ImmutableArray.of(Array.from_string(array_json))
+
+
+class ImmutableObject:
+    """
+    An Object which is never changed in place. put and remove return a new
+    ImmutableObject sharing structure with the old one, in O(log n).
+    Nested Objects and Arrays are made immutable as they are put.
+    """
+
+    def __init__(self, data: OrderedHashMap = None, fields: dict = None,
+                 required: frozenset = frozenset()) -> None:
+        self.__data = data if data != None else OrderedHashMap()
+        self.__fields = fields
+        self.__required = required
+
+    def put(self, key: str, value) -> 'ImmutableObject':
+        if type(key) != str or not DEFAULT_VALIDATOR.is_valid(value) or \
+                type(value) == NumericArray:
+            raise TypeError("Invalid value type.")
+        value = to_immutable(value)
+        if self.__fields != None and key in self.__fields:
+            try:
+                value = Schema.check(self.__fields[key], value)
+            except TypeError as e:
+                raise Schema.error(e, key) from None
+        return ImmutableObject(self.__data.set(key, value), self.__fields,
+                               self.__required)
+
+    def get(self, key: str, value_type=None):
+        value = self.__data[key]
+        if value_type:
+            if type(value) != value_type:
+                raise TypeError("Does not contain given type")
+        return value
+
+    def length(self) -> int:
+        return len(self.__data)
+
+    def keys(self) -> list:
+        return list(self.__data)
+
+    def remove(self, key: str) -> 'ImmutableObject':
+        if key in self.__required:
+            raise TypeError(key + " is required.")
+        return ImmutableObject(self.__data.delete(key), self.__fields,
+                               self.__required)
+
+    def to_string(self) -> str:
+        data = dict()
+        for (key, value) in self.__data.items():
+            if type(value) == ImmutableArray or \
+                    type(value) == ImmutableObject:
+                value = json.loads(value.to_string())
+            data[key] = value
+        return json.dumps(data)
+
+    def bind(self, fields: dict, required: frozenset,
+             replaced: list = ()) -> 'ImmutableObject':
+        """
+        Returns a copy with the field validators and required fields, for it
+        and the versions made from it, and the (key, value) pairs in
+        replaced set. This version is left as it is.
+        """
+        data = self.__data
+        for (key, value) in replaced:
+            data = data.set(key, value)
+        return ImmutableObject(data, fields, required)
+
+    def unbind(self) -> 'ImmutableObject':
+        """
+        Returns a copy without the schema, nor the schemas of the values
+        nested in it.
+        """
+        if self.__fields == None:
+            return self
+        data = self.__data
+        for (key, value) in self.__data.items():
+            unbound = Schema.unbind(value)
+            if unbound is not value:
+                data = data.set(key, unbound)
+        return ImmutableObject(data)
+
+    def get_schema(self) -> dict:
+        return self.__fields
+
+    def memory_size(self) -> int:
+        """
+        Counts shared structure in full.
+        """
+        return sys.getsizeof(self) + \
+            sum(sys.getsizeof(key) + memory_size(value)
+                for (key, value) in self.__data.items())
+
+    def thaw(self) -> Object:
+        """
+        Returns a mutable copy.
+        """
+        return Object.from_string(self.to_string())
+
+    @classmethod
+    def of(cls, source: Object) -> 'ImmutableObject':
+        return ImmutableObject(OrderedHashMap.of(
+            (key, to_immutable(source.get(key))) for key in source.keys()))
+
+    @classmethod
+    def from_string(cls, object_json: str) -> 'ImmutableObject':
+        return ImmutableObject.of(Object.from_string(object_json))
+
+
+class DatabaseVersion():
+    """
+    A read only view of a BaseDB's data at one point in time, see
+    BaseDB.version.
+    """
+
+    def __init__(self, data: OrderedHashMap) -> None:
+        self.__data = data
+
+    def get(self, key: str, value_type=None):
+        value = self.__data[key]
+        if type(value) == CompressedValue:
+            value = value.thaw()
+        if value_type:
+            if type(value) != value_type:
+                raise TypeError("Does not contain given type.")
+        return value
+
+    def keys(self) -> list:
+        return list(self.__data)
+
+    def length(self) -> int:
+        return len(self.__data)
+
+    def get_json(self) -> str:
+        data = dict()
+        for (key, value) in self.__data.items():
+            if type(value) == ImmutableArray or \
+                    type(value) == ImmutableObject or \
+                    type(value) == CompressedValue:
+                value = json.loads(value.to_string())
+            elif type(value) == NumericArray:
+                value = value.to_list()
+            data[key] = value
+        return json.dumps(data)
+
+
+DEFAULT_VALIDATOR = Validator()
+
+
 class Observer():
     def __init__(self) -> None:
         self.__changes = 0
@@ -610,5 +4070,573 @@ class Cursor():
         self.__observers.remove(o)
 
     def update(self, updated_value) -> None:
-        for observer in self.__observers:
-            observer.update(updated_value)
+        if METRICS.enabled:
+            METRICS.count('observer_notifications', len(self.__observers))
+        notify_all(self.__observers, updated_value)
+
+
+class View():
+    """
+    A materialized view over the values of keys starting with prefix.
+    Views are told about every change, and remember what each key added to
+    them, so a change only updates the groups it touches. Values changed
+    in place are picked up when they are put again.
+    Reading a view goes through get(group), and get_cursor(group) returns
+    a Cursor that is notified when the group's value changes.
+    Keys for which the view's functions raise KeyError, TypeError,
+    AttributeError or IndexError (for example a missing field) are left
+    out. Keys for which they raise anything else are left out too, and the
+    error is raised once every view and cursor has been told of the change.
+    """
+    skipped_errors = (KeyError, TypeError, AttributeError, IndexError)
+
+    def __init__(self, prefix: str = '') -> None:
+        self.__prefix = prefix
+        self.__cursors = dict()
+
+    def change(self, key: str, value) -> None:
+        """
+        Called with the new value of the key, None if it was removed.
+        """
+        if key.startswith(self.__prefix):
+            self.update(key, value)
+
+    def update(self, key: str, value) -> None:
+        pass
+
+    def get(self, group=None, value_type=None):
+        pass
+
+    def get_cursor(self, group=None) -> 'Cursor':
+        cursor = Cursor(self, group)
+        if not group in self.__cursors:
+            self.__cursors[group] = list()
+        self.__cursors[group].append(cursor)
+        return cursor
+
+    def watched_groups(self) -> list:
+        """
+        Returns the groups which have cursors.
+        """
+        return list(self.__cursors)
+
+    def notify(self, group) -> None:
+        """
+        Passes the group's new value to its cursors.
+        """
+        if group in self.__cursors:
+            value = self.get(group)
+            notify_all(self.__cursors[group], value)
+
+
+class FilterView(View):
+    """
+    The set of keys whose value matches the predicate.
+    The keys are held in a KeySet, so get() and the cursors are given the
+    current keys without copying them.
+    """
+
+    def __init__(self, predicate, prefix: str = '') -> None:
+        super().__init__(prefix)
+        self.__predicate = predicate
+        self.__keys = KeySet()
+
+    def update(self, key: str, value) -> None:
+        matches = False
+        if value != None:
+            try:
+                matches = bool(self.__predicate(value))
+            except View.skipped_errors:
+                matches = False
+        if matches == (key in self.__keys):
+            return
+        if matches:
+            self.__keys = self.__keys.add(key)
+        else:
+            self.__keys = self.__keys.discard(key)
+        self.notify(None)
+
+    def get(self, group=None, value_type=None) -> KeySet:
+        return self.__keys
+
+    def contains(self, key: str) -> bool:
+        return key in self.__keys
+
+    def length(self) -> int:
+        return len(self.__keys)
+
+
+class AggregateView(View):
+    """
+    A number per group, from what each key adds to its group.
+    group_by returns the group of a value, all values are in the group
+    None if it is not given.
+    """
+
+    def __init__(self, group_by=None, prefix: str = '') -> None:
+        super().__init__(prefix)
+        self.__group_by = group_by
+        self.__contributions = dict()
+        self.__totals = dict()
+
+    def amount(self, value):
+        """
+        Returns what the value adds to its group.
+        """
+        pass
+
+    def update(self, key: str, value) -> None:
+        contribution = None
+        if value != None:
+            try:
+                group = None
+                if self.__group_by != None:
+                    group = self.__group_by(value)
+                amount = self.amount(value)
+                if amount != None:
+                    contribution = (group, amount)
+            except View.skipped_errors:
+                contribution = None
+
+        old_contribution = self.__contributions.pop(key, None)
+        if contribution == old_contribution:
+            if contribution != None:
+                self.__contributions[key] = contribution
+            return
+        if old_contribution != None:
+            (old_group, old_amount) = old_contribution
+            self.__add(old_group, -old_amount, -1)
+        if contribution != None:
+            self.__contributions[key] = contribution
+            self.__add(contribution[0], contribution[1], 1)
+
+        if old_contribution != None:
+            self.notify(old_contribution[0])
+        if contribution != None and (old_contribution == None or
+                                     contribution[0] != old_contribution[0]):
+            self.notify(contribution[0])
+
+    def __add(self, group, amount, keys: int) -> None:
+        (total, count) = self.__totals.get(group, (0, 0))
+        if count + keys == 0:
+            del self.__totals[group]
+        else:
+            self.__totals[group] = (total + amount, count + keys)
+
+    def get(self, group=None, value_type=None):
+        return self.__totals.get(group, (0, 0))[0]
+
+    def groups(self) -> list:
+        return list(self.__totals)
+
+
+class CountView(AggregateView):
+    """
+    The number of keys in each group, counting only values that match the
+    predicate if one is given.
+    """
+
+    def __init__(self, group_by=None, predicate=None,
+                 prefix: str = '') -> None:
+        super().__init__(group_by, prefix)
+        self.__predicate = predicate
+
+    def amount(self, value):
+        if self.__predicate != None and not self.__predicate(value):
+            return None
+        return 1
+
+
+class SumView(AggregateView):
+    """
+    The sum of value_of(value) over the keys in each group.
+    """
+
+    def __init__(self, value_of, group_by=None, prefix: str = '') -> None:
+        super().__init__(group_by, prefix)
+        self.__value_of = value_of
+
+    def amount(self, value):
+        amount = self.__value_of(value)
+        if type(amount) != int and type(amount) != float:
+            raise TypeError("Not a number.")
+        return amount
+
+
+class TopView(View):
+    """
+    The n keys with the highest score_of(value), as a list of
+    [key, score] pairs, highest first.
+    Every key with a score is ranked, in a ChunkedList, so a change is
+    O(log n) and reading the top is O(n).
+    """
+
+    def __init__(self, n: int, score_of, prefix: str = '') -> None:
+        super().__init__(prefix)
+        self.__n = n
+        self.__score_of = score_of
+        self.__scores = dict()
+        # (-score, key) pairs in ascending order, so the top is at the front
+        self.__ranking = ChunkedList()
+
+    def update(self, key: str, value) -> None:
+        score = None
+        if value != None:
+            try:
+                score = self.__score_of(value)
+            except View.skipped_errors:
+                score = None
+
+        old_score = self.__scores.get(key)
+        if score == old_score:
+            return
+
+        changed_top = False
+        if old_score != None:
+            index = self.__ranking.bisect_left((-old_score, key))
+            self.__ranking.pop(index)
+            del self.__scores[key]
+            changed_top = index < self.__n
+        if score != None:
+            index = self.__ranking.bisect_left((-score, key))
+            self.__ranking.insert(index, (-score, key))
+            self.__scores[key] = score
+            changed_top = changed_top or index < self.__n
+        if changed_top:
+            self.notify(None)
+
+    def get(self, group=None, value_type=None) -> list:
+        return [[key, -score] for (score, key)
+                in itertools.islice(self.__ranking, self.__n)]
+
+
+class PostingList():
+    """
+    A set of document ids held compressed. The sorted ids are split into
+    blocks of block_size, and each block keeps its first id and the gaps
+    to the next ids in the smallest array type they fit.
+    Changes go to small added and removed sets, which are folded into the
+    blocks once they grow past an eighth of the list.
+    """
+    block_size = 128
+    typecodes = ('B', 'H', 'I', 'Q')
+
+    def __init__(self) -> None:
+        self.__blocks = list()
+        # the first id of each block, to find the block of an id
+        self.__firsts = list()
+        self.__block_length = 0
+        self.__added = set()
+        self.__removed = set()
+
+    def __len__(self) -> int:
+        return self.__block_length + len(self.__added) - len(self.__removed)
+
+    def add(self, doc_id: int) -> None:
+        if doc_id in self.__removed:
+            self.__removed.discard(doc_id)
+        else:
+            self.__added.add(doc_id)
+        self.__compact_if_needed()
+
+    def remove(self, doc_id: int) -> None:
+        if doc_id in self.__added:
+            self.__added.discard(doc_id)
+        else:
+            self.__removed.add(doc_id)
+        self.__compact_if_needed()
+
+    def ids(self) -> set:
+        doc_ids = set()
+        for block in self.__blocks:
+            doc_ids.update(PostingList.__decode(block))
+        if self.__removed:
+            doc_ids.difference_update(self.__removed)
+        doc_ids.update(self.__added)
+        return doc_ids
+
+    def intersection(self, doc_ids: set) -> set:
+        """
+        Returns the ids which are both in doc_ids and the list. When there
+        are few doc_ids only the blocks they fall in are decoded.
+        """
+        if len(doc_ids) * 16 > len(self):
+            return doc_ids & self.ids()
+        found = set()
+        blocks = dict()
+        for doc_id in doc_ids:
+            if doc_id in self.__added:
+                found.add(doc_id)
+                continue
+            if doc_id in self.__removed:
+                continue
+            index = bisect.bisect_right(self.__firsts, doc_id) - 1
+            if index < 0:
+                continue
+            block = blocks.get(index)
+            if block == None:
+                block = set(PostingList.__decode(self.__blocks[index]))
+                blocks[index] = block
+            if doc_id in block:
+                found.add(doc_id)
+        return found
+
+    @classmethod
+    def __decode(cls, block: tuple):
+        (first, typecode, data) = block
+        gaps = array.array(typecode)
+        gaps.frombytes(data)
+        return itertools.accumulate(gaps, initial=first)
+
+    def size(self) -> int:
+        """
+        Returns the number of bytes of the compressed blocks.
+        """
+        return sum(len(data) + 8 for (first, typecode, data) in self.__blocks)
+
+    def __compact_if_needed(self) -> None:
+        pending = len(self.__added) + len(self.__removed)
+        if pending > 32 and pending * 8 > self.__block_length:
+            self.__compact()
+
+    def __compact(self) -> None:
+        doc_ids = sorted(self.ids())
+        blocks = list()
+        for start in range(0, len(doc_ids), PostingList.block_size):
+            block = doc_ids[start:start + PostingList.block_size]
+            gaps = [later - earlier
+                    for (earlier, later) in zip(block, block[1:])]
+            widest = max(gaps, default=0)
+            for typecode in PostingList.typecodes:
+                if widest < 1 << (8 * array.array(typecode).itemsize):
+                    break
+            blocks.append((block[0], typecode,
+                           array.array(typecode, gaps).tobytes()))
+        self.__blocks = blocks
+        self.__firsts = [block[0] for block in blocks]
+        self.__block_length = len(doc_ids)
+        self.__added = set()
+        self.__removed = set()
+
+
+class TextIndex(View):
+    """
+    An inverted index of the words in the string values of keys starting
+    with prefix. fields lists the field paths to index, 'address.city' is
+    the 'city' field of the Object at 'address' and paths go through
+    Arrays to each element. Without fields every string in the value is
+    indexed.
+    Words are lower cased runs of letters and digits.
+    get(query) returns the keys matching the query, see search. The
+    results of queries with cursors are kept as KeySets, and a change only
+    checks whether the changed key matches each of them.
+    """
+    word = re.compile(r'\w+')
+
+    def __init__(self, fields: list = None, prefix: str = '') -> None:
+        super().__init__(prefix)
+        self.__paths = None
+        if fields != None:
+            self.__paths = [field.split('.') for field in fields]
+        self.__postings = dict()
+        # the terms in order, for prefix queries
+        self.__terms = list()
+        self.__key_ids = dict()
+        self.__keys = list()
+        # ids of keys which left the index, given to the next new keys
+        self.__free_ids = list()
+        self.__key_terms = dict()
+        # query -> (parsed query, KeySet of its results), for cursors
+        self.__watched = dict()
+
+    @classmethod
+    def tokenize(cls, text: str) -> list:
+        return TextIndex.word.findall(text.lower())
+
+    def terms_of(self, value) -> set:
+        """
+        Returns the words of the indexed strings of the value.
+        """
+        strings = list()
+        if self.__paths == None:
+            TextIndex.__strings(value, [], strings)
+        else:
+            for path in self.__paths:
+                TextIndex.__strings(value, path, strings)
+        terms = set()
+        for string in strings:
+            terms.update(TextIndex.tokenize(string))
+        return terms
+
+    @classmethod
+    def __strings(cls, value, path: list, strings: list) -> None:
+        """
+        Adds the strings found at the path in the value to strings.
+        """
+        value_type = type(value)
+        if value_type == Array or value_type == ImmutableArray:
+            for index in range(value.length()):
+                TextIndex.__strings(value.get(index), path, strings)
+        elif value_type == Object or value_type == ImmutableObject:
+            if path:
+                if path[0] in value.keys():
+                    TextIndex.__strings(value.get(path[0]), path[1:],
+                                        strings)
+            else:
+                for field in value.keys():
+                    TextIndex.__strings(value.get(field), path, strings)
+        elif value_type == str and not path:
+            strings.append(value)
+
+    def update(self, key: str, value) -> None:
+        old_terms = self.__key_terms.get(key, frozenset())
+        new_terms = frozenset()
+        if value != None:
+            new_terms = frozenset(self.terms_of(value))
+        if new_terms == old_terms:
+            return
+
+        key_id = self.__key_ids.get(key)
+        if key_id == None:
+            if self.__free_ids:
+                key_id = self.__free_ids.pop()
+                self.__keys[key_id] = key
+            else:
+                key_id = len(self.__keys)
+                self.__keys.append(key)
+            self.__key_ids[key] = key_id
+        for term in old_terms - new_terms:
+            postings = self.__postings[term]
+            postings.remove(key_id)
+            if len(postings) == 0:
+                del self.__postings[term]
+                del self.__terms[bisect.bisect_left(self.__terms, term)]
+        for term in new_terms - old_terms:
+            postings = self.__postings.get(term)
+            if postings == None:
+                postings = PostingList()
+                self.__postings[term] = postings
+                bisect.insort(self.__terms, term)
+            postings.add(key_id)
+
+        if new_terms:
+            self.__key_terms[key] = new_terms
+        else:
+            # its postings are all removed, so the id can be reused
+            del self.__key_terms[key]
+            del self.__key_ids[key]
+            self.__keys[key_id] = None
+            self.__free_ids.append(key_id)
+        for (query, (alternatives, results)) in list(self.__watched.items()):
+            matches = TextIndex.__matches(alternatives, new_terms)
+            if matches != (key in results):
+                results = results.add(key) if matches \
+                    else results.discard(key)
+                self.__watched[query] = (alternatives, results)
+                self.notify(query)
+
+    @classmethod
+    def parse(cls, query: str) -> list:
+        """
+        Returns the alternatives of the query, each a list of (term,
+        is_prefix) pairs which must all match.
+        """
+        alternatives = list()
+        for alternative in re.split(r'\s+OR\s+', query.strip()):
+            conditions = list()
+            for word in alternative.split():
+                if word.endswith('*'):
+                    conditions.extend((prefix, True) for prefix
+                                      in TextIndex.tokenize(word[:-1]))
+                else:
+                    conditions.extend((term, False) for term
+                                      in TextIndex.tokenize(word))
+            alternatives.append(conditions)
+        return alternatives
+
+    @classmethod
+    def __matches(cls, alternatives: list, terms: frozenset) -> bool:
+        """
+        Returns whether a document with the terms matches the parsed query.
+        """
+        for conditions in alternatives:
+            if conditions and all(
+                    any(term.startswith(word) for term in terms)
+                    if is_prefix else word in terms
+                    for (word, is_prefix) in conditions):
+                return True
+        return False
+
+    def search(self, query: str) -> frozenset:
+        """
+        Returns the keys matching the query. Words separated by spaces must
+        all match, 'OR' separates alternatives, and a word ending in '*'
+        matches every word starting with it: 'san diego OR los*'.
+        """
+        doc_ids = set()
+        for conditions in TextIndex.parse(query):
+            doc_ids.update(self.__search_all(conditions))
+        return frozenset(self.__keys[doc_id] for doc_id in doc_ids)
+
+    def __search_all(self, conditions: list) -> set:
+        """
+        Returns the ids of the documents matching every condition.
+        """
+        matches = list()
+        for (word, is_prefix) in conditions:
+            if is_prefix:
+                matches.append(self.__prefix_postings(word))
+            else:
+                matches.append([self.__postings.get(word)])
+        if not matches:
+            return set()
+
+        # start with the shortest lists, so the sets stay small
+        matches.sort(key=lambda postings_lists: sum(
+            len(postings) for postings in postings_lists
+            if postings != None))
+        doc_ids = None
+        for postings_lists in matches:
+            found = set()
+            for postings in postings_lists:
+                if postings == None:
+                    continue
+                if doc_ids == None:
+                    found.update(postings.ids())
+                else:
+                    found.update(postings.intersection(doc_ids))
+            doc_ids = found
+            if not doc_ids:
+                break
+        return doc_ids
+
+    def __prefix_postings(self, prefix: str) -> list:
+        postings_lists = list()
+        index = bisect.bisect_left(self.__terms, prefix)
+        while index < len(self.__terms) and \
+                self.__terms[index].startswith(prefix):
+            postings_lists.append(self.__postings[self.__terms[index]])
+            index += 1
+        return postings_lists
+
+    def get(self, group=None, value_type=None):
+        watched = self.__watched.get(group)
+        if watched != None:
+            return watched[1]
+        return self.search(group if group != None else '')
+
+    def get_cursor(self, group=None) -> 'Cursor':
+        if not group in self.__watched:
+            query = group if group != None else ''
+            self.__watched[group] = (TextIndex.parse(query),
+                                     KeySet(self.search(query)))
+        return super().get_cursor(group)
+
+    def memory_size(self) -> int:
+        """
+        Returns the approximate number of bytes of the posting lists and
+        of the table of key ids.
+        """
+        return sum(sys.getsizeof(term) + postings.size()
+                   for (term, postings) in self.__postings.items()) + \
+            sys.getsizeof(self.__keys) + sys.getsizeof(self.__free_ids)
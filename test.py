@@ -1,6 +1,24 @@
+import os
+import random
+import time
 import unittest
 from database import *
 
+import benchmark
+
+
+class ValueObserver(Observer):
+    """
+    Records every value it is updated with.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.values = []
+
+    def update(self, updated_value) -> None:
+        self.values.append(updated_value)
+
 
 class TestDB(unittest.TestCase):
     def setUp(self):
@@ -104,6 +122,148 @@ class TestDB(unittest.TestCase):
         self.assertRaises(KeyError, self.database_decorator.get,
                           'Non Existent Key')
 
+    def test_basedb_put_ttl(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        database.put('Key', 5, ttl=10)
+        self.assertEqual(database.get('Key'), 5)
+        clock[0] = 110.0
+        self.assertRaises(KeyError, database.get, 'Key')
+
+    def test_basedb_put_without_ttl_clears_expiry(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        database.put('Key', 5, ttl=10)
+        database.put('Key', 6)
+        clock[0] = 200.0
+        self.assertEqual(database.get('Key'), 6)
+        self.assertEqual(database.get_expiry('Key'), None)
+
+    def test_basedb_expire(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        database.put('Key1', 1, ttl=5)
+        database.put('Key2', 2, ttl=50)
+        clock[0] = 120.0
+        self.assertEqual(database.expire(), ['Key1'])
+        self.assertEqual(database.get_json(), '{"Key2": 2}')
+
+    def test_basedb_expire_within_bucket(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        database.put('Key1', 1, ttl=0.25)
+        database.put('Key2', 2, ttl=0.75)
+        clock[0] = 100.5
+        self.assertRaises(KeyError, database.get, 'Key1')
+        self.assertEqual(database.get_json(), '{"Key2": 2}')
+        self.assertEqual(database.get_expiries(), {'Key2': 100.75})
+        clock[0] = 100.75
+        self.assertEqual(database.expire(), ['Key2'])
+        self.assertEqual(database.get_json(), '{}')
+
+    def test_basedb_expire_large_current_bucket(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        for i in range(20000):
+            database.put('Key' + str(i), i, ttl=0.9)
+        database.put('Early', 1, ttl=0.25)
+        database.put('Moved', 1, ttl=0.25)
+        clock[0] = 100.2
+        database.put('Moved', 2, ttl=0.6)
+        clock[0] = 100.5
+        start = time.perf_counter()
+        for i in range(1000):
+            database.put('Other', i)
+        # checking the 20000 keys on every put takes seconds
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertRaises(KeyError, database.get, 'Early')
+        self.assertEqual(database.get('Moved'), 2)
+        clock[0] = 100.85
+        self.assertEqual(database.expire(), ['Moved'])
+        clock[0] = 100.95
+        self.assertEqual(len(database.expire()), 20000)
+
+    def test_basedb_expiry_notifies_cursor(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        database.put('Key', 1, ttl=5)
+        cursor = database.get_cursor('Key')
+        observer = ValueObserver()
+        cursor.add_observer(observer)
+        clock[0] = 106.0
+        database.expire()
+        self.assertEqual(observer.values, [None])
+
+    def test_persistentdb_recover_expired(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        clock = [100.0]
+        database = PersistentDB(BaseDB(clock=lambda: clock[0]),
+                                command_file, snapshot_file)
+        database.put('Key', 1)
+        database.snapshot()
+        database.put('Session', 'abc', ttl=10)
+        database.put('Cache', 'xyz', ttl=3600)
+
+        clock[0] = 111.0
+        recovered_database = PersistentDB.recover(
+            command_file, snapshot_file,
+            database=BaseDB(clock=lambda: clock[0]))
+        self.assertEqual(recovered_database.get('Key'), 1)
+        self.assertEqual(recovered_database.get('Cache'), 'xyz')
+        self.assertRaises(KeyError, recovered_database.get, 'Session')
+
+    def test_persistentdb_recover_expired_key_order(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        clock = [100.0]
+        database = PersistentDB(BaseDB(clock=lambda: clock[0]),
+                                command_file, snapshot_file)
+        database.snapshot()
+        database.put('a', 1, ttl=5)
+        database.put('b', 2)
+        clock[0] = 106.0
+        database.put('c', 3)
+        database.put('a', 4)
+        self.assertEqual(database.get_json(), '{"b": 2, "c": 3, "a": 4}')
+        recovered_database = PersistentDB.recover(
+            command_file, snapshot_file,
+            database=BaseDB(clock=lambda: clock[0]))
+        self.assertEqual(recovered_database.get_json(), database.get_json())
+
+    def test_persistentdb_snapshot_keeps_expiry(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.put('Key', 1, ttl=3600)
+        database.snapshot()
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get('Key'), 1)
+        self.assertEqual(recovered_database.get_cursor('Key').get(), 1)
+
+    def test_persistentdb_default_database(self):
+        first = PersistentDB(command_file='test_commands.txt',
+                             snapshot_file='test_snapshot.txt')
+        second = PersistentDB(command_file='test_commands.txt',
+                              snapshot_file='test_snapshot.txt')
+        first.put('Key', 1)
+        self.assertRaises(KeyError, second.get, 'Key')
+
+    def test_persistentdb_logs_expiry_once(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0])
+        PersistentDB(database, command_file, snapshot_file).snapshot()
+        wrapper = PersistentDB(database, command_file, snapshot_file)
+        wrapper.put('Key', 1, ttl=5)
+        clock[0] = 106.0
+        database.expire()
+        records = list(CommandLog(command_file).read())
+        self.assertEqual([record[0] for record in records],
+                         ['PutCommand', 'ExpireCommand'])
+
     def test_persistentdb_get_cursor(self):
         self.database_decorator.put('Key', 1)
         cursor = self.database_decorator.get_cursor('Key')
@@ -150,7 +310,256 @@ class TestDB(unittest.TestCase):
         with open(snapshot_file) as file:
             for line in file:
                 database_json = json.loads(line)
-                self.assertEqual(database_json, {"Key": 1000})
+                self.assertEqual(database_json, ["Key", 1000])
+
+    def test_persistentdb_recover_legacy_snapshot(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        with open(command_file, 'w') as file:
+            pass
+        with open(snapshot_file, 'w') as file:
+            file.write(json.dumps({'Key': 1, 'Object': {'a': [1, 2]}}))
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get('Object').get('a').length(), 2)
+        self.assertEqual(recovered_database.get('Key'), 1)
+
+    def test_persistentdb_export_import(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file,
+                                LzmaCodec())
+        database.put('Key', 1, ttl=1000)
+        database.put('Object', Object.from_string('{"a": [1, 2]}'))
+        database.put('Numbers', NumericArray('int64', [1, 2]))
+        lines = list(database.export_iter())
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[1]), ['Object', {'a': [1, 2]}])
+
+        imported = PersistentDB(BaseDB(), command_file, snapshot_file,
+                                LzmaCodec())
+        self.assertEqual(imported.import_stream(iter(lines), batch_size=2), 3)
+        self.assertEqual(os.path.getsize(command_file), 0)
+        recovered_base = BaseDB()
+        recovered_database = PersistentDB.recover(command_file, snapshot_file,
+                                                  LzmaCodec(),
+                                                  database=recovered_base)
+        self.assertEqual(recovered_database.get_json(), database.get_json())
+        self.assertEqual(type(recovered_database.get('Numbers')), NumericArray)
+        self.assertEqual(recovered_base.get_expiry('Key'),
+                         json.loads(lines[0])[2])
+
+        with self.assertRaises(ValueError) as context:
+            imported.import_stream(['["a", 1]', '["b", '])
+        self.assertIn('line 2', str(context.exception))
+        with self.assertRaises(ValueError):
+            imported.import_stream(['["c", 1]', '["d", '], batch_size=1)
+        self.assertEqual(imported.get('c'), 1)
+        recovered_database = PersistentDB.recover(command_file, snapshot_file,
+                                                  LzmaCodec(),
+                                                  database=BaseDB())
+        self.assertEqual(recovered_database.get_json(), imported.get_json())
+
+    def test_persistentdb_recover_compressed(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        codec = ZlibCodec(min_size=64)
+        database = PersistentDB(BaseDB(), command_file, snapshot_file, codec)
+        database.put('Key', 1)
+        database.snapshot()
+        phones = Array.from_string(json.dumps(['619-594-3535'] * 20))
+        database.put('Phones', phones)
+        database.put('Key2', 2)
+
+        with open(command_file) as file:
+            records = [line.split(' ', 2)[2] for line in file]
+        self.assertTrue(records[0].startswith('z:'))
+        self.assertTrue(records[1].startswith('['))
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file,
+                                                  codec)
+        self.assertEqual(recovered_database.get_json(), json.dumps(
+            {'Key': 1, 'Phones': ['619-594-3535'] * 20, 'Key2': 2}))
+
+        # an older log has the same records unframed
+        with open(command_file, 'w') as file:
+            file.write(''.join(records))
+        recovered_database = PersistentDB.recover(command_file, snapshot_file,
+                                                  codec)
+        self.assertEqual(recovered_database.get_json(), json.dumps(
+            {'Key': 1, 'Phones': ['619-594-3535'] * 20, 'Key2': 2}))
+        with open(command_file, 'w') as file:
+            file.write(records[1] + records[0][:20])
+        recovered_database = PersistentDB.recover(command_file, snapshot_file,
+                                                  codec)
+        self.assertEqual(recovered_database.get_json(), '{"Key": 1, "Key2": 2}')
+
+    def test_zlib_codec_dictionary(self):
+        samples = [json.dumps({'name': name, 'address': '123 main street',
+                               'balance': 10}) for name in ['Bill', 'Roger']]
+        dictionary = ZlibCodec.train_dictionary(samples)
+        self.assertIn(b'"address": ', dictionary)
+
+        codec = ZlibCodec(dictionary=dictionary)
+        data = json.dumps({'name': 'Ann', 'address': '123 main street',
+                           'balance': 5}).encode()
+        self.assertLess(len(codec.compress(data)),
+                        len(ZlibCodec().compress(data)))
+        self.assertEqual(codec.decompress(codec.compress(data)), data)
+
+    def test_lzma_codec(self):
+        codec = LzmaCodec()
+        data = b'{"Key": "value"}' * 100
+        self.assertEqual(codec.decompress(codec.compress(data)), data)
+
+    def test_basedb_freeze_cold(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0],
+                          cold_codec=ZlibCodec(min_size=10))
+        object_data = {"name": "Bill", "phones": ["619-594-3535"]}
+        database.put('Cold', Object.from_string(json.dumps(object_data)))
+        database.put('Small', Array())
+        clock[0] = 200.0
+        database.put('Hot', Object.from_string(json.dumps(object_data)))
+
+        self.assertEqual(database.freeze_cold(50), ['Cold'])
+        self.assertEqual(json.loads(database.get_json())['Cold'], object_data)
+        self.assertEqual(database.get('Cold', Object).to_string(),
+                         json.dumps(object_data))
+
+    def test_basedb_freeze_detaches_references(self):
+        database = BaseDB(cold_codec=ZlibCodec(min_size=10))
+        database.put('Cold', Object.from_string('{"name": "Bill"}'))
+        held = database.get('Cold')
+        database.freeze('Cold')
+
+        # the thawed value is a new Object, the held one is no longer stored
+        held.put('name', 'Roger')
+        self.assertIsNot(database.get('Cold'), held)
+        self.assertEqual(database.get('Cold').get('name'), 'Bill')
+        database.put('Cold', held)
+        self.assertEqual(database.get('Cold').get('name'), 'Roger')
+
+    def test_put_command_keeps_old_value_frozen(self):
+        database = BaseDB(cold_codec=ZlibCodec(min_size=10))
+        database.put('Cold', Object.from_string('{"name": "Bill"}'))
+        database.freeze('Cold')
+        transaction = Transaction(database, 'test_commands.txt')
+        transaction.put('Cold', 5)
+        self.assertEqual(type(database.peek('Cold')), int)
+        transaction.abort()
+        self.assertEqual(database.get('Cold', Object).get('name'), 'Bill')
+
+        database.freeze('Cold')
+        command = PutCommand('test_commands.txt', database, 'Cold', 6)
+        self.assertEqual(type(database.peek('Cold')), CompressedValue)
+        command.execute()
+        command.undo()
+        self.assertEqual(database.get('Cold', Object).get('name'), 'Bill')
+
+    def test_persistentdb_recover_torn_record(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.snapshot()
+        database.put('Key1', 1)
+        database.put('Key2', 2)
+        with open(command_file, 'rb+') as file:
+            file.truncate(os.path.getsize(command_file) - 3)
+
+        self.assertRaises(ValueError, PersistentDB.recover, command_file,
+                          snapshot_file, strict=True)
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(), '{"Key1": 1}')
+
+        # the torn record is cut off, so new records follow the valid ones
+        recovered_database.put('Key3', 3)
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(),
+                         '{"Key1": 1, "Key3": 3}')
+
+        # a tail torn after the first byte of a frame header
+        with open(command_file, 'ab') as file:
+            file.write(b'0')
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(),
+                         '{"Key1": 1, "Key3": 3}')
+
+        # a record whose header is corrupt ends recovery there
+        recovered_database.put('Key4', 4)
+        recovered_database.put('Key5', 5)
+        with open(command_file, 'rb') as file:
+            lines = file.read().split(b'\n')
+        lines[2] = b'x' + lines[2][1:]
+        with open(command_file, 'wb') as file:
+            file.write(b'\n'.join(lines))
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(),
+                         '{"Key1": 1, "Key3": 3}')
+
+    def test_persistentdb_recover_corrupt_record(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.snapshot()
+        database.put('Key1', 1)
+        database.put('Key2', 2)
+        with open(command_file, 'rb') as file:
+            data = file.read()
+        with open(command_file, 'wb') as file:
+            file.write(data.replace(b'"Key2", 2', b'"Key2", 3'))
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(), '{"Key1": 1}')
+
+    def test_command_log_parallel_verify(self):
+        command_log = CommandLog('test_commands.txt')
+        command_log.reset([['PutCommand', 'Key' + str(i), i]
+                           for i in range(1000)])
+        size = os.path.getsize('test_commands.txt')
+        with open('test_commands.txt', 'ab') as file:
+            file.write(b'0000')
+
+        default_size = CommandLog.parallel_size
+        CommandLog.parallel_size = 0
+        try:
+            self.assertEqual(command_log.verify(workers=4), size)
+        finally:
+            CommandLog.parallel_size = default_size
+
+    def test_persistentdb_recover_final_state(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.put('Key1', 1)
+        database.put('Key2', 2)
+        database.snapshot()
+        database.put('Key3', 3)
+        database.remove('Key1')
+        database.put('Key2', 20)
+        database.put('Key1', 10)
+        database.remove('Key3')
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get_json(), database.get_json())
+
+    def test_persistentdb_recover_parallel(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.snapshot()
+        for i in range(300):
+            database.put('Key' + str(i % 50), i)
+            if i % 7 == 0:
+                database.remove('Key' + str(i % 50))
+
+        default_size = CommandLog.parallel_size
+        CommandLog.parallel_size = 0
+        try:
+            recovered_database = PersistentDB.recover(command_file,
+                                                      snapshot_file, workers=3)
+        finally:
+            CommandLog.parallel_size = default_size
+        self.assertEqual(recovered_database.get_json(), database.get_json())
 
     def test_put_command_execute(self):
         command = PutCommand('test_commands.txt', self.database, 'Key', 5)
@@ -327,6 +736,771 @@ class TestDB(unittest.TestCase):
         test_array.put(2)
         self.assertEqual(test_array.to_string(), '[1, 2]')
 
+    def test_schema_put(self):
+        self.database.set_schema('account:', Schema(
+            {'name': 'string', 'balance': 'number', 'phones': ['string']},
+            required=['name']))
+        account = Object.from_string(json.dumps(
+            {'name': 'Bill', 'balance': 1234.05, 'phones': ['619-594-3535']}))
+        self.database.put('account:1', account)
+        self.database.put('other', Object())
+        self.assertEqual(self.database.get('account:1'), account)
+
+    def test_schema_put_fail(self):
+        self.database.set_schema('account:', Schema(
+            {'name': 'string', 'phones': ['string']}, required=['name']))
+        self.assertRaises(TypeError, self.database.put, 'account:1', 5)
+        self.assertRaises(TypeError, self.database.put, 'account:1',
+                          Object.from_string('{"balance": 5}'))
+        with self.assertRaisesRegex(TypeError, r'account:1\.phones\[1\]'):
+            self.database.put('account:1', Object.from_string(
+                '{"name": "Bill", "phones": ["619-594-3535", 5]}'))
+
+    def test_schema_longest_prefix(self):
+        self.database.set_schema('a', 'string')
+        self.database.set_schema('ab', 'int')
+        self.database.put('ab1', 5)
+        self.database.put('ac1', 'text')
+        self.assertRaises(TypeError, self.database.put, 'ab2', 'text')
+
+    def test_schema_set_checks_stored_values(self):
+        self.database.put('count:1', 'one')
+        self.assertRaises(TypeError, self.database.set_schema, 'count:', 'int')
+
+    def test_schema_nested_put(self):
+        self.database.set_schema('account:', Schema(
+            {'name': 'string', 'phones': ['string']}, required=['name']))
+        account = Object.from_string(json.dumps(
+            {'name': 'Bill', 'phones': ['619-594-3535']}))
+        self.database.put('account:1', account)
+
+        account.put('name', 'Roger')
+        account.get('phones').put('619-594-0000')
+        self.assertRaises(TypeError, account.put, 'name', 5)
+        self.assertRaises(TypeError, account.get('phones').put, 5)
+        self.assertRaises(TypeError, account.remove, 'name')
+        self.assertEqual(account.get('name'), 'Roger')
+        self.assertEqual(account.get('phones').length(), 2)
+
+    def test_schema_rejected_put_binds_nothing(self):
+        self.database.set_schema('account:', Schema(
+            {'address': {'city': 'string'}, 'balance': 'int'}))
+        account = Object.from_string(json.dumps(
+            {'address': {'city': 'San Diego'}, 'balance': 'a lot'}))
+        self.assertRaises(TypeError, self.database.put, 'account:1', account)
+        account.get('address').put('city', 92182)
+
+        # set_schema binds nothing unless every stored value passes
+        self.database.put('user:1', Object.from_string(
+            '{"address": {"city": "San Diego"}}'))
+        self.database.put('user:2', Object.from_string('{"balance": 5}'))
+        self.assertRaises(TypeError, self.database.set_schema, 'user:',
+                          Schema({'address': 'object'}, required=['address']))
+        self.database.get('user:1').remove('address')
+
+    def test_persistentdb_rejected_put_not_logged(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.snapshot()
+        database.set_schema('user:', Schema({'age': 'int'}, ['age']))
+        self.assertRaises(TypeError, database.put, 'user:1',
+                          Object.from_string('{"name": "x"}'))
+        self.assertRaises(TypeError, database.put, 'user:2', (1, 2))
+        database.put('user:3', Object.from_string('{"age": 3}'))
+        recovered = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered.get_json(), database.get_json())
+        schema_base = BaseDB()
+        schema_base.set_schema('user:', Schema({'age': 'int'}, ['age']))
+        recovered = PersistentDB.recover(command_file, snapshot_file,
+                                         database=schema_base)
+        self.assertEqual(recovered.get_json(), '{"user:3": {"age": 3}}')
+        os.remove(command_file)
+        os.remove(snapshot_file)
+
+    def test_schema_unbound_on_remove(self):
+        self.database.set_schema('account:', Schema(
+            {'name': 'string', 'phones': ['string']}, required=['name']))
+        first = Object.from_string(json.dumps(
+            {'name': 'Bill', 'phones': ['619-594-3535']}))
+        second = Object.from_string(json.dumps({'name': 'Roger'}))
+        self.database.put('account:1', first)
+        self.database.put('account:2', second)
+
+        # the value left its key, so it is no longer checked
+        self.database.remove('account:1')
+        first.remove('name')
+        first.get('phones').put(5)
+
+        # nor are the values under a removed schema
+        self.database.remove_schema('account:')
+        second.remove('name')
+        second.put('phones', 5)
+        self.database.put('account:3', Object.from_string('{"phones": 5}'))
+
+    def test_schema_remove_keeps_shorter_prefix(self):
+        self.database.set_schema('a', Schema({'name': 'string'}))
+        self.database.set_schema('account:', Schema(
+            {'name': 'string'}, required=['name']))
+        account = Object.from_string('{"name": "Bill"}')
+        self.database.put('account:1', account)
+        self.database.remove_schema('account:')
+        account.remove('name')
+        self.assertRaises(TypeError, account.put, 'name', 5)
+
+    def test_metrics(self):
+        METRICS.reset()
+        METRICS.enable()
+        try:
+            database = PersistentDB(BaseDB(), 'test_commands.txt',
+                                    'test_snapshot.txt')
+            database.put('Key', 1)
+            cursor = database.get_cursor('Key')
+            cursor.add_observer(Observer())
+            database.put('Key', 2)
+            database.get('Key')
+            database.get_json()
+        finally:
+            METRICS.disable()
+
+        metrics = METRICS.snapshot()
+        self.assertEqual(metrics['latency']['put']['count'], 2)
+        self.assertEqual(metrics['latency']['log.append']['count'], 2)
+        for phase in ['put.validate', 'put.notify', 'command.old_value',
+                      'get_json']:
+            self.assertIn(phase, metrics['latency'])
+        self.assertEqual(metrics['counters']['notifications'], 1)
+        self.assertEqual(metrics['counters']['observer_notifications'], 1)
+        self.assertEqual(metrics['counters']['log.records'], 2)
+        self.assertGreater(metrics['counters']['log.bytes'], 0)
+
+    def test_metrics_disabled(self):
+        METRICS.reset()
+        self.database.put('Key', 1)
+        self.assertEqual(METRICS.snapshot(), {'latency': {}, 'counters': {}})
+
+    def test_metrics_hook(self):
+        phases = []
+
+        def hook(name, seconds):
+            phases.append(name)
+        METRICS.add_hook(hook)
+        METRICS.enable()
+        try:
+            self.database.put('Key', 1)
+        finally:
+            METRICS.disable()
+            METRICS.remove_hook(hook)
+        self.assertEqual(phases, ['put.validate', 'put.notify', 'put'])
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+    def test_basedb_memory_usage(self):
+        self.database.put('Key', 1)
+        self.database.put('Object', Object.from_string(
+            json.dumps({"name": "Bill", "phones": ["619-594-3535"]})))
+        usage = self.database.memory_usage()
+        self.assertGreater(usage['Object'], usage['Key'])
+
+    def test_numeric_array(self):
+        series = NumericArray('float64', [1.5, 2.5])
+        series.put(3).extend([4.0, 5.0])
+        self.assertEqual(series.length(), 5)
+        self.assertEqual(series.get(2), 3.0)
+        self.assertEqual(series.sum(), 16.0)
+        self.assertEqual(series.min(), 1.5)
+        self.assertEqual(series.max(), 5.0)
+        self.assertEqual(series.mean(), 3.2)
+        self.assertEqual(series.slice(1, 3).to_list(), [2.5, 3.0])
+        self.assertRaises(TypeError, series.put, 'text')
+
+    def test_numeric_array_int64(self):
+        counts = NumericArray('int64', [1, 2, 3])
+        self.assertEqual(counts.sum(), 6)
+        self.assertRaises(TypeError, counts.put, 1.5)
+        self.assertRaises(TypeError, counts.extend, [1.5])
+
+    def test_numeric_array_interop(self):
+        source = Array.from_string('[1, 2.5, 3]')
+        series = NumericArray.from_array(source)
+        self.assertEqual(series.to_list(), [1.0, 2.5, 3.0])
+        self.assertEqual(series.to_array().to_string(), '[1.0, 2.5, 3.0]')
+
+        # nested, it is stored as an Array
+        document = Object()
+        self.assertRaises(TypeError, document.put, 'series', series)
+        self.assertRaises(TypeError, Array().put, series)
+        document.put('series', series.to_array())
+        self.assertEqual(document.to_string(), '{"series": [1.0, 2.5, 3.0]}')
+
+    def test_numeric_array_encode(self):
+        series = NumericArray('int64', [1, -2, 2 ** 40])
+        encoded = json.loads(json.dumps(series.encode()))
+        self.assertEqual(from_json_value(encoded).to_list(), [1, -2, 2 ** 40])
+        self.assertEqual(from_json_value(encoded).dtype(), 'int64')
+
+    def test_persistentdb_recover_numeric_array(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.put('Series1', NumericArray('float64', [1.0, 2.0]))
+        database.snapshot()
+        database.put('Series2', NumericArray('int64', [3, 4]))
+        self.assertEqual(database.get_json(),
+                         '{"Series1": [1.0, 2.0], "Series2": [3, 4]}')
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        self.assertEqual(recovered_database.get('Series1', NumericArray).sum(),
+                         3.0)
+        self.assertEqual(recovered_database.get('Series2', NumericArray).sum(),
+                         7)
+
+    def test_persistentdb_recover_numeric_lookalikes(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        tagged = {'$numeric': 'int64', 'data': 'AQAAAAAAAAA='}
+        database.put('Object', Object.from_dict(tagged))
+        database.put('Array', Array.from_list(['int64', 'AQAAAAAAAAA=']))
+        database.snapshot()
+        database.put('Logged', Object.from_dict(tagged))
+
+        recovered_database = PersistentDB.recover(command_file, snapshot_file)
+        for key in ('Object', 'Logged'):
+            self.assertEqual(recovered_database.get(key, Object).to_string(),
+                             json.dumps(tagged))
+        self.assertEqual(recovered_database.get('Array', Array).length(), 2)
+
+    def put_account(self, key, name, city, balance):
+        account = Object()
+        account.put('name', name).put('city', city).put('balance', balance)
+        self.database.put(key, account)
+        return account
+
+    def test_sum_view(self):
+        self.put_account('account:1', 'Bill', 'San Diego', 100)
+        self.database.put('other', 5)
+        total = self.database.add_view('total', SumView(
+            lambda account: account.get('balance'), prefix='account:'))
+        self.assertEqual(total.get(), 100)
+
+        account = self.put_account('account:2', 'Ann', 'La Jolla', 50)
+        self.assertEqual(total.get(), 150)
+        # changed in place, then put again
+        account.put('balance', 70)
+        self.database.put('account:2', account)
+        self.assertEqual(total.get(), 170)
+        self.database.remove('account:1')
+        self.assertEqual(total.get(), 70)
+
+    def test_count_view_groups(self):
+        cities = self.database.add_view('cities', CountView(
+            group_by=lambda account: account.get('city'), prefix='account:'))
+        self.put_account('account:1', 'Bill', 'San Diego', 100)
+        self.put_account('account:2', 'Ann', 'San Diego', 50)
+        self.put_account('account:3', 'Roger', 'La Jolla', 10)
+        self.assertEqual(cities.get('San Diego'), 2)
+        self.put_account('account:2', 'Ann', 'La Jolla', 50)
+        self.assertEqual(cities.get('San Diego'), 1)
+        self.assertEqual(cities.get('La Jolla'), 2)
+        self.assertEqual(cities.get('Boston'), 0)
+
+    def test_filter_view(self):
+        rich = self.database.add_view('rich', FilterView(
+            lambda account: account.get('balance') > 75))
+        self.put_account('account:1', 'Bill', 'San Diego', 100)
+        self.put_account('account:2', 'Ann', 'San Diego', 50)
+        self.database.put('other', 5)
+        self.assertEqual(rich.get(), frozenset(['account:1']))
+        self.put_account('account:1', 'Bill', 'San Diego', 10)
+        self.assertEqual(rich.length(), 0)
+
+    def test_filter_view_cursor(self):
+        rich = self.database.add_view('rich', FilterView(
+            lambda value: value > 75))
+        observer = ValueObserver()
+        rich.get_cursor().add_observer(observer)
+        for i in range(20000):
+            self.database.put('account:' + str(i), 100)
+        start = time.perf_counter()
+        for i in range(1000):
+            self.database.put('account:' + str(i), 10)
+        # copying the 20000 keys for each change takes seconds
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(len(observer.values), 21000)
+        self.assertEqual(observer.values[0], {'account:0'})
+        self.assertEqual(len(observer.values[19999]), 20000)
+        self.assertEqual(rich.get(), frozenset(
+            'account:' + str(i) for i in range(1000, 20000)))
+        self.assertEqual(rich.get() & {'account:1', 'account:1000'},
+                         {'account:1000'})
+
+    def test_top_view(self):
+        top = self.database.add_view('top', TopView(
+            2, lambda account: account.get('balance')))
+        self.put_account('account:1', 'Bill', 'San Diego', 100)
+        self.put_account('account:2', 'Ann', 'San Diego', 50)
+        self.put_account('account:3', 'Roger', 'La Jolla', 75)
+        self.assertEqual(top.get(), [['account:1', 100], ['account:3', 75]])
+        self.database.remove('account:1')
+        self.assertEqual(top.get(), [['account:3', 75], ['account:2', 50]])
+
+    def test_top_view_many_keys(self):
+        top = self.database.add_view('top', TopView(
+            10, lambda value: value))
+        rng = random.Random(1)
+        scores = dict()
+        for _ in range(5000):
+            key = 'Key' + str(rng.randrange(3000))
+            if rng.random() < 0.2 and key in scores:
+                self.database.remove(key)
+                del scores[key]
+            else:
+                scores[key] = rng.randrange(1000)
+                self.database.put(key, scores[key])
+        expected = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        self.assertEqual(top.get(), [list(item) for item in expected[:10]])
+
+    def test_chunked_list_bisect(self):
+        values = ChunkedList()
+        for value in range(0, 4000, 2):
+            values.append(value)
+        self.assertEqual(values.bisect_left(-1), 0)
+        self.assertEqual(values.bisect_left(1500), 750)
+        self.assertEqual(values.bisect_left(1501), 751)
+        self.assertEqual(values.bisect_left(5000), 2000)
+
+    def test_view_error_reaches_other_views(self):
+        def fails_on_two(value):
+            if value == 2:
+                raise ValueError("failed")
+            return value
+        broken = self.database.add_view('broken', SumView(fails_on_two))
+        total = self.database.add_view('total', SumView(lambda value: value))
+        self.database.put('Key', 1)
+        cursor = self.database.get_cursor('Key')
+        observer = ValueObserver()
+        cursor.add_observer(observer)
+
+        self.assertRaises(ValueError, self.database.put, 'Key', 2)
+        self.assertEqual(broken.get(), 0)
+        self.assertEqual(total.get(), 2)
+        self.assertEqual(observer.values, [2])
+        self.assertEqual(self.database.get('Key'), 2)
+
+    def test_add_view_skips_expired_frozen_values(self):
+        clock = [100.0]
+        database = BaseDB(clock=lambda: clock[0],
+                          cold_codec=ZlibCodec(min_size=10))
+        database.put('Old', Object.from_string('{"balance": 10}'), ttl=5)
+        database.put('Cold', Object.from_string('{"balance": 20}'))
+        database.freeze('Old')
+        database.freeze('Cold')
+        clock[0] = 106.0
+
+        total = database.add_view('total', SumView(
+            lambda account: account.get('balance')))
+        database.set_schema('', Schema({'balance': 'int'}))
+        self.assertEqual(total.get(), 20)
+        self.assertEqual(type(database.peek('Cold')), CompressedValue)
+        self.assertRaises(TypeError, database.get('Cold').put, 'balance', 'x')
+
+    def test_view_cursor(self):
+        total = self.database.add_view('total', SumView(
+            lambda account: account.get('balance')))
+        cursor = total.get_cursor()
+        observer = ValueObserver()
+        cursor.add_observer(observer)
+        self.put_account('account:1', 'Bill', 'San Diego', 100)
+        self.put_account('account:2', 'Ann', 'San Diego', 50)
+        self.database.remove('account:1')
+        self.assertEqual(observer.values, [100, 150, 50])
+        self.assertEqual(cursor.get(), 50)
+
+    def test_text_index(self):
+        index = self.database.add_view('search', TextIndex(
+            ['name', 'city', 'address.city'], 'account:'))
+        self.put_account('account:1', 'Bill Smith', 'San Diego', 100)
+        self.put_account('account:2', 'Ann Smith', 'Los Angeles', 50)
+        self.put_account('account:3', 'Sandy Jones', 'San Francisco', 75)
+        self.database.put('account:4', Object.from_string(json.dumps(
+            {'address': [{'city': 'Santa Fe'}], 'note': 'Smith'})))
+        self.database.put('note', 'Bill Smith')
+        self.assertEqual(index.search('smith'), {'account:1', 'account:2'})
+        self.assertEqual(index.search('smith san'), {'account:1'})
+        self.assertEqual(index.search('san*'),
+                         {'account:1', 'account:3', 'account:4'})
+        self.assertEqual(index.search('ann OR jones'),
+                         {'account:2', 'account:3'})
+        self.assertEqual(index.search('San-Diego'), {'account:1'})
+        self.assertEqual(index.search('balance'), frozenset())
+
+        self.put_account('account:1', 'Bill Brown', 'San Diego', 100)
+        self.database.remove('account:2')
+        self.assertEqual(index.search('smith'), frozenset())
+        self.assertEqual(index.get('brown'), {'account:1'})
+
+    def test_text_index_cursor(self):
+        index = self.database.add_view('search', TextIndex())
+        cursor = index.get_cursor('smith')
+        observer = ValueObserver()
+        cursor.add_observer(observer)
+        self.database.put('name', 'Bill Smith')
+        self.database.put('names', Array().put('Ann Smith'))
+        self.database.remove('name')
+        self.assertEqual(observer.values, [{'name'}, {'name', 'names'},
+                                           {'names'}])
+
+    def test_text_index_cursor_matches_search(self):
+        index = self.database.add_view('search', TextIndex())
+        queries = ['red', 'red apple', 'gr*', 'red OR pear', 'ap* OR x',
+                   '']
+        cursors = [index.get_cursor(query) for query in queries]
+        cursors.append(index.get_cursor())
+        words = ['red', 'green', 'grape', 'apple', 'pear', 'x']
+        rng = random.Random(1)
+        stored = set()
+        for i in range(500):
+            key = 'key' + str(rng.randrange(50))
+            if rng.random() < 0.2:
+                if key in stored:
+                    self.database.remove(key)
+                    stored.discard(key)
+                continue
+            self.database.put(key, ' '.join(rng.sample(words, 2)))
+            stored.add(key)
+        for (query, cursor) in zip(queries + [None], cursors):
+            self.assertEqual(cursor.get(), index.search(query or ''), query)
+
+    def test_text_index_reuses_key_ids(self):
+        index = self.database.add_view('search', TextIndex())
+        cursor = index.get_cursor('active')
+        for i in range(10):
+            self.database.put('user:' + str(i), 'active user')
+        size = index.memory_size()
+        for i in range(20000):
+            key = 'session:' + str(i)
+            self.database.put(key, 'active session')
+            self.database.remove(key)
+        self.assertLess(index.memory_size(), size * 2)
+        self.database.put('session:x', 'active')
+        self.database.put('user:3', 'gone')
+        self.assertEqual(index.search('active'), frozenset(
+            ['session:x'] + ['user:' + str(i) for i in range(10) if i != 3]))
+        self.assertEqual(cursor.get(), index.search('active'))
+        self.assertEqual(index.search('session'), frozenset())
+
+    def test_posting_list(self):
+        postings = PostingList()
+        for doc_id in range(0, 100000, 3):
+            postings.add(doc_id)
+        for doc_id in range(0, 3000, 6):
+            postings.remove(doc_id)
+        expected = set(range(0, 100000, 3)) - set(range(0, 3000, 6))
+        self.assertEqual(postings.ids(), expected)
+        self.assertEqual(len(postings), len(expected))
+        self.assertLess(postings.size(), len(expected) * 2)
+        self.assertEqual(postings.intersection({3, 6, 9, 99999, 100002}),
+                         {3, 9, 99999})
+
+    def test_persistentdb_recover_text_index(self):
+        command_file = 'test_commands.txt'
+        snapshot_file = 'test_snapshot.txt'
+        database = PersistentDB(BaseDB(), command_file, snapshot_file)
+        database.put('a', 'red apple')
+        database.snapshot()
+        database.put('b', 'green apple')
+        recovered_base = BaseDB()
+        index = recovered_base.add_view('search', TextIndex())
+        PersistentDB.recover(command_file, snapshot_file,
+                             database=recovered_base)
+        self.assertEqual(index.search('apple'), {'a', 'b'})
+        os.remove(command_file)
+        os.remove(snapshot_file)
+
+    def test_hash_map(self):
+        versions = [HashMap()]
+        for i in range(2000):
+            versions.append(versions[-1].set('key' + str(i), i))
+        smaller = versions[-1].delete('key7')
+        self.assertEqual(len(versions[-1]), 2000)
+        self.assertEqual(len(smaller), 1999)
+        self.assertFalse('key7' in smaller)
+        self.assertEqual(versions[8]['key7'], 7)
+        self.assertFalse('key8' in versions[8])
+        self.assertEqual(dict(versions[-1].items()),
+                         {'key' + str(i): i for i in range(2000)})
+        with self.assertRaises(KeyError):
+            smaller.delete('key7')
+
+    def test_vector(self):
+        vector = Vector()
+        for i in range(1100):
+            vector = vector.append(i)
+        changed = vector.set(500, 'x')
+        self.assertEqual(vector.get(500), 500)
+        self.assertEqual(changed.get(500), 'x')
+        self.assertEqual(list(vector), list(range(1100)))
+        for i in range(100):
+            vector = vector.pop()
+        self.assertEqual(list(vector), list(range(1000)))
+        self.assertEqual(vector.get(-1), 999)
+
+    def test_rope(self):
+        rng = random.Random(1)
+        rope = Rope.of(range(1000))
+        expected = list(range(1000))
+        versions = [(rope, list(expected))]
+        for i in range(3000):
+            choice = rng.random()
+            if choice < 0.4 and expected:
+                index = rng.randrange(len(expected))
+                rope = rope.remove(index)
+                del expected[index]
+            elif choice < 0.7:
+                rope = rope.append(i)
+                expected.append(i)
+            elif expected:
+                index = rng.randrange(len(expected))
+                rope = rope.set(index, -i)
+                expected[index] = -i
+            if i % 500 == 0:
+                versions.append((rope, list(expected)))
+        for (version, values) in versions:
+            self.assertEqual(list(version), values)
+            self.assertEqual(len(version), len(values))
+            self.assertEqual([version.get(index)
+                              for index in range(len(values))], values)
+        for index in range(len(expected), 0, -1):
+            rope = rope.remove(rng.randrange(index))
+        self.assertEqual(list(rope), [])
+        self.assertEqual(list(rope.append(1)), [1])
+        self.assertRaises(IndexError, rope.get, 0)
+
+    def test_immutable_array_remove_middle(self):
+        array = ImmutableArray.of(Array.from_string(
+            json.dumps(list(range(100000)))))
+        start = time.perf_counter()
+        for i in range(1000):
+            array = array.remove(500)
+        # rebuilding the 100000 elements takes seconds
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(array.length(), 99000)
+        self.assertEqual(array.get(499), 499)
+        self.assertEqual(array.get(500), 1500)
+        self.assertEqual(array.remove(-1).get(-1), 99998)
+
+    def test_immutable_object(self):
+        first = ImmutableObject().put('name', 'Bill')
+        second = first.put('phones', Array().put('619-594-3535'))
+        third = second.remove('name')
+        self.assertEqual(first.keys(), ['name'])
+        self.assertEqual(type(second.get('phones')), ImmutableArray)
+        self.assertEqual(json.loads(second.to_string()),
+                         {'name': 'Bill', 'phones': ['619-594-3535']})
+        self.assertEqual(third.keys(), ['phones'])
+        self.assertEqual(second.thaw().get('phones').get(0), '619-594-3535')
+
+    def test_array_insert_remove(self):
+        timeline = Array()
+        for i in range(3000):
+            timeline.put(i)
+        timeline.insert(0, 'first').insert(1500, 'middle').set(-1, 'last')
+        self.assertEqual(timeline.get(0), 'first')
+        self.assertEqual(timeline.get(1500), 'middle')
+        self.assertEqual(timeline.remove(1500), 'middle')
+        self.assertEqual(timeline.remove(0), 'first')
+        self.assertEqual(timeline.remove(-1), 'last')
+        self.assertEqual(timeline.length(), 2999)
+        self.assertEqual(json.loads(timeline.to_string()), list(range(2999)))
+
+    def test_array_outgrows_plain_list(self):
+        limit = Array.list_limit
+        small = Array.from_list(list(range(limit)))
+        small.insert(0, -1)
+        self.assertEqual(small.length(), limit + 1)
+        self.assertEqual(small.get(-1), limit - 1)
+        nested = Array.from_list([[i] for i in range(limit + 10)])
+        self.assertEqual(nested.to_string(),
+                         json.dumps([[i] for i in range(limit + 10)]))
+        nested.get(limit + 5).put('x')
+        self.assertEqual(json.loads(nested.to_string())[limit + 5],
+                         [limit + 5, 'x'])
+        for i in range(limit + 10):
+            nested.remove(-1)
+        self.assertEqual(nested.to_string(), '[]')
+        self.assertRaises(IndexError, nested.get, 0)
+
+    def test_array_to_string_after_changes(self):
+        account = Object().put('balance', 10)
+        accounts = Array().put('Bill').put(account)
+        names = Array()
+        for i in range(2000):
+            names.put(str(i))
+        self.assertEqual(accounts.to_string(), '["Bill", {"balance": 10}]')
+        self.assertEqual(json.loads(names.to_string())[1999], '1999')
+        account.put('balance', 20)
+        names.set(1999, 'last')
+        self.assertEqual(accounts.to_string(), '["Bill", {"balance": 20}]')
+        self.assertEqual(json.loads(names.to_string())[1999], 'last')
+
+    def test_cached_json_after_nested_changes(self):
+        address = Object().put('city', 'San Diego')
+        phones = Array().put('619-594-3535')
+        self.database.put('Bill', Object().put('address', address)
+                          .put('phones', phones))
+        self.database.put('Ann', Object().put('address', address))
+        self.database.get_json()
+        address.put('city', 'Boston')
+        phones.set(0, Array().put(1))
+        self.assertEqual(json.loads(self.database.get_json()), {
+            'Bill': {'address': {'city': 'Boston'}, 'phones': [[1]]},
+            'Ann': {'address': {'city': 'Boston'}}})
+        phones.get(0).put(2)
+        self.database.get('Ann').remove('address')
+        self.assertEqual(json.loads(self.database.get_json()), {
+            'Bill': {'address': {'city': 'Boston'}, 'phones': [[1, 2]]},
+            'Ann': {}})
+
+    def test_removed_value_changes_do_not_reach_database(self):
+        account = Object().put('balance', 10)
+        self.database.put('account', account)
+        self.database.get_json()
+        self.database.remove('account')
+        account.put('balance', 20)
+        self.assertEqual(self.database.get_json(), '{}')
+
+    def test_discarded_parent_is_not_kept_alive(self):
+        address = Object().put('city', 'San Diego')
+        document = Object().put('address', address).put('home', address)
+        document.to_string()
+        reference = weakref.ref(document)
+        document.remove('home')
+        address.put('city', 'Boston')
+        self.assertEqual(json.loads(document.to_string()),
+                         {'address': {'city': 'Boston'}})
+        del document
+        self.assertEqual(reference(), None)
+        address.put('city', 'Denver')
+
+    def test_numeric_array_in_immutable_object(self):
+        series = NumericArray('int64', [1, 2])
+        self.assertRaises(TypeError, ImmutableObject().put, 'series', series)
+        self.assertRaises(TypeError, ImmutableObject().put, 'series',
+                          series.read_only())
+
+    def test_immutable_array(self):
+        first = ImmutableArray().put(1).put(2).put(3)
+        self.assertEqual(first.remove(0).to_string(), '[2, 3]')
+        self.assertEqual(first.remove(-1).to_string(), '[1, 2]')
+        self.assertEqual(first.set(1, 5).to_string(), '[1, 5, 3]')
+        self.assertEqual(first.to_string(), '[1, 2, 3]')
+        with self.assertRaises(TypeError):
+            first.put((1, 2))
+
+    def test_basedb_version(self):
+        database = BaseDB(immutable=True)
+        database.put('account', Object.from_string('{"balance": 100}'))
+        version = database.version()
+        account = database.get('account')
+        self.assertEqual(type(account), ImmutableObject)
+        database.put('account', account.put('balance', 50))
+        database.put('other', 1)
+        self.assertEqual(version.get('account').get('balance'), 100)
+        self.assertEqual(version.keys(), ['account'])
+        self.assertEqual(database.version().get('account').get('balance'), 50)
+        with self.assertRaises(Exception):
+            BaseDB().version()
+
+    def test_immutable_undo_and_schema(self):
+        database = BaseDB(immutable=True)
+        database.set_schema('account:', {'balance': 'number'})
+        transaction = PersistentDB(database, 'test_commands.txt').transaction()
+        transaction.put('account:1', Object.from_string('{"balance": 100}'))
+        transaction.commit()
+        account = database.get('account:1')
+        with self.assertRaises(TypeError):
+            account.put('balance', 'a lot')
+        transaction = PersistentDB(database, 'test_commands.txt').transaction()
+        transaction.put('account:1', account.put('balance', 50))
+        transaction.abort()
+        self.assertIs(database.get('account:1'), account)
+        os.remove('test_commands.txt')
+
+    def test_immutable_set_schema_keeps_versions(self):
+        database = BaseDB(immutable=True)
+        database.put('account:1', Object.from_string(
+            '{"balance": 100, "tags": ["a"]}'))
+        version = database.version()
+        database.set_schema('account:',
+                            {'balance': 'number', 'tags': ['string']})
+        self.assertEqual(version.get('account:1').get_schema(), None)
+        self.assertEqual(version.get('account:1').get('tags').get_schema(),
+                         None)
+        version.get('account:1').put('balance', 'a lot')
+        with self.assertRaises(TypeError):
+            database.get('account:1').put('balance', 'a lot')
+        with self.assertRaises(TypeError):
+            database.get('account:1').get('tags').put(1)
+        bound = database.version()
+        database.remove_schema('account:')
+        self.assertNotEqual(bound.get('account:1').get_schema(), None)
+        database.get('account:1').put('balance', 'a lot')
+        database.get('account:1').get('tags').put(1)
+
+    def test_immutable_keeps_insertion_order(self):
+        source = '{"z": 1, "a": {"y": 2, "b": 3}, "m": [1, 2]}'
+        mutable = BaseDB()
+        immutable = BaseDB(immutable=True)
+        for database in (mutable, immutable):
+            for key in ['k' + str(i) for i in range(100, 0, -1)]:
+                database.put(key, Object.from_string(source))
+            for i in range(1, 100, 3):
+                database.remove('k' + str(i))
+            database.put('k5', 1)
+        self.assertEqual(immutable.get_json(), mutable.get_json())
+        self.assertEqual(immutable.version().get_json(), mutable.get_json())
+        self.assertEqual(list(immutable.export_iter()),
+                         list(mutable.export_iter()))
+
+    def test_immutable_numeric_array_read_only(self):
+        database = BaseDB(immutable=True)
+        values = NumericArray('int64', [1, 2])
+        database.put('a', values)
+        version = database.version()
+        values.put(3)
+        stored = database.get('a')
+        self.assertEqual(stored.to_list(), [1, 2])
+        for change in (lambda: stored.put(3), lambda: stored.extend([3]),
+                       lambda: stored.remove(0)):
+            with self.assertRaises(TypeError):
+                change()
+        database.put('a', stored.slice().put(3))
+        self.assertEqual(version.get('a').to_list(), [1, 2])
+        self.assertEqual(database.get('a').to_list(), [1, 2, 3])
+
+    def test_persistentdb_recover_immutable(self):
+        if os.path.exists('test_snapshot.txt'):
+            os.remove('test_snapshot.txt')
+        database = PersistentDB(BaseDB(immutable=True), 'test_commands.txt',
+                                'test_snapshot.txt')
+        database.put('a', Object.from_string('{"b": [1, 2]}'))
+        database.snapshot()
+        database.put('c', database.get('a').put('d', 3))
+        recovered = PersistentDB.recover('test_commands.txt',
+                                         'test_snapshot.txt',
+                                         database=BaseDB(immutable=True))
+        self.assertEqual(json.loads(recovered.version().get_json()),
+                         {'a': {'b': [1, 2]}, 'c': {'b': [1, 2], 'd': 3}})
+        os.remove('test_commands.txt')
+        os.remove('test_snapshot.txt')
+
     def test_number_validator_is_valid(self):
         validator = NumberValidator()
         self.assertTrue(validator.is_valid(5) and
@@ -360,5 +1534,95 @@ class TestDB(unittest.TestCase):
         self.assertFalse(validator.is_valid((3, 5)))
 
 
+
+class TestBenchmark(unittest.TestCase):
+    def result(self, ops_per_s: float, p99: float, mean: float) -> dict:
+        latency = {"read": {"count": 10, "mean": mean, "p99": p99}}
+        return {"load": {"ops_per_s": 1000.0},
+                "run": {"ops_per_s": ops_per_s, "latency_us": latency},
+                "recover_seconds": None}
+
+    def test_compare(self):
+        baseline = self.result(1000.0, 10.0, 5.0)
+        self.assertEqual(benchmark.compare(baseline, baseline), [])
+
+        # one histogram bucket higher is within the resolution of p99
+        self.assertEqual(benchmark.compare(
+            baseline, self.result(1000.0, 10.0 * 2 ** 0.25, 5.0)), [])
+        regressions = benchmark.compare(
+            baseline, self.result(800.0, 10.0 * 2 ** 0.5, 6.0))
+        self.assertEqual([regression.split(':')[0]
+                          for regression in regressions],
+                         ['run ops_per_s', 'read mean_us', 'read p99_us'])
+        self.assertEqual(benchmark.compare(
+            baseline, self.result(800.0, 10.0, 5.0), threshold=0.25), [])
+
+    def test_generators_stay_in_range(self):
+        for (name, generator) in benchmark.DISTRIBUTIONS.items():
+            keys = generator(100, random.Random(1))
+            for items in (100, 150):
+                keys.grow(items)
+                picked = [keys.next() for _ in range(5000)]
+                self.assertGreaterEqual(min(picked), 0, name)
+                self.assertLess(max(picked), items, name)
+
+        # the most popular items come first, or are the newest
+        zipfian = benchmark.ZipfianGenerator(1000, random.Random(1))
+        self.assertLess(sorted(zipfian.next() for _ in range(1001))[500], 100)
+        latest = benchmark.LatestGenerator(1000, random.Random(1))
+        self.assertGreater(sorted(latest.next() for _ in range(1001))[500],
+                           900)
+
+    def test_run_workload_copies_values(self):
+        result = benchmark.run_workload(
+            'persistent', 'read-modify-write', 'uniform', 'object',
+            records=20, operations=50)
+        self.assertEqual(result["run"]["latency_us"]["read"]["count"] +
+                         result["run"]["latency_us"]["read-modify-write"]
+                         ["count"], 50)
+        value = benchmark.make_value('object', random.Random(1))
+        copied = benchmark.copy_value(value)
+        self.assertIsNot(copied, value)
+        self.assertEqual(copied.to_string(), value.to_string())
+
+    def test_run_throughput_excludes_copies(self):
+        result = benchmark.run_workload(
+            'base', 'update-heavy', 'uniform', 'object',
+            records=20, operations=200)
+        timed_us = sum(statistics["mean"] * statistics["count"]
+                       for statistics in result["run"]["latency_us"].values())
+        self.assertAlmostEqual(result["run"]["ops_per_s"],
+                               200 / timed_us * 1e6,
+                               delta=result["run"]["ops_per_s"] * 0.05)
+
+    def test_main(self):
+        baseline_file = 'test_baseline.json'
+        current_file = 'test_current.json'
+        try:
+            self.assertEqual(benchmark.main(
+                ['ycsb', '--records', '10', '--operations', '20',
+                 '--output', baseline_file]), 0)
+            with open(baseline_file) as file:
+                result = json.load(file)
+            self.assertEqual(result["config"]["records"], 10)
+            self.assertEqual(result["config"]["operations"], 20)
+
+            with open(current_file, 'w') as file:
+                json.dump(self.result(1.0, 1e9, 1e9), file)
+            self.assertEqual(benchmark.main(
+                ['compare', baseline_file, baseline_file]), 0)
+            self.assertEqual(benchmark.main(
+                ['compare', baseline_file, current_file]), 1)
+        finally:
+            for file in (baseline_file, current_file):
+                if os.path.exists(file):
+                    os.remove(file)
+
+        with self.assertRaises(SystemExit):
+            benchmark.main(['ycsb', '--workload', 'unknown'])
+        with self.assertRaises(SystemExit):
+            benchmark.main([])
+
+
 if __name__ == '__main__':
     unittest.main()